@@ -0,0 +1,111 @@
+import asyncio
+from collections import namedtuple
+import datetime
+import decimal
+import unittest
+
+import cp_async_connectors as cp
+import cp_connectors
+
+
+
+ParameterType = namedtuple('ParameterType', ['name'])
+
+
+
+class FakeStatement(object):
+    """
+    Stands in for an asyncpg prepared statement, recording the arguments of each execution
+    """
+
+    def __init__(self, query, parameter_types):
+        self.query = query
+        self.parameter_types = parameter_types
+        self.executions = []
+
+    def get_parameters(self):
+        return [ParameterType(name) for name in self.parameter_types]
+
+    def get_attributes(self):
+        return []
+
+    async def fetch(self, *args):
+        self.executions.append(list(args))
+        return []
+
+    def get_statusmsg(self):
+        return 'INSERT 0 %d' % (len(self.executions[-1]) // max(len(self.parameter_types), 1),)
+
+
+
+class FakeConnection(object):
+    """
+    Stands in for an asyncpg connection, preparing statements whose parameters are all of one type per
+    column
+    """
+
+    def __init__(self, column_types):
+        self.column_types = column_types
+        self.statements = []
+
+    async def prepare(self, query):
+        count = query.count('$')
+        types = [self.column_types[i % len(self.column_types)] for i in range(count)]
+
+        statement = FakeStatement(query, types)
+        self.statements.append(statement)
+
+        return statement
+
+    def is_closed(self):
+        return False
+
+    def is_in_transaction(self):
+        return False
+
+
+
+class AsyncPSQLConnectorTest(unittest.TestCase):
+
+    def test_build_statements_should_number_parameters(self):
+        db = cp.AsyncPSQLConnector(FakeConnection(['text']))
+
+        statement = db.build_upsert_statement('cp_pool', ['id', 'quantity'], ['id'], 2)
+        self.assertEqual(statement, 'INSERT INTO cp_pool (id, quantity) VALUES (%s, %s), (%s, %s) ' +
+            'ON CONFLICT (id) DO UPDATE SET quantity = EXCLUDED.quantity')
+        self.assertEqual(cp_connectors.PSQLStatementBuilder._convert_parameters(statement), 'INSERT INTO cp_pool (id, quantity) ' +
+            'VALUES ($1, $2), ($3, $4) ON CONFLICT (id) DO UPDATE SET quantity = EXCLUDED.quantity')
+
+        self.assertEqual(db.build_insert_statement('cp_pool', ['id'], True), 'INSERT INTO cp_pool (id) VALUES (%s) ON CONFLICT DO NOTHING')
+
+    def test_insert_rows_should_bind_at_most_32767_arguments(self):
+        columns = ['c%d' % (i,) for i in range(50)]
+        conn = FakeConnection(['text'])
+        db = cp.AsyncPSQLConnector(conn)
+
+        rows = [['x'] * len(columns) for i in range(1500)]
+        self.assertEqual(asyncio.run(db.insert_rows('cp_consumer', columns, rows)), 1500)
+
+        executions = [execution for statement in conn.statements for execution in statement.executions]
+        self.assertEqual([len(execution) // len(columns) for execution in executions], [655, 655, 190])
+        self.assertTrue(all(len(execution) <= 32767 for execution in executions))
+
+        # Full batches share one prepared statement
+        self.assertEqual(len(conn.statements), 2)
+
+    def test_insert_rows_should_convert_text_arguments(self):
+        conn = FakeConnection(['text', 'timestamptz', 'timestamp', 'date', 'numeric', 'int4'])
+        db = cp.AsyncPSQLConnector(conn)
+
+        row = ['id', '2020-01-02 03:04:05.5+00', '2020-01-02 03:04:05+02:00', '2020-01-02', '1.25', 3]
+        asyncio.run(db.insert_rows('cp_test', ['id', 'created', 'local', 'day', 'amount', 'count'], [row, ['id2', None, None, None, None, 4]]))
+
+        (first, second) = [conn.statements[0].executions[0][i:i + 6] for i in (0, 6)]
+        self.assertEqual(first, ['id', datetime.datetime(2020, 1, 2, 3, 4, 5, 500000, tzinfo=datetime.timezone.utc),
+            datetime.datetime(2020, 1, 2, 3, 4, 5), datetime.date(2020, 1, 2), decimal.Decimal('1.25'), 3])
+        self.assertEqual(second, ['id2', None, None, None, None, 4])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
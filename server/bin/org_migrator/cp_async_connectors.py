@@ -0,0 +1,620 @@
+#!/usr/bin/env python
+
+# asyncio counterparts to the database connectors in cp_connectors, for callers running many queries at
+# once from a single thread. As with cp_connectors, this file should be imported and used by other
+# scripts, rather than having business logic added to it directly.
+
+# This requires asyncpg or aiomysql for postgresql and mysql/mariadb respectively. Neither is needed by
+# the org migrator itself, so they aren't installed with it.
+
+from collections import OrderedDict
+import datetime
+import decimal
+import re
+import time
+
+import logging
+
+import cp_connectors as cp
+
+log = logging.getLogger('cp_connector')
+
+
+
+def import_asyncpg():
+    try:
+        import asyncpg
+        return asyncpg
+    except ImportError:
+        raise Exception("AsyncPSQLConnector requires the asyncpg package")
+
+def import_aiomysql():
+    try:
+        import aiomysql
+        return aiomysql
+    except ImportError:
+        raise Exception("AsyncMySQLConnector requires the aiomysql package")
+
+def parse_timestamp(value):
+    """
+    Parses a timestamp in the ISO 8601 form written to archives, such as 2020-01-01 12:00:00.5+00:00.
+    Offsets may be given in hours alone, as PostgreSQL prints them.
+    """
+    return datetime.datetime.fromisoformat(re.sub(r'([+-]\d{2})$', r'\1:00', value))
+
+def parse_naive_timestamp(value):
+    # As with PostgreSQL itself, any offset given for a timestamp without a time zone is ignored
+    return parse_timestamp(value).replace(tzinfo=None)
+
+
+
+class AsyncCursor(object):
+    """
+    A cursor over the results of a query run through an AsyncDBConnector. Rows are read with the fetch
+    coroutines, or by iterating the cursor with async for, which fetches itersize rows at a time. The
+    description lists a tuple of the name and type code of each column, as it does for DB-API cursors.
+    """
+
+    def __init__(self, description, itersize=cp.DBConnector.DEFAULT_ITERSIZE):
+        self.description = description
+        self.itersize = itersize
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        while True:
+            rows = await self.fetchmany(self.itersize)
+
+            if len(rows) < 1:
+                break
+
+            for row in rows:
+                yield row
+
+    async def fetchone(self):
+        rows = await self.fetchmany(1)
+        return rows[0] if len(rows) > 0 else None
+
+    async def fetchmany(self, size):
+        raise NotImplementedError("Not yet implemented")
+
+    async def fetchall(self):
+        rows = []
+
+        while True:
+            block = await self.fetchmany(self.itersize)
+
+            if len(block) < 1:
+                return rows
+
+            rows.extend(block)
+
+    async def close(self):
+        pass
+
+
+
+class AsyncDBConnector(cp.InsertBatching):
+    """
+    An asyncio counterpart to DBConnector, offering the same core interface as coroutines so queries on
+    many connections can overlap within a single thread. Queries take parameters in the same %s style,
+    and statements are built by the same statement builders, as those of the synchronous connectors.
+
+    Connectors are created with the connect coroutine of the backend's connector class, or with
+    get_async_db_connector.
+    """
+
+    class TransactionContext(object):
+        def __init__(self, db):
+            self._active = True
+            self._db = db
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, exc_type, exc_value, traceback):
+            # As with synchronous transactions, commit on successful exit and roll back on exception
+            if self._active and self._db.in_transaction():
+                if exc_type is None:
+                    await self.commit()
+                else:
+                    log.debug("async with-statement exited with exception; rolling back transaction")
+                    await self.rollback()
+
+            return False
+
+        async def commit(self):
+            if not self._active or not self._db.in_transaction():
+                raise RuntimeError("Transaction already closed")
+
+            await self._db.commit()
+            self._active = False
+
+        async def rollback(self):
+            if not self._active or not self._db.in_transaction():
+                raise RuntimeError("Transaction already closed")
+
+            await self._db.rollback()
+            self._active = False
+
+
+
+    def __init__(self, db):
+        self.db = db
+        self.itersize = cp.DBConnector.DEFAULT_ITERSIZE
+
+        # An optional callable invoked with the statement and elapsed time of each query executed through
+        # execQuery or execUpdate
+        self.query_listener = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+    def backend(self):
+        raise NotImplementedError("Not yet implemented")
+
+    def get_type_as_string(self, type_code):
+        raise NotImplementedError("Not yet implemented")
+
+    def build_insert_statement(self, table, columns, ignore_duplicates=False, rows=1):
+        raise NotImplementedError("Not yet implemented")
+
+    def build_upsert_statement(self, table, columns, key_columns, rows=1):
+        raise NotImplementedError("Not yet implemented")
+
+    async def insert_rows(self, table, columns, rows, ignore_duplicates=False, batch_size=None):
+        """
+        Inserts the given rows into the table, many rows per statement, returning the number of rows
+        sent. The rows may be a regular or an asynchronous iterable.
+        """
+        return await self._execute_insert_batches(rows, len(columns), batch_size,
+            lambda count: self.build_insert_statement(table, columns, ignore_duplicates, count))
+
+    async def upsert_rows(self, table, columns, key_columns, rows, batch_size=None):
+        """
+        Inserts the given rows into the table, or updates the existing rows with the same key columns,
+        returning the number of rows sent. The rows may be a regular or an asynchronous iterable.
+        """
+        return await self._execute_insert_batches(rows, len(columns), batch_size,
+            lambda count: self.build_upsert_statement(table, columns, key_columns, count))
+
+    async def _execute_insert_batches(self, rows, column_count, batch_size, build_statement):
+        batch_size = self.get_insert_batch_size(column_count, batch_size)
+        statements = {}
+        count = 0
+
+        reported = build_statement(1)
+
+        async for block in AsyncDBConnector._iterate_async_batches(rows, batch_size):
+            for batch in self._iterate_insert_batches(block, batch_size):
+                if len(batch) not in statements:
+                    statements[len(batch)] = build_statement(len(batch))
+
+                await self._execute(statements[len(batch)], [value for row in batch for value in row], reported)
+                count = count + len(batch)
+
+        return count
+
+    @staticmethod
+    async def _iterate_async_batches(rows, batch_size):
+        batch = []
+
+        if hasattr(rows, '__aiter__'):
+            async for row in rows:
+                batch.append(row)
+
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        else:
+            for row in rows:
+                batch.append(row)
+
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+
+        if len(batch) > 0:
+            yield batch
+
+    async def close(self):
+        raise NotImplementedError("Not yet implemented")
+
+    def is_closed(self):
+        raise NotImplementedError("Not yet implemented")
+
+    async def start_transaction(self, readonly=False, consistent=False, snapshot=None):
+        """
+        Starts a new transaction on this connection, as DBConnector.start_transaction does, returning a
+        context which may be used with async with
+        """
+        raise NotImplementedError("Not yet implemented")
+
+    def in_transaction(self):
+        raise NotImplementedError("Not yet implemented")
+
+    async def commit(self):
+        raise NotImplementedError("Not yet implemented")
+
+    async def rollback(self):
+        raise NotImplementedError("Not yet implemented")
+
+    async def export_snapshot(self):
+        return None
+
+    async def execQuery(self, query, parameters=(), server_side=False):
+        """
+        Runs the given query, returning an AsyncCursor over its results. If server_side is set, the
+        results are streamed from the server as the cursor is read rather than read in full up front.
+        """
+        raise NotImplementedError("Not yet implemented")
+
+    async def execUpdate(self, query, parameters=()):
+        """
+        Runs the given statement, returning the number of rows affected
+        """
+        try:
+            return await self._execute(query, parameters)
+        except Exception:
+            if self.in_transaction():
+                await self.rollback()
+
+            raise
+
+    async def _execute(self, query, parameters, reported_query=None):
+        raise NotImplementedError("Not yet implemented")
+
+    def _notify_query(self, query, elapsed):
+        if self.query_listener is not None:
+            self.query_listener(query, elapsed)
+
+
+
+class AsyncPSQLConnector(cp.PSQLStatementBuilder, AsyncDBConnector):
+    """
+    An asynchronous PostgreSQL connector built on asyncpg.
+
+    asyncpg binds parameters in their binary form, so it requires values of the Python type matching
+    the type of each parameter rather than their text. Text bound to temporal and numeric parameters is
+    converted with the TEXT_CONVERTERS, as archives store those values as text; values of any other
+    type must already match the parameter. Timestamps with a time zone given without an offset are
+    taken to be in UTC, rather than the time zone of the session.
+    """
+
+    # asyncpg binds at most 32767 arguments to a single statement
+    MAX_INSERT_PARAMETERS = 32767
+
+    # Functions converting text bound to parameters of the given types
+    TEXT_CONVERTERS = {
+        'timestamptz':  parse_timestamp,
+        'timestamp':    parse_naive_timestamp,
+        'date':         datetime.date.fromisoformat,
+        'time':         datetime.time.fromisoformat,
+        'numeric':      decimal.Decimal
+    }
+
+    class Cursor(AsyncCursor):
+        def __init__(self, description, itersize, records=None, cursor=None):
+            super(AsyncPSQLConnector.Cursor, self).__init__(description, itersize)
+
+            self._records = records
+            self._cursor = cursor
+            self._offset = 0
+
+        async def fetchmany(self, size):
+            if self._cursor is not None:
+                return [tuple(record) for record in await self._cursor.fetch(size)]
+
+            block = self._records[self._offset:self._offset + size]
+            self._offset = self._offset + len(block)
+
+            return [tuple(record) for record in block]
+
+
+
+    def __init__(self, db):
+        super(AsyncPSQLConnector, self).__init__(db)
+
+        self._transaction = None
+
+        # The names of the types seen in query results, by OID
+        self._type_map = {}
+
+        # Prepared statements by the text of the query, in least-recently-used order. asyncpg caches the
+        # statements it prepares itself, but doesn't expose the column types of their results.
+        self.statement_cache_size = cp.DBConnector.DEFAULT_STATEMENT_CACHE_SIZE
+        self.statement_cache_hits = 0
+        self.statement_cache_misses = 0
+        self._statements = OrderedDict()
+
+    @classmethod
+    async def connect(cls, host, port, username, password, dbname):
+        asyncpg = import_asyncpg()
+
+        params = {'host': host, 'user': username, 'password': password, 'database': dbname}
+
+        # Port does not use default when None is passed in; skip it if it's not provided
+        if port is not None:
+            params['port'] = port
+
+        return cls(await asyncpg.connect(**params))
+
+    def backend(self):
+        return 'PostgreSQL'
+
+    def get_type_as_string(self, type_code):
+        return self._type_map.get(type_code)
+
+    async def close(self):
+        if not self.is_closed():
+            if self.statement_cache_hits + self.statement_cache_misses > 0:
+                log.debug("Statement cache: %d hits, %d misses", self.statement_cache_hits, self.statement_cache_misses)
+
+            await self.db.close()
+
+        self._statements.clear()
+
+    def is_closed(self):
+        return self.db is None or self.db.is_closed()
+
+    async def start_transaction(self, readonly=False, consistent=False, snapshot=None):
+        isolation = 'repeatable_read' if (consistent or snapshot is not None) else 'read_committed'
+
+        self._transaction = self.db.transaction(isolation=isolation, readonly=readonly)
+        await self._transaction.start()
+
+        # The snapshot must be adopted before any other query is run in the transaction
+        if snapshot is not None:
+            await self.db.execute("SET TRANSACTION SNAPSHOT '" + snapshot.replace("'", "''") + "'")
+
+        return AsyncDBConnector.TransactionContext(self)
+
+    def in_transaction(self):
+        return not self.is_closed() and self.db.is_in_transaction()
+
+    async def commit(self):
+        log.debug("Committing transaction")
+        (transaction, self._transaction) = (self._transaction, None)
+        await transaction.commit()
+
+    async def rollback(self):
+        log.debug("Rolling back transaction")
+        (transaction, self._transaction) = (self._transaction, None)
+        await transaction.rollback()
+
+    async def export_snapshot(self):
+        if not self.in_transaction():
+            raise RuntimeError("Snapshots can only be exported from an active transaction")
+
+        return await self.db.fetchval('SELECT pg_export_snapshot()')
+
+    async def execQuery(self, query, parameters=(), server_side=False):
+        return await self._run_prepared(query, lambda: self._run_query(query, parameters, server_side))
+
+    async def _run_prepared(self, query, run):
+        import asyncpg
+
+        try:
+            return await run()
+        except (asyncpg.exceptions.InvalidCachedStatementError, asyncpg.exceptions.OutdatedSchemaCacheError):
+            # The schema changed under a cached statement. Outside of a transaction the query can simply
+            # be prepared again; within one, the transaction has already failed.
+            self._statements.pop(query, None)
+
+            if self.in_transaction():
+                raise
+
+            return await run()
+
+    async def _prepare(self, query):
+        statement = self._statements.get(query)
+
+        if statement is not None:
+            self._statements.move_to_end(query)
+            self.statement_cache_hits = self.statement_cache_hits + 1
+
+            return statement
+
+        self.statement_cache_misses = self.statement_cache_misses + 1
+        statement = await self.db.prepare(cp.PSQLStatementBuilder._convert_parameters(query))
+
+        # asyncpg deallocates evicted statements on the server once they're garbage collected
+        if self.statement_cache_size > 0:
+            self._statements[query] = statement
+
+            while len(self._statements) > self.statement_cache_size:
+                self._statements.popitem(last=False)
+
+        return statement
+
+    @staticmethod
+    def _convert_arguments(statement, parameters):
+        converters = [AsyncPSQLConnector.TEXT_CONVERTERS.get(parameter.name) for parameter in statement.get_parameters()]
+
+        if not any(converters):
+            return parameters
+
+        return [(converter(value) if converter is not None and isinstance(value, str) else value)
+            for (converter, value) in zip(converters, parameters)]
+
+    async def _run_query(self, query, parameters, server_side):
+        start = time.time()
+        statement = await self._prepare(query)
+
+        description = []
+        for attribute in statement.get_attributes():
+            self._type_map[attribute.type.oid] = attribute.type.name
+            description.append((attribute.name, attribute.type.oid))
+
+        # Impl note:
+        # As with psycopg2's named cursors, asyncpg's cursors only live as long as the transaction
+        # that declared them
+        parameters = AsyncPSQLConnector._convert_arguments(statement, parameters)
+
+        if server_side and self.in_transaction():
+            cursor = await statement.cursor(*parameters)
+            self._notify_query(query, time.time() - start)
+
+            return AsyncPSQLConnector.Cursor(description, self.itersize, cursor=cursor)
+
+        if server_side:
+            log.debug("Server-side cursors require an active transaction; reading the results up front")
+
+        records = await statement.fetch(*parameters)
+        self._notify_query(query, time.time() - start)
+
+        return AsyncPSQLConnector.Cursor(description, self.itersize, records=records)
+
+    async def _execute(self, query, parameters, reported_query=None):
+        # Statements without parameters may hold several commands, which can't be prepared
+        if len(parameters) < 1:
+            start = time.time()
+            status = await self.db.execute(cp.PSQLStatementBuilder._convert_parameters(query))
+            self._notify_query(reported_query or query, time.time() - start)
+        else:
+            status = await self._run_prepared(query, lambda: self._execute_prepared(query, parameters, reported_query))
+
+        # The status of a statement ends with the number of rows it affected, such as "INSERT 0 5"
+        count = status.split()[-1] if status else ''
+        return int(count) if count.isdigit() else -1
+
+    async def _execute_prepared(self, query, parameters, reported_query):
+        start = time.time()
+        statement = await self._prepare(query)
+
+        await statement.fetch(*AsyncPSQLConnector._convert_arguments(statement, parameters))
+        self._notify_query(reported_query or query, time.time() - start)
+
+        return statement.get_statusmsg()
+
+
+
+class AsyncMySQLConnector(cp.MySQLStatementBuilder, AsyncDBConnector):
+    """
+    An asynchronous MySQL/MariaDB connector built on aiomysql
+    """
+
+    class Cursor(AsyncCursor):
+        def __init__(self, cursor, itersize):
+            super(AsyncMySQLConnector.Cursor, self).__init__([(column[0], column[1]) for column in (cursor.description or [])], itersize)
+            self._cursor = cursor
+
+        async def fetchmany(self, size):
+            return list(await self._cursor.fetchmany(size))
+
+        async def close(self):
+            await self._cursor.close()
+
+
+
+    def __init__(self, db):
+        super(AsyncMySQLConnector, self).__init__(db)
+
+    @classmethod
+    async def connect(cls, host, port, username, password, dbname):
+        aiomysql = import_aiomysql()
+        from pymysql.constants import FIELD_TYPE
+        from pymysql.converters import conversions
+
+        # Dates are read as strings, as they are by MySQLConnector
+        converters = dict(conversions)
+        converters[FIELD_TYPE.DATE] = str
+        converters[FIELD_TYPE.DATETIME] = str
+
+        params = {'host': host, 'user': username, 'password': password, 'db': dbname, 'conv': converters, 'autocommit': True}
+
+        # Port does not use default when None is passed in; skip it if it's not provided
+        if port is not None:
+            params['port'] = port
+
+        return cls(await aiomysql.connect(**params))
+
+    def backend(self):
+        return 'MySQL/MariaDB'
+
+    def get_type_as_string(self, type_code):
+        from pymysql.constants import FIELD_TYPE
+
+        for name in dir(FIELD_TYPE):
+            if getattr(FIELD_TYPE, name) == type_code and not name.startswith('_'):
+                return name
+
+        return None
+
+    async def close(self):
+        if not self.is_closed():
+            self.db.close()
+
+    def is_closed(self):
+        return self.db is None or self.db.closed
+
+    async def start_transaction(self, readonly=False, consistent=False, snapshot=None):
+        # Impl note: As with MySQLConnector, read-only transactions aren't supported
+        if snapshot is not None:
+            raise ValueError("MySQL/MariaDB does not support adopting exported snapshots")
+
+        async with self.db.cursor() as cursor:
+            if consistent:
+                await cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                await cursor.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+            else:
+                await cursor.execute('START TRANSACTION')
+
+        return AsyncDBConnector.TransactionContext(self)
+
+    def in_transaction(self):
+        from pymysql.constants import SERVER_STATUS
+        return not self.is_closed() and bool(self.db.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS)
+
+    async def commit(self):
+        log.debug("Committing transaction")
+        await self.db.commit()
+
+    async def rollback(self):
+        log.debug("Rolling back transaction")
+        await self.db.rollback()
+
+    async def execQuery(self, query, parameters=(), server_side=False):
+        import aiomysql
+
+        # Unbuffered cursors read rows off the wire as they're fetched, and must be read in full before
+        # the connection can be used for another query
+        cursor = await self.db.cursor(aiomysql.SSCursor if server_side else aiomysql.Cursor)
+
+        try:
+            start = time.time()
+            await cursor.execute(query, parameters)
+            self._notify_query(query, time.time() - start)
+        except Exception:
+            await cursor.close()
+            raise
+
+        return AsyncMySQLConnector.Cursor(cursor, self.itersize)
+
+    async def _execute(self, query, parameters, reported_query=None):
+        async with self.db.cursor() as cursor:
+            start = time.time()
+            await cursor.execute(query, parameters)
+            self._notify_query(reported_query or query, time.time() - start)
+
+            return cursor.rowcount
+
+
+
+async def get_async_db_connector(type, host='localhost', port=None, username='candlepin', password='', dbname='candlepin'):
+    connectors = {
+        'psql':         AsyncPSQLConnector,
+        'postgre':      AsyncPSQLConnector,
+        'postgres':     AsyncPSQLConnector,
+        'postgresql':   AsyncPSQLConnector,
+
+        'mariadb':      AsyncMySQLConnector,
+        'mysql':        AsyncMySQLConnector
+    }
+
+    return await connectors[str(type).lower()].connect(host, port, username, password, dbname)
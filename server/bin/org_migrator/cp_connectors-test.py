@@ -0,0 +1,309 @@
+import re
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+import cp_connectors as cp
+
+
+
+def build_connector(cls, db=None):
+    # Builds a connector around the given DB-API connection, rather than connecting to a server
+    connector = cls.__new__(cls)
+    cp.DBConnector.__init__(connector, db if db is not None else Mock())
+
+    return connector
+
+
+
+class PSQLConnectorTest(unittest.TestCase):
+
+    TRANSACTION_STATUS_IDLE = 0
+    TRANSACTION_STATUS_INERROR = 3
+
+    def _build_connector(self, copy_error=None):
+        db = build_connector(cp.PSQLConnector)
+        db.psql = Mock()
+        db.psql.extensions.TRANSACTION_STATUS_INERROR = PSQLConnectorTest.TRANSACTION_STATUS_INERROR
+        db.db.get_transaction_status.return_value = PSQLConnectorTest.TRANSACTION_STATUS_IDLE
+
+        db.execUpdate = Mock(return_value=0)
+        db.cursor = Mock(return_value=Mock())
+
+        # The server reads the rows as they're copied
+        db.cursor.return_value.copy_expert.side_effect = copy_error or (lambda statement, stream, size: stream.read())
+
+        return db
+
+    def test_copy_rows_ignoring_duplicates_should_drop_the_staging_table(self):
+        db = self._build_connector()
+        self.assertEqual(db.copy_rows('cp_pool', ['id'], [['p1'], ['p2']], True), 2)
+
+        statements = [call[0][0] for call in db.execUpdate.call_args_list]
+        self.assertEqual(statements, [
+            'CREATE TEMPORARY TABLE org_migrator_copy_cp_pool (LIKE cp_pool INCLUDING DEFAULTS)',
+            'INSERT INTO cp_pool (id) SELECT id FROM org_migrator_copy_cp_pool ON CONFLICT DO NOTHING',
+            'DROP TABLE IF EXISTS org_migrator_copy_cp_pool'
+        ])
+
+    def test_copy_rows_ignoring_duplicates_should_drop_the_staging_table_after_failures(self):
+        db = self._build_connector(Exception('bad row'))
+
+        with self.assertRaises(Exception):
+            db.copy_rows('cp_pool', ['id'], [['p1']], True)
+
+        self.assertEqual(db.execUpdate.call_args[0][0], 'DROP TABLE IF EXISTS org_migrator_copy_cp_pool')
+
+    def test_copy_rows_ignoring_duplicates_should_leave_failed_transactions_alone(self):
+        db = self._build_connector(Exception('bad row'))
+        db.db.get_transaction_status.return_value = PSQLConnectorTest.TRANSACTION_STATUS_INERROR
+
+        with self.assertRaises(Exception):
+            db.copy_rows('cp_pool', ['id'], [['p1']], True)
+
+        self.assertEqual(db.execUpdate.call_count, 1)
+
+
+
+class MySQLConnectorTest(unittest.TestCase):
+
+    def _load(self, columns, rows, binary_columns=(), bit_columns=()):
+        # Runs copy_rows, returning the LOAD DATA statement and the contents of the load file it was given
+        loads = []
+
+        def execute(statement, params):
+            with open(params[0], 'rb') as fp:
+                loads.append((statement, fp.read().decode('utf-8')))
+
+        cursor = Mock(rowcount=len(rows))
+        cursor.execute.side_effect = execute
+
+        db = build_connector(cp.MySQLConnector)
+        db.supports_local_infile = Mock(return_value=True)
+        db.get_binary_columns = Mock(return_value=list(binary_columns))
+        db.get_bit_columns = Mock(return_value=list(bit_columns))
+        db.cursor = Mock(return_value=cursor)
+
+        self.assertEqual(db.copy_rows('cp_consumer', columns, rows), len(rows))
+        self.assertEqual(len(loads), 1)
+
+        return loads[0]
+
+    def _read_load_file(self, statement, data):
+        # Reads the load file back as the server would, applying the conversions of the SET clause
+        targets = re.search(r'\(([^)]*)\)(?: SET|$)', statement).group(1).split(', ')
+        assignments = dict(re.findall(r'(\w+) = (\w+)\(@\w+', statement))
+
+        rows = []
+        for line in data.splitlines():
+            row = {}
+
+            for (target, field) in zip(targets, line.split('\t')):
+                column = target.lstrip('@')
+                value = None if field == '\\N' else field
+
+                if value is not None and assignments.get(column) == 'CAST':
+                    value = int(value)
+                elif value is not None and assignments.get(column) == 'UNHEX':
+                    value = bytes.fromhex(value)
+
+                row[column] = value
+
+            rows.append(row)
+
+        return rows
+
+    def test_copy_rows_should_load_false_booleans_into_bit_columns(self):
+        (statement, data) = self._load(['id', 'autoheal', 'name'], [['c1', False, 'a'], ['c2', True, 'b'], ['c3', None, 'c']],
+            bit_columns=['autoheal'])
+
+        self.assertIn('(id, @autoheal, name) SET autoheal = CAST(@autoheal AS UNSIGNED)', statement)
+
+        rows = self._read_load_file(statement, data)
+        self.assertEqual([row['autoheal'] for row in rows], [0, 1, None])
+        self.assertEqual([row['name'] for row in rows], ['a', 'b', 'c'])
+
+    def test_copy_rows_should_load_binary_and_bit_columns_together(self):
+        (statement, data) = self._load(['id', 'autoheal', 'content'], [['c1', b'\x00', b'\x01\xff'], ['c2', b'\x01', None]],
+            binary_columns=['content'], bit_columns=['autoheal'])
+
+        self.assertTrue(statement.endswith('(id, @autoheal, @content) SET autoheal = CAST(@autoheal AS UNSIGNED), content = UNHEX(@content)'))
+
+        rows = self._read_load_file(statement, data)
+        self.assertEqual(rows, [{'id': 'c1', 'autoheal': 0, 'content': b'\x01\xff'}, {'id': 'c2', 'autoheal': 1, 'content': None}])
+
+    def test_encode_load_row_should_escape_text(self):
+        db = build_connector(cp.MySQLConnector)
+
+        self.assertEqual(db._encode_load_row(['a\tb\\c\n', 3, None, False], [None, None, None, cp.MySQLConnector.LOAD_BIT]),
+            b'a\\tb\\\\c\\n\t3\t\\N\t0\n')
+
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.opened = []
+
+    def _connect(self):
+        connector = Mock()
+        connector.ping.return_value = True
+        connector.in_transaction.return_value = False
+        connector.is_closed.return_value = False
+
+        self.opened.append(connector)
+        return connector
+
+    def test_acquire_should_reuse_released_connections(self):
+        pool = cp.ConnectionPool(self._connect, max_size=2)
+        self.assertEqual(pool.size, 0)
+
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertEqual(pool.size, 2)
+        self.assertIs(first.pool, pool)
+
+        first.pool.release(first)
+        self.assertIsNone(first.pool)
+        self.assertIs(pool.acquire(), first)
+
+        self.assertEqual(len(self.opened), 2)
+        second.close.assert_not_called()
+
+    def test_release_should_roll_back_open_transactions(self):
+        pool = cp.ConnectionPool(self._connect)
+        connector = pool.acquire()
+        connector.in_transaction.return_value = True
+
+        pool.release(connector)
+
+        connector.rollback.assert_called_once_with()
+        self.assertIs(pool.acquire(), connector)
+
+    def test_acquire_should_replace_connections_failing_validation(self):
+        pool = cp.ConnectionPool(self._connect, max_size=1)
+        broken = pool.acquire()
+        pool.release(broken)
+
+        broken.ping.return_value = False
+        connector = pool.acquire()
+
+        self.assertIsNot(connector, broken)
+        broken.close.assert_called_once_with()
+        self.assertEqual(pool.size, 1)
+
+    def test_release_should_discard_closed_connections(self):
+        pool = cp.ConnectionPool(self._connect, max_size=1)
+        broken = pool.acquire()
+        broken.is_closed.return_value = True
+
+        pool.release(broken)
+        self.assertEqual(pool.size, 0)
+
+        self.assertIsNot(pool.acquire(), broken)
+        self.assertEqual(len(self.opened), 2)
+
+    def test_acquire_should_time_out_when_exhausted(self):
+        pool = cp.ConnectionPool(self._connect, max_size=1)
+        pool.acquire()
+
+        with self.assertRaises(Exception):
+            pool.acquire(timeout=0.05)
+
+    def test_acquire_should_retry_failed_connections(self):
+        attempts = [Exception('refused'), Exception('refused')]
+
+        def connect():
+            if len(attempts) > 0:
+                raise attempts.pop(0)
+
+            return self._connect()
+
+        pool = cp.ConnectionPool(connect, retries=2, backoff=0.5)
+
+        with patch('time.sleep') as sleep:
+            pool.acquire()
+
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [0.5, 1.0])
+        self.assertEqual(pool.size, 1)
+
+    def test_acquire_should_free_the_slot_of_failed_connections(self):
+        pool = cp.ConnectionPool(Mock(side_effect=Exception('refused')), max_size=1, retries=0)
+
+        for i in range(2):
+            with self.assertRaises(Exception):
+                pool.acquire()
+
+        self.assertEqual(pool.size, 0)
+
+    def test_acquire_should_close_expired_idle_connections(self):
+        pool = cp.ConnectionPool(self._connect, min_size=1, max_size=3, idle_timeout=10)
+        connectors = [pool.acquire(), pool.acquire(), pool.acquire()]
+
+        with patch('time.time', return_value=1000):
+            for connector in connectors:
+                pool.release(connector)
+
+        with patch('time.time', return_value=1020):
+            connector = pool.acquire()
+
+        # The pool keeps its minimum size, handing out the most recently released connection
+        self.assertIs(connector, connectors[2])
+        self.assertEqual(pool.size, 1)
+        self.assertEqual([c.close.call_count for c in connectors], [1, 1, 0])
+
+    def test_close_should_close_idle_and_released_connections(self):
+        pool = cp.ConnectionPool(self._connect, max_size=2)
+        (idle, busy) = (pool.acquire(), pool.acquire())
+        pool.release(idle)
+
+        pool.close()
+        idle.close.assert_called_once_with()
+        busy.close.assert_not_called()
+
+        pool.release(busy)
+        busy.close.assert_called_once_with()
+        self.assertEqual(pool.size, 0)
+
+        with self.assertRaises(Exception):
+            pool.acquire()
+
+    def test_pool_should_be_shared_between_threads(self):
+        pool = cp.ConnectionPool(self._connect, max_size=3)
+        lock = threading.Lock()
+        state = {'active': 0, 'peak': 0}
+
+        def work():
+            for i in range(50):
+                connector = pool.acquire(timeout=5)
+
+                with lock:
+                    state['active'] = state['active'] + 1
+                    state['peak'] = max(state['peak'], state['active'])
+
+                time.sleep(0.0005)
+
+                with lock:
+                    state['active'] = state['active'] - 1
+
+                pool.release(connector)
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLessEqual(state['peak'], 3)
+        self.assertLessEqual(len(self.opened), 3)
+        self.assertEqual(pool.size, len(self.opened))
+
+        pool.close()
+        self.assertTrue(all(connector.close.called for connector in self.opened))
+        self.assertEqual(pool.size, 0)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,25 @@
 #!/usr/bin/env python
 
-# The CP connector provides various means for connecting to Candlepin or its supported backing databases.
+# The CP connector provides various means for connecting to Candlepin's supported backing databases.
 # This file should be imported and used by other scripts, rather than having business logic added to it
-# directly.
+# directly. Clients for Candlepin's REST API live in cp_http_connectors, and asyncio database connectors
+# in cp_async_connectors.
 
 # This requires mysql-connector or psycopg2 for mysql/mariadb and postgresql respectively. "Compatible"
 # packages may introduce odd issues (i.e. mysql-connector-python is known to cause problems)
 
+import binascii
+from collections import deque, OrderedDict
+import decimal
+from functools import partial
+import itertools
+import json
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
 
 import logging
 
@@ -16,13 +28,88 @@ log = logging.getLogger('cp_connector')
 
 
 
-class HTTPConnector(object):
-    def __init__(self):
-        pass
+class RowStreamReader(object):
+    """
+    Presents an iterable of rows as a readable file object, encoding the rows with the given function
+    only as the data is read. This allows rows to be streamed to bulk loading interfaces which read
+    from files without materializing the entire data set.
+    """
+
+    def __init__(self, rows, encode_row):
+        self.rows = iter(rows)
+        self.encode_row = encode_row
+        self.count = 0
+
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            row = next(self.rows, None)
+
+            if row is None:
+                break
+
+            self._buffer += self.encode_row(row)
+            self.count = self.count + 1
+
+        if size < 0 or size > len(self._buffer):
+            size = len(self._buffer)
+
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+
+        return data
+
+
+
+class InsertBatching(object):
+    """
+    Splits the rows of bulk inserts into batches, each sent as a single statement kept within the limits
+    of the server. Shared by the synchronous and asyncio connectors.
+    """
 
+    # The default number of rows to insert per statement when bulk inserting
+    DEFAULT_INSERT_BATCH_SIZE = 1000
 
+    # Upper bounds on the number of parameters and the approximate size of the data bound to a single
+    # bulk insert statement. These keep statements well within the limits of the server, such as the
+    # 65535 bind parameters of a prepared statement or MySQL's max_allowed_packet.
+    MAX_INSERT_PARAMETERS = 65535
+    MAX_INSERT_BYTES = 4 * 1024 * 1024
 
-class DBConnector(object):
+    def get_insert_batch_size(self, column_count, batch_size=None):
+        """
+        Returns the number of rows to insert per statement for a table with the given number of columns,
+        limiting the requested batch size to what the server can accept in a single statement
+        """
+        if batch_size is None:
+            batch_size = InsertBatching.DEFAULT_INSERT_BATCH_SIZE
+
+        return max(1, min(batch_size, self.MAX_INSERT_PARAMETERS // max(column_count, 1)))
+
+    def _iterate_insert_batches(self, rows, batch_size):
+        # Yields lists of at most batch_size rows, ending a batch early if the values bound to it would
+        # grow too large
+        iterator = iter(rows)
+        batch = []
+        size = 0
+
+        for row in iterator:
+            batch.append(row)
+            size = size + sum((len(value) if isinstance(value, (str, bytes, bytearray)) else 8) for value in row)
+
+            if len(batch) >= batch_size or size >= self.MAX_INSERT_BYTES:
+                yield batch
+
+                batch = []
+                size = 0
+
+        if len(batch) > 0:
+            yield batch
+
+
+
+class DBConnector(InsertBatching):
     class TransactionContext():
         def __init__(self, db):
             self._active = True
@@ -62,8 +149,36 @@ class DBConnector(object):
 
 
 
+    # The default number of rows to pull from the server per round trip when iterating a server-side
+    # cursor
+    DEFAULT_ITERSIZE = 5000
+
+    # The default number of server-side prepared statements kept open per connection for statements
+    # executed repeatedly, such as the statements of bulk inserts. A size of zero disables the cache.
+    DEFAULT_STATEMENT_CACHE_SIZE = 32
+
+    # Patterns identifying potentially expensive operations in the lines of a query plan, mapped to a
+    # description of the operation. Group 1 of the pattern, if present, is the table involved.
+    PLAN_WARNINGS = []
+
     def __init__(self, db):
         self.db = db
+        self.itersize = DBConnector.DEFAULT_ITERSIZE
+
+        # An optional callable invoked with the statement and elapsed time of each query executed through
+        # execQuery or execUpdate
+        self.query_listener = None
+
+        self._catalog_cache = {}
+
+        # Prepared statements by the text of the statement, in least-recently-used order
+        self.statement_cache_size = DBConnector.DEFAULT_STATEMENT_CACHE_SIZE
+        self.statement_cache_hits = 0
+        self.statement_cache_misses = 0
+        self._statements = OrderedDict()
+
+        # The pool this connector was checked out of, if any
+        self.pool = None
 
         # Default auto-commit to True to make some of the transaction stuff easier to setup later
         # This will be automatically shut off once a transaction is started.
@@ -72,28 +187,334 @@ class DBConnector(object):
     def __del__(self):
         self.close()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+    def release(self):
+        """
+        Returns this connector to the pool it was checked out of, or closes it if it doesn't belong to a
+        pool
+        """
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            self.close()
+
+    def ping(self):
+        """
+        Checks whether or not the connection is still usable by running a trivial query on it. This
+        must not be called while a transaction is active.
+        """
+        if self.is_closed():
+            return False
+
+        try:
+            cursor = self.db.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            cursor.close()
+
+            return True
+        except Exception as e:
+            log.debug("Connection failed validation: %s", e)
+            return False
+
     def backend(self):
         raise NotImplementedError("Not yet implemented")
 
     def get_type_as_string(self, type_code):
         raise NotImplementedError("Not yet implemented")
 
-    def build_insert_statement(self, table, columns, ignore_duplicates=False):
+    def get_types_as_strings(self, type_codes):
+        """
+        Returns the names of the given types, as get_type_as_string does, looking them up together where
+        the backend needs to query the server for them
+        """
+        return [self.get_type_as_string(type_code) for type_code in type_codes]
+
+    def build_insert_statement(self, table, columns, ignore_duplicates=False, rows=1):
+        """
+        Builds a statement inserting the given number of rows into the table. The statement takes the
+        values of every row, in order, as a flat list of parameters.
+        """
+        raise NotImplementedError("Not yet implemented")
+
+    def build_upsert_statement(self, table, columns, key_columns, rows=1):
+        """
+        Builds a statement inserting the given number of rows into the table, updating the existing row
+        instead wherever a row with the same key columns already exists. The statement takes the values
+        of every row, in order, as a flat list of parameters.
+        """
         raise NotImplementedError("Not yet implemented")
 
+    def insert_rows(self, table, columns, rows, ignore_duplicates=False, batch_size=None):
+        """
+        Inserts the given rows into the table, sending many rows per statement to avoid a round trip to
+        the server for every row. Returns the number of rows sent.
+        """
+        return self._execute_insert_batches(rows, len(columns), batch_size,
+            lambda count: self.build_insert_statement(table, columns, ignore_duplicates, count))
+
+    def upsert_rows(self, table, columns, key_columns, rows, batch_size=None):
+        """
+        Inserts the given rows into the table, or updates the existing rows with the same key columns,
+        sending many rows per statement. Returns the number of rows sent.
+        """
+        return self._execute_insert_batches(rows, len(columns), batch_size,
+            lambda count: self.build_upsert_statement(table, columns, key_columns, count))
+
+    def _execute_insert_batches(self, rows, column_count, batch_size, build_statement):
+        # Executes the statements built for each batch of rows, building one statement per batch size.
+        # Queries are reported in their single-row form, so every batch is recorded as the same query.
+        batch_size = self.get_insert_batch_size(column_count, batch_size)
+        statements = {}
+        reported = build_statement(1)
+
+        cursor = self.cursor()
+        count = 0
+
+        try:
+            for block in self._iterate_insert_batches(rows, batch_size):
+                if len(block) not in statements:
+                    statements[len(block)] = build_statement(len(block))
+
+                start = time.time()
+                self._execute_cached(cursor, statements[len(block)], [value for row in block for value in row])
+                self._notify_query(reported, time.time() - start)
+
+                count = count + len(block)
+        finally:
+            cursor.close()
+
+        return count
+
+    def copy_rows(self, table, columns, rows, ignore_duplicates=False, batch_size=None):
+        """
+        Loads the given rows into the table using the fastest bulk loading interface offered by the
+        backend, streaming the rows as they're loaded. Backends lacking such an interface fall back to
+        batched inserts. Returns the number of rows sent.
+        """
+        return self.insert_rows(table, columns, rows, ignore_duplicates, batch_size)
+
+    def build_insert_select_statement(self, table, columns, source, ignore_duplicates=False):
+        """
+        Builds a statement copying the given columns of every row of the source table into the table
+        """
+        raise NotImplementedError("Not yet implemented")
+
+    def insert_from(self, table, columns, source, ignore_duplicates=False):
+        """
+        Copies the given columns of every row of the source table into the table, returning the number
+        of rows inserted
+        """
+        return self.execUpdate(self.build_insert_select_statement(table, columns, source, ignore_duplicates))
+
+    def create_staging_table(self, name, table, columns):
+        """
+        Creates a table with the given columns of an existing table, but none of its constraints or
+        indexes. Rows may be loaded into it in any order, and later copied into the original table.
+        """
+        self.execUpdate('CREATE TABLE ' + name + ' AS SELECT ' + ', '.join(columns) + ' FROM ' + table + ' WHERE 1=0')
+
     def close(self):
         if not self.is_closed():
+            if self.statement_cache_hits + self.statement_cache_misses > 0:
+                log.debug("Statement cache: %d hits, %d misses", self.statement_cache_hits, self.statement_cache_misses)
+
             self.db.close()
 
+        # Prepared statements don't outlive the connection that prepared them
+        self._statements.clear()
+
     def is_closed(self):
         raise NotImplementedError("Not yet implemented")
 
-    def start_transaction(self, readonly=False):
+    def supports_prepared_statements(self):
+        return False
+
+    def _execute_cached(self, cursor, query, parameters):
+        """
+        Executes the given statement on the cursor, through a prepared statement cached by the text of
+        the statement if the backend supports it. Returns the number of rows affected.
+        """
+        if self.statement_cache_size < 1 or not self.supports_prepared_statements():
+            cursor.execute(query, parameters)
+            return cursor.rowcount
+
+        statement = self._statements.get(query)
+
+        if statement is not None:
+            self._statements.move_to_end(query)
+            self.statement_cache_hits = self.statement_cache_hits + 1
+        else:
+            self.statement_cache_misses = self.statement_cache_misses + 1
+
+            statement = self._prepare_statement(query)
+            self._statements[query] = statement
+
+            while len(self._statements) > self.statement_cache_size:
+                self._deallocate_statement(self._statements.popitem(last=False)[1])
+
+        return self._execute_statement(cursor, statement, query, parameters)
+
+    def _prepare_statement(self, query):
+        raise NotImplementedError("Not yet implemented")
+
+    def _execute_statement(self, cursor, statement, query, parameters):
+        raise NotImplementedError("Not yet implemented")
+
+    def _deallocate_statement(self, statement):
+        raise NotImplementedError("Not yet implemented")
+
+    def start_transaction(self, readonly=False, consistent=False, snapshot=None):
+        """
+        Starts a new transaction on this connection. If consistent is set, every statement in the
+        transaction will see the same snapshot of the database. If a snapshot token previously returned
+        by export_snapshot is provided, the transaction will adopt that snapshot instead of taking its own.
+        """
         raise NotImplementedError("Not yet implemented")
 
     def in_transaction(self):
         raise NotImplementedError("Not yet implemented")
 
+    def supports_recursive_queries(self):
+        """
+        Checks whether or not the backend supports recursive common table expressions (WITH RECURSIVE)
+        """
+        return False
+
+    def current_schema(self):
+        """
+        Returns the SQL expression evaluating to the name of the schema tables are looked up in
+        """
+        raise NotImplementedError("Not yet implemented")
+
+    def get_table_columns(self, table):
+        """
+        Fetches the names of the columns of the given table, in column order. The result is cached for
+        the life of this connector.
+        """
+        return self._catalog_lookup('columns', table, 'SELECT column_name FROM information_schema.columns ' +
+            'WHERE table_schema = ' + self.current_schema() + ' AND table_name = %s ORDER BY ordinal_position')
+
+    def get_primary_key(self, table):
+        """
+        Fetches the names of the columns making up the primary key of the given table, in key order. If
+        the table has no primary key, this returns an empty list. The result is cached for the life of
+        this connector.
+        """
+        return self._catalog_lookup('primary_key', table, 'SELECT kcu.column_name FROM information_schema.table_constraints tc ' +
+            'JOIN information_schema.key_column_usage kcu ON kcu.constraint_name = tc.constraint_name ' +
+            'AND kcu.table_schema = tc.table_schema AND kcu.table_name = tc.table_name ' +
+            'WHERE tc.constraint_type = \'PRIMARY KEY\' AND tc.table_schema = ' + self.current_schema() + ' AND tc.table_name = %s ' +
+            'ORDER BY kcu.ordinal_position')
+
+    def get_referenced_tables(self, table):
+        """
+        Fetches the names of the tables referenced by the foreign keys of the given table, including the
+        table itself if it references its own rows. Returns None if the backend can't report foreign
+        keys. The result is cached for the life of this connector.
+        """
+        return None
+
+    def get_foreign_keys(self, table):
+        """
+        Fetches the single-column foreign keys of the given table, as a list of tuples of the column,
+        the referenced table and the referenced column. Returns None if the backend can't report
+        foreign keys. The result is cached for the life of this connector.
+        """
+        return None
+
+    def advance_sequence(self, table, column):
+        """
+        Advances the sequence generating the values of the given column, if it has one, past the highest
+        value in the column, such that rows inserted with explicit values don't collide with the values
+        it generates later
+        """
+        raise NotImplementedError("Not yet implemented")
+
+    def get_secondary_indexes(self, table):
+        """
+        Fetches the indexes of the given table which don't enforce a constraint, as a list of tuples
+        of the index name and the statement which recreates it. Unlike other catalog lookups, the
+        result is not cached, as the indexes may be dropped and recreated.
+        """
+        raise NotImplementedError("Not yet implemented")
+
+    def drop_index(self, table, index):
+        raise NotImplementedError("Not yet implemented")
+
+    def analyze_table(self, table):
+        """
+        Updates the statistics the query planner keeps for the given table
+        """
+        raise NotImplementedError("Not yet implemented")
+
+    def _catalog_lookup(self, kind, table, query):
+        return [value for (value,) in self._catalog_lookup_rows(kind, table, query)]
+
+    def _catalog_lookup_rows(self, kind, table, query):
+        key = (kind, table)
+
+        if key not in self._catalog_cache:
+            cursor = self.execQuery(query, (table,))
+
+            # Some backends return catalog strings as raw bytes
+            self._catalog_cache[key] = [tuple((value.decode('utf-8') if isinstance(value, (bytes, bytearray)) else value) for value in row)
+                for row in cursor]
+            cursor.close()
+
+        return self._catalog_cache[key]
+
+    def explain(self, query, parameters=(), analyze=False):
+        """
+        Fetches the execution plan for the given query as a list of lines of text. If analyze is set,
+        the query is executed and the plan includes actual row counts and timings.
+        """
+        cursor = self.execQuery(self._get_explain_prefix(analyze) + query, parameters)
+        columns = [col[0] for col in cursor.description]
+        plan = [self._format_plan_row(columns, row) for row in cursor]
+        cursor.close()
+
+        return plan
+
+    def _get_explain_prefix(self, analyze):
+        if analyze:
+            raise NotImplementedError("Not yet implemented")
+
+        return 'EXPLAIN '
+
+    def _format_plan_row(self, columns, row):
+        return ' '.join((str(value) for value in row))
+
+    def get_plan_warnings(self, plan):
+        """
+        Scans a query plan returned by explain for operations which are likely to be expensive on large
+        data sets, such as full table scans and sorts. Returns a list of warning messages.
+        """
+        warnings = []
+
+        for line in plan:
+            for (pattern, description) in self.PLAN_WARNINGS:
+                match = re.search(pattern, line)
+
+                if match is not None:
+                    warnings.append((description + ' on ' + match.group(1)) if match.groups() else description)
+
+        return warnings
+
+    def export_snapshot(self):
+        """
+        Exports the snapshot of the current transaction so it can be shared with transactions on other
+        connections. Returns a snapshot token, or None if the backend does not support exporting
+        snapshots.
+        """
+        return None
+
     def commit(self):
         log.debug("Committing transaction")
         self.db.commit()
@@ -104,15 +525,23 @@ class DBConnector(object):
         self.db.rollback()
         self.db.autocommit=True
 
-    def cursor(self):
+    def cursor(self, server_side=False):
+        """
+        Opens a new cursor on this connection. If server_side is set, the cursor will leave the result
+        set on the server and stream it to the client in blocks of itersize rows as it is consumed,
+        rather than buffering the entire result set on the client when the query is executed.
+        """
         return self.db.cursor()
 
-    def execQuery(self, query, parameters=()):
+    def execQuery(self, query, parameters=(), server_side=False):
         cursor = None
 
         try:
-            cursor = self.cursor()
+            cursor = self.cursor(server_side)
+
+            start = time.time()
             cursor.execute(query, parameters)
+            self._notify_query(query, time.time() - start)
 
             return cursor
         except Exception as error:
@@ -121,14 +550,30 @@ class DBConnector(object):
 
             raise error
 
-    def execUpdate(self, query, parameters=()):
+    def _notify_query(self, query, elapsed):
+        if self.query_listener is not None:
+            self.query_listener(query, elapsed)
+
+    def execUpdate(self, query, parameters=(), prepare=False):
+        """
+        Runs the given statement, returning the number of rows affected. If prepare is set, the
+        statement is run as a server-side prepared statement which is kept for later executions of the
+        same statement, sparing the server from parsing and planning it each time.
+        """
         cursor = None
 
         try:
             cursor = self.cursor()
 
-            cursor.execute(query, parameters)
-            count = cursor.rowcount
+            start = time.time()
+
+            if prepare:
+                count = self._execute_cached(cursor, query, parameters)
+            else:
+                cursor.execute(query, parameters)
+                count = cursor.rowcount
+
+            self._notify_query(query, time.time() - start)
 
             cursor.close()
 
@@ -143,7 +588,69 @@ class DBConnector(object):
 
 
 
-class PSQLConnector(DBConnector):
+class PSQLStatementBuilder(object):
+    """
+    Builds the statements run by the PostgreSQL connectors, shared by the synchronous and asyncio
+    connectors
+    """
+
+    # Matches the parameter placeholders of the DB-API format style, and escaped percent signs
+    PARAMETER_PATTERN = re.compile(r'%[s%]')
+
+    def build_insert_statement(self, table, columns, ignore_duplicates=False, rows=1):
+        pblock = '(' + ', '.join(['%s'] * len(columns)) + ')'
+        statement = 'INSERT INTO ' + table + ' (' + ', '.join(columns) + ') VALUES ' + ', '.join([pblock] * rows)
+
+        if ignore_duplicates:
+            statement = statement + ' ON CONFLICT DO NOTHING'
+
+        return statement
+
+    def build_upsert_statement(self, table, columns, key_columns, rows=1):
+        pblock = '(' + ', '.join(['%s'] * len(columns)) + ')'
+
+        return 'INSERT INTO ' + table + ' (' + ', '.join(columns) + ') VALUES ' + ', '.join([pblock] * rows) + \
+            self._build_conflict_clause(columns, key_columns)
+
+    def _build_conflict_clause(self, columns, key_columns):
+        updates = [(col + ' = EXCLUDED.' + col) for col in columns if col not in key_columns]
+
+        if len(updates) < 1:
+            return ' ON CONFLICT (' + ', '.join(key_columns) + ') DO NOTHING'
+
+        return ' ON CONFLICT (' + ', '.join(key_columns) + ') DO UPDATE SET ' + ', '.join(updates)
+
+    @staticmethod
+    def _convert_parameters(query):
+        # PostgreSQL takes numbered parameters ($1, $2, ...) rather than the DB-API format style
+        counter = itertools.count(1)
+        return PSQLStatementBuilder.PARAMETER_PATTERN.sub(lambda match: '%' if match.group(0) == '%%' else '$%d' % (next(counter),), query)
+
+
+
+class PSQLConnector(PSQLStatementBuilder, DBConnector):
+    # The size of the blocks of encoded rows sent to the server during COPY
+    COPY_BUFFER_SIZE = 64 * 1024
+
+    # OIDs below this are assigned to the built-in objects created by initdb, which are the same on
+    # every server of a given version
+    FIRST_NORMAL_OID = 16384
+
+    # The directory in which the names of built-in types are saved, by server version, so they needn't
+    # be looked up again by later runs. Set with set_type_cache_dir; None disables the disk cache.
+    type_cache_dir = None
+
+    # The names of the types seen so far, by OID, shared by every connector to the same database
+    _type_caches = {}
+    _type_cache_lock = threading.Lock()
+
+    PLAN_WARNINGS = [
+        (r'Seq Scan on (\w+)', 'sequential scan'),
+        (r'(?:->|^)\s*(?:Incremental )?Sort\s+\(', 'sort'),
+        (r'Sort Method: external', 'sort spilled to disk'),
+        (r'Batches: (?:[2-9]|\d{2,})', 'hash spilled to disk')
+    ]
+
     def __init__(self, host, port, username, password, dbname):
         import psycopg2 as psql
         self.psql = psql
@@ -161,53 +668,342 @@ class PSQLConnector(DBConnector):
 
         super(PSQLConnector, self).__init__(psql.connect(**params))
 
-        # Get the types from the DB so we can map them for storing types
+        # Used to generate unique names for server-side cursors and prepared statements
+        self._cursor_count = 0
+        self._statement_count = 0
+
+        # Attach the shared map of type names; types are looked up as they're seen in query results
         self._init_types()
 
     def backend(self):
         return 'PostgreSQL'
 
+    def cursor(self, server_side=False):
+        if not server_side:
+            return self.db.cursor()
+
+        # Named cursors only live as long as the transaction that declared them
+        if not self.in_transaction():
+            log.debug("Server-side cursors require an active transaction; using a client-side cursor")
+            return self.db.cursor()
+
+        self._cursor_count = self._cursor_count + 1
+
+        cursor = self.db.cursor(name=('cp_cursor_%d' % (self._cursor_count,)))
+        cursor.itersize = self.itersize
+
+        return cursor
+
     def _init_types(self):
-        cursor = self.execQuery('SELECT oid, typname FROM pg_type')
+        # Impl note:
+        # Reading all of pg_type up front costs every connection a round trip and thousands of rows on
+        # databases with many extensions, though an export only ever sees a few dozen types. Instead,
+        # types are resolved as they turn up in query results, and cached for the life of the process.
+        params = self.db.get_dsn_parameters()
+        key = (params.get('host'), params.get('port'), params.get('dbname'), self.db.server_version)
 
-        self._type_map = {}
-        for row in cursor:
-            self._type_map[row[0]] = row[1]
+        with PSQLConnector._type_cache_lock:
+            if key not in PSQLConnector._type_caches:
+                PSQLConnector._type_caches[key] = self._load_type_cache()
 
-        cursor.close()
+            self._type_map = PSQLConnector._type_caches[key]
 
     def get_type_as_string(self, type_code):
-        if type_code in self._type_map:
-            return self._type_map[type_code]
+        return self.get_types_as_strings([type_code])[0]
 
-        return None
+    def get_types_as_strings(self, type_codes):
+        missing = [type_code for type_code in set(type_codes) if type_code not in self._type_map]
+
+        if len(missing) > 0:
+            self._resolve_types(missing)
+
+        return [self._type_map.get(type_code) for type_code in type_codes]
+
+    def _resolve_types(self, oids):
+        cursor = self.execQuery('SELECT oid, typname FROM pg_type WHERE oid IN (' + ', '.join(['%s'] * len(oids)) + ')', oids)
+        resolved = dict(cursor.fetchall())
+        cursor.close()
+
+        with PSQLConnector._type_cache_lock:
+            # Types which don't exist are recorded as well, so they aren't looked up again
+            for oid in oids:
+                self._type_map[oid] = resolved.get(oid)
+
+            if any(oid < PSQLConnector.FIRST_NORMAL_OID for oid in resolved):
+                self._save_type_cache()
+
+    def _get_type_cache_file(self):
+        if PSQLConnector.type_cache_dir is None:
+            return None
+
+        return os.path.join(PSQLConnector.type_cache_dir, 'pg_types-%d.json' % (self.db.server_version,))
+
+    def _load_type_cache(self):
+        # Only the built-in types are saved, as the OIDs of any other type differ between databases
+        file = self._get_type_cache_file()
+        types = {}
+
+        if file is not None and os.path.isfile(file):
+            try:
+                with open(file, 'r') as fp:
+                    types = dict((int(oid), name) for (oid, name) in json.load(fp).items())
+
+                log.debug("Loaded %d type names from cache: %s", len(types), file)
+            except (IOError, OSError, ValueError) as e:
+                log.debug("Unable to read type cache %s: %s", file, e)
+
+        return types
+
+    def _save_type_cache(self):
+        file = self._get_type_cache_file()
+
+        if file is None:
+            return
+
+        types = dict((str(oid), name) for (oid, name) in self._type_map.items() if oid < PSQLConnector.FIRST_NORMAL_OID and name is not None)
+
+        # Write to a temporary file first, so concurrent runs never see a partially written cache
+        try:
+            if not os.path.isdir(PSQLConnector.type_cache_dir):
+                os.makedirs(PSQLConnector.type_cache_dir)
 
-    def build_insert_statement(self, table, columns, ignore_duplicates=False):
-        pblock = ', '.join(['%s'] * len(columns))
-        statement = 'INSERT INTO ' + table + ' (' + ', '.join(columns) + ') VALUES (' + pblock + ')'
+            (fd, temp) = tempfile.mkstemp(prefix='.pg_types-', dir=PSQLConnector.type_cache_dir)
+
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(types, fp)
+
+            os.replace(temp, file)
+        except (IOError, OSError) as e:
+            log.debug("Unable to write type cache %s: %s", file, e)
+
+    def insert_rows(self, table, columns, rows, ignore_duplicates=False, batch_size=None):
+        statement = 'INSERT INTO ' + table + ' (' + ', '.join(columns) + ') VALUES %s'
+
+        if ignore_duplicates:
+            statement = statement + ' ON CONFLICT DO NOTHING'
+
+        return self._execute_values(statement, rows, len(columns), batch_size)
+
+    def upsert_rows(self, table, columns, key_columns, rows, batch_size=None):
+        statement = 'INSERT INTO ' + table + ' (' + ', '.join(columns) + ') VALUES %s' + self._build_conflict_clause(columns, key_columns)
+        return self._execute_values(statement, rows, len(columns), batch_size)
+
+    def _execute_values(self, statement, rows, column_count, batch_size):
+        from psycopg2.extras import execute_values
+
+        # execute_values expands the lone VALUES placeholder into the values of every row of the page,
+        # so we don't need to build a statement for each batch size
+        batch_size = self.get_insert_batch_size(column_count, batch_size)
+
+        cursor = self.cursor()
+        count = 0
+
+        try:
+            for block in self._iterate_insert_batches(rows, batch_size):
+                start = time.time()
+                execute_values(cursor, statement, block, page_size=len(block))
+                self._notify_query(statement, time.time() - start)
+
+                count = count + len(block)
+        finally:
+            cursor.close()
+
+        return count
+
+    def copy_rows(self, table, columns, rows, ignore_duplicates=False, batch_size=None):
+        # Impl note:
+        # COPY can't skip conflicting rows, so when duplicates are to be ignored we copy into a staging
+        # table shaped like the target and merge it in with a single INSERT ... ON CONFLICT DO NOTHING
+        target = table
+
+        if ignore_duplicates:
+            target = 'org_migrator_copy_' + table
+            self.execUpdate('CREATE TEMPORARY TABLE ' + target + ' (LIKE ' + table + ' INCLUDING DEFAULTS)')
+
+        statement = 'COPY ' + target + ' (' + ', '.join(columns) + ') FROM STDIN WITH (FORMAT csv)'
+        stream = RowStreamReader(rows, self._encode_csv_row)
+
+        try:
+            cursor = self.cursor()
+
+            try:
+                start = time.time()
+                cursor.copy_expert(statement, stream, size=PSQLConnector.COPY_BUFFER_SIZE)
+                self._notify_query(statement, time.time() - start)
+            finally:
+                cursor.close()
+
+            if ignore_duplicates:
+                self.insert_from(table, columns, target, True)
+        finally:
+            # Outside of a transaction the staging table outlives a failed copy, and must be dropped. A
+            # failed transaction can't run the drop, but takes the table with it when rolled back.
+            if ignore_duplicates and self.db.get_transaction_status() != self.psql.extensions.TRANSACTION_STATUS_INERROR:
+                self.execUpdate('DROP TABLE IF EXISTS ' + target)
+
+        return stream.count
+
+    def build_insert_select_statement(self, table, columns, source, ignore_duplicates=False):
+        column_list = ', '.join(columns)
+        statement = 'INSERT INTO ' + table + ' (' + column_list + ') SELECT ' + column_list + ' FROM ' + source
 
         if ignore_duplicates:
             statement = statement + ' ON CONFLICT DO NOTHING'
 
         return statement
 
+    def create_staging_table(self, name, table, columns):
+        # Staging tables are dropped once the import completes, so there's no need to write them to the WAL
+        self.execUpdate('CREATE UNLOGGED TABLE ' + name + ' AS SELECT ' + ', '.join(columns) + ' FROM ' + table + ' WHERE 1=0')
+
+    def get_referenced_tables(self, table):
+        return self._catalog_lookup('referenced_tables', table, 'SELECT DISTINCT rc.relname FROM pg_constraint c ' +
+            'JOIN pg_class rc ON rc.oid = c.confrelid WHERE c.contype = \'f\' AND c.conrelid = %s::regclass')
+
+    def get_foreign_keys(self, table):
+        return self._catalog_lookup_rows('foreign_keys', table, 'SELECT a.attname, rc.relname, ra.attname FROM pg_constraint c ' +
+            'JOIN pg_class rc ON rc.oid = c.confrelid ' +
+            'JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1] ' +
+            'JOIN pg_attribute ra ON ra.attrelid = c.confrelid AND ra.attnum = c.confkey[1] ' +
+            'WHERE c.contype = \'f\' AND c.conrelid = %s::regclass AND array_length(c.conkey, 1) = 1')
+
+    def advance_sequence(self, table, column):
+        cursor = self.execQuery('SELECT pg_get_serial_sequence(%s, %s)', (table, column))
+        (sequence,) = cursor.fetchone()
+        cursor.close()
+
+        if sequence is not None:
+            cursor = self.execQuery('SELECT setval(%s, MAX(' + column + ')) FROM ' + table + ' HAVING MAX(' + column + ') IS NOT NULL', (sequence,))
+            cursor.fetchall()
+            cursor.close()
+
+    def get_secondary_indexes(self, table):
+        # Impl note:
+        # pg_indexes is a view over pg_index using pg_get_indexdef for the definitions; we go to
+        # pg_index directly, as the view can't tell us which indexes are unique or back a constraint
+        cursor = self.execQuery('SELECT ic.relname, pg_get_indexdef(ix.indexrelid) FROM pg_index ix ' +
+            'JOIN pg_class ic ON ic.oid = ix.indexrelid ' +
+            'WHERE ix.indrelid = %s::regclass AND NOT ix.indisunique AND NOT ix.indisprimary ' +
+            'AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = ix.indexrelid) ' +
+            'ORDER BY ic.relname', (table,))
+
+        indexes = [(name, definition) for (name, definition) in cursor]
+        cursor.close()
+
+        return indexes
+
+    def drop_index(self, table, index):
+        self.execUpdate('DROP INDEX "' + index.replace('"', '""') + '"')
+
+    def analyze_table(self, table):
+        self.execUpdate('ANALYZE ' + table)
+
+    def _encode_csv_row(self, row):
+        return (','.join((PSQLConnector._encode_csv_value(value) for value in row)) + '\n').encode('utf-8')
+
+    @staticmethod
+    def _encode_csv_value(value):
+        # Unquoted empty values are read as NULL, so every string is quoted to keep empty strings intact
+        if value is None:
+            return ''
+
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+
+        if isinstance(value, (int, float, decimal.Decimal)):
+            return str(value)
+
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return '\\x' + binascii.hexlify(value).decode('ascii')
+
+        return '"' + str(value).replace('"', '""') + '"'
+
     def is_closed(self):
         if self.db is not None and self.db.closed == 0:
             return False
 
         return True
 
-    def start_transaction(self, readonly=False):
-        self.db.set_session(readonly=readonly, autocommit=False)
+    def supports_prepared_statements(self):
+        return True
+
+    def _prepare_statement(self, query):
+        # Impl note:
+        # Statements are prepared with PREPARE rather than through the protocol, as psycopg2 has no
+        # interface for the latter. Parameters are still interpolated by psycopg2, but only into the
+        # argument list of EXECUTE, which the server doesn't need to plan. Prepared statements aren't
+        # transactional, so they survive the rollback of the transaction that prepared them.
+        self._statement_count = self._statement_count + 1
+        name = 'cp_statement_%d' % (self._statement_count,)
+
+        cursor = self.db.cursor()
+
+        try:
+            cursor.execute('PREPARE ' + name + ' AS ' + PSQLStatementBuilder._convert_parameters(query))
+        finally:
+            cursor.close()
+
+        return (name, len([match for match in PSQLStatementBuilder.PARAMETER_PATTERN.findall(query) if match == '%s']))
+
+    def _execute_statement(self, cursor, statement, query, parameters):
+        (name, count) = statement
+
+        if count > 0:
+            cursor.execute('EXECUTE ' + name + ' (' + ', '.join(['%s'] * count) + ')', parameters)
+        else:
+            cursor.execute('EXECUTE ' + name)
+
+        return cursor.rowcount
+
+    def _deallocate_statement(self, statement):
+        cursor = self.db.cursor()
+
+        try:
+            cursor.execute('DEALLOCATE ' + statement[0])
+        except self.psql.Error as e:
+            # This can only fail within an aborted transaction; the statement is simply left to be
+            # deallocated along with the connection
+            log.debug("Unable to deallocate prepared statement %s: %s", statement[0], e)
+        finally:
+            cursor.close()
+
+    def start_transaction(self, readonly=False, consistent=False, snapshot=None):
+        isolation_level = 'REPEATABLE READ' if (consistent or snapshot is not None) else 'DEFAULT'
+        self.db.set_session(isolation_level=isolation_level, readonly=readonly, autocommit=False)
 
         # Transactions are automatically started on the first command if autocommit is set to false, so
-        # let's do a quick no-op query to get things started
+        # let's do a quick no-op query to get things started. When adopting an exported snapshot, the
+        # snapshot must be set before any other query is run in the transaction.
         cursor = self.cursor()
-        cursor.execute('SELECT 1')
+
+        if snapshot is not None:
+            cursor.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+        else:
+            cursor.execute('SELECT 1')
+
         cursor.close()
 
         return DBConnector.TransactionContext(self)
 
+    def supports_recursive_queries(self):
+        return True
+
+    def _get_explain_prefix(self, analyze):
+        return 'EXPLAIN (ANALYZE, BUFFERS) ' if analyze else 'EXPLAIN '
+
+    def current_schema(self):
+        return 'current_schema()'
+
+    def export_snapshot(self):
+        if not self.in_transaction():
+            raise RuntimeError("Snapshots can only be exported from an active transaction")
+
+        cursor = self.execQuery('SELECT pg_export_snapshot()')
+        snapshot = cursor.fetchone()[0]
+        cursor.close()
+
+        return snapshot
+
 
     def in_transaction(self):
         tx_states = [self.psql.extensions.STATUS_BEGIN, self.psql.extensions.STATUS_IN_TRANSACTION, self.psql.extensions.STATUS_PREPARED]
@@ -215,7 +1011,62 @@ class PSQLConnector(DBConnector):
 
 
 
-class MySQLConnector(DBConnector):
+class MySQLStatementBuilder(object):
+    """
+    Builds the statements run by the MySQL/MariaDB connectors, shared by the synchronous and asyncio
+    connectors
+    """
+
+    def build_insert_statement(self, table, columns, ignore_duplicates=False, rows=1):
+        # Impl note:
+        # The connector's executemany only batches plain INSERT statements, not INSERT IGNORE, so bulk
+        # inserts always use the explicit multi-row form built here
+        pblock = '(' + ', '.join(['%s'] * len(columns)) + ')'
+        statement = ' INTO ' + table + ' (' + ', '.join(columns) + ') VALUES ' + ', '.join([pblock] * rows)
+
+        if ignore_duplicates:
+            statement = 'INSERT IGNORE' + statement
+        else:
+            statement = 'INSERT' + statement
+
+        return statement
+
+    def build_upsert_statement(self, table, columns, key_columns, rows=1):
+        # Impl note:
+        # ON DUPLICATE KEY UPDATE can't be limited to a particular key; it applies to a conflict on any
+        # unique key of the table, so the key columns only determine which columns are left as-is
+        updates = [(col + ' = VALUES(' + col + ')') for col in columns if col not in key_columns]
+
+        if len(updates) < 1:
+            updates = [key_columns[0] + ' = ' + key_columns[0]]
+
+        return self.build_insert_statement(table, columns, False, rows) + ' ON DUPLICATE KEY UPDATE ' + ', '.join(updates)
+
+
+
+class MySQLConnector(MySQLStatementBuilder, DBConnector):
+    # The size of the blocks of encoded rows written to the load file
+    LOAD_BUFFER_SIZE = 64 * 1024
+
+    # Escape sequences for the characters with special meaning in the load file; the backslash must come
+    # first so it isn't applied to the escapes themselves
+    LOAD_ESCAPES = [('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'), ('\0', '\\0')]
+
+    BINARY_TYPES = ('binary', 'varbinary', 'tinyblob', 'blob', 'mediumblob', 'longblob')
+
+    # The kinds of columns loaded through user variables and converted by the server
+    LOAD_BINARY = 'binary'
+    LOAD_BIT = 'bit'
+
+    # Tabular plans are formatted as column=value pairs; MySQL's EXPLAIN ANALYZE produces a tree instead
+    PLAN_WARNINGS = [
+        (r'\btable=(\S+) .*\btype=ALL\b', 'full table scan'),
+        (r'Using filesort', 'sort'),
+        (r'Using temporary', 'temporary table'),
+        (r'Table scan on (\w+)', 'full table scan'),
+        (r'-> Sort\b', 'sort')
+    ]
+
     def __init__(self, host, port, username, password, dbname):
         import mysql.connector as mysql
         self.mysql = mysql
@@ -249,25 +1100,240 @@ class MySQLConnector(DBConnector):
         # Add our converter class
         params['converter_class'] = DataConverter
 
+        # Report the number of rows matched by updates rather than the number actually changed, so a
+        # row count of zero reliably means the row doesn't exist
+        params['client_flags'] = [mysql.ClientFlag.FOUND_ROWS]
+
+        # Allow the client to send files for LOAD DATA LOCAL INFILE, which is used for bulk loading
+        params['allow_local_infile'] = True
+
         super(MySQLConnector, self).__init__(mysql.connect(**params))
 
     def backend(self):
         return 'MySQL/MariaDB'
 
+    def cursor(self, server_side=False):
+        # Unbuffered cursors read rows off the wire as they're fetched rather than reading the entire
+        # result set on execute. Note that the result must be fully consumed before the connection
+        # can be used for another query.
+        if not server_side:
+            return self.db.cursor()
+
+        return self.db.cursor(buffered=False)
+
     def get_type_as_string(self, type_code):
         from mysql.connector import FieldType
         return FieldType.get_info(type_code)
 
-    def build_insert_statement(self, table, columns, ignore_duplicates=False):
-        pblock = ', '.join(['%s'] * len(columns))
-        statement = ' INTO ' + table + ' (' + ', '.join(columns) + ') VALUES (' + pblock + ')'
+    def copy_rows(self, table, columns, rows, ignore_duplicates=False, batch_size=None):
+        if not self.supports_local_infile():
+            log.debug('Server does not permit LOAD DATA LOCAL INFILE; falling back to batched inserts')
+            return super(MySQLConnector, self).copy_rows(table, columns, rows, ignore_duplicates, batch_size)
 
-        if ignore_duplicates:
-            statement = 'INSERT IGNORE' + statement
-        else:
-            statement = 'INSERT' + statement
+        # Impl note:
+        # The rows are spooled to a temp file rather than a named pipe; if the server rejects the
+        # statement before opening the file, a writer blocked on the pipe would never be released.
+        # Binary columns are sent hex-encoded and decoded by the server, since the load file is read
+        # in a single character set. BIT columns, which back booleans, read their field as a binary
+        # string, so they're sent as numbers and cast by the server.
+        (statement, kinds) = self._build_load_statement(table, columns, ignore_duplicates)
 
-        return statement
+        spool = tempfile.NamedTemporaryFile(prefix='org_migrator_', suffix='.tsv', delete=False)
+
+        try:
+            stream = RowStreamReader(rows, lambda row: self._encode_load_row(row, kinds))
+
+            with spool:
+                shutil.copyfileobj(stream, spool, MySQLConnector.LOAD_BUFFER_SIZE)
+
+            if stream.count == 0:
+                return 0
+
+            cursor = self.cursor()
+
+            try:
+                start = time.time()
+                cursor.execute(statement, (spool.name,))
+                self._notify_query(statement, time.time() - start)
+
+                loaded = cursor.rowcount
+            finally:
+                cursor.close()
+        finally:
+            os.unlink(spool.name)
+
+        # LOCAL loads always skip rows which conflict with existing keys, since the server has no way
+        # to abort the transfer partway through. Restore the usual error when duplicates aren't ignored.
+        if not ignore_duplicates and loaded != stream.count:
+            raise RuntimeError('Loaded %d of %d rows into table %s; some rows conflict with existing data' %
+                (loaded, stream.count, table))
+
+        return stream.count
+
+    def _build_load_statement(self, table, columns, ignore_duplicates):
+        # Returns the LOAD DATA statement for the given columns, along with the kind of value each
+        # column is encoded as in the load file
+        binary_columns = set(self.get_binary_columns(table))
+        bit_columns = set(self.get_bit_columns(table))
+
+        kinds = []
+        targets = []
+        assignments = []
+
+        for column in columns:
+            if column in binary_columns:
+                kinds.append(MySQLConnector.LOAD_BINARY)
+                assignments.append(column + ' = UNHEX(@' + column + ')')
+            elif column in bit_columns:
+                kinds.append(MySQLConnector.LOAD_BIT)
+                assignments.append(column + ' = CAST(@' + column + ' AS UNSIGNED)')
+            else:
+                kinds.append(None)
+
+            targets.append(('@' + column) if kinds[-1] is not None else column)
+
+        statement = 'LOAD DATA LOCAL INFILE %s ' + \
+            ('IGNORE ' if ignore_duplicates else '') + 'INTO TABLE ' + table + ' CHARACTER SET utf8mb4 ' + \
+            'FIELDS TERMINATED BY \'\\t\' ESCAPED BY \'\\\\\' LINES TERMINATED BY \'\\n\' ' + \
+            '(' + ', '.join(targets) + ')'
+
+        if assignments:
+            statement = statement + ' SET ' + ', '.join(assignments)
+
+        return (statement, kinds)
+
+    def build_insert_select_statement(self, table, columns, source, ignore_duplicates=False):
+        column_list = ', '.join(columns)
+        statement = ' INTO ' + table + ' (' + column_list + ') SELECT ' + column_list + ' FROM ' + source
+
+        return ('INSERT IGNORE' if ignore_duplicates else 'INSERT') + statement
+
+    def get_referenced_tables(self, table):
+        return self._catalog_lookup('referenced_tables', table, 'SELECT DISTINCT referenced_table_name FROM information_schema.key_column_usage ' +
+            'WHERE table_schema = ' + self.current_schema() + ' AND table_name = %s AND referenced_table_name IS NOT NULL')
+
+    def get_foreign_keys(self, table):
+        # Constraints spanning several columns are left out by looking for a second column of the same
+        # constraint
+        return self._catalog_lookup_rows('foreign_keys', table, 'SELECT k.column_name, k.referenced_table_name, k.referenced_column_name ' +
+            'FROM information_schema.key_column_usage k WHERE k.table_schema = ' + self.current_schema() + ' AND k.table_name = %s ' +
+            'AND k.referenced_table_name IS NOT NULL AND NOT EXISTS (SELECT 1 FROM information_schema.key_column_usage o ' +
+            'WHERE o.table_schema = k.table_schema AND o.table_name = k.table_name AND o.constraint_name = k.constraint_name ' +
+            'AND o.ordinal_position > 1)')
+
+    def advance_sequence(self, table, column):
+        # AUTO_INCREMENT counters advance past explicitly inserted values on their own
+        pass
+
+    def get_secondary_indexes(self, table):
+        # Indexes over expressions have no column name, and can't be recreated from the column list, so
+        # they're left out
+        cursor = self.execQuery('SELECT index_name, index_type, column_name, sub_part FROM information_schema.statistics ' +
+            'WHERE table_schema = ' + self.current_schema() + ' AND table_name = %s AND non_unique = 1 ' +
+            'ORDER BY index_name, seq_in_index', (table,))
+
+        columns = {}
+        types = {}
+
+        for (name, index_type, column, sub_part) in cursor:
+            name = MySQLConnector._decode_catalog_string(name)
+            column = MySQLConnector._decode_catalog_string(column)
+
+            if column is None:
+                columns[name] = None
+            elif name not in columns or columns[name] is not None:
+                columns.setdefault(name, []).append(column if sub_part is None else '%s(%d)' % (column, sub_part))
+
+            types[name] = MySQLConnector._decode_catalog_string(index_type)
+
+        cursor.close()
+
+        indexes = []
+        for (name, index_columns) in columns.items():
+            if index_columns is None:
+                continue
+
+            prefix = types[name] + ' ' if types[name] in ('FULLTEXT', 'SPATIAL') else ''
+            indexes.append((name, 'CREATE ' + prefix + 'INDEX `' + name.replace('`', '``') + '` ON ' + table + ' (' + ', '.join(index_columns) + ')'))
+
+        return indexes
+
+    def drop_index(self, table, index):
+        self.execUpdate('DROP INDEX `' + index.replace('`', '``') + '` ON ' + table)
+
+    def analyze_table(self, table):
+        # ANALYZE TABLE returns a status row, which must be read before the connection can be reused
+        cursor = self.execQuery('ANALYZE TABLE ' + table)
+        cursor.fetchall()
+        cursor.close()
+
+    @staticmethod
+    def _decode_catalog_string(value):
+        return value.decode('utf-8') if isinstance(value, (bytes, bytearray)) else value
+
+    def supports_local_infile(self):
+        """
+        Checks whether or not the server permits LOAD DATA LOCAL INFILE. The result is cached for the
+        life of this connector.
+        """
+        if 'local_infile' not in self._catalog_cache:
+            cursor = self.execQuery('SELECT @@local_infile')
+            (enabled,) = cursor.fetchone()
+            cursor.close()
+
+            self._catalog_cache['local_infile'] = bool(int(enabled))
+
+        return self._catalog_cache['local_infile']
+
+    def get_binary_columns(self, table):
+        """
+        Fetches the names of the columns of the given table which hold binary strings. The result is
+        cached for the life of this connector.
+        """
+        return self._catalog_lookup('binary_columns', table, 'SELECT column_name FROM information_schema.columns ' +
+            'WHERE table_schema = ' + self.current_schema() + ' AND table_name = %s ' +
+            'AND data_type IN (' + ', '.join(('\'%s\'' % type for type in MySQLConnector.BINARY_TYPES)) + ')')
+
+    def get_bit_columns(self, table):
+        """
+        Fetches the names of the BIT columns of the given table, which back boolean fields. The result
+        is cached for the life of this connector.
+        """
+        return self._catalog_lookup('bit_columns', table, 'SELECT column_name FROM information_schema.columns ' +
+            'WHERE table_schema = ' + self.current_schema() + ' AND table_name = %s AND data_type = \'bit\'')
+
+    def _encode_load_row(self, row, kinds):
+        return ('\t'.join((MySQLConnector._encode_load_value(value, kind) for (value, kind) in zip(row, kinds))) + '\n').encode('utf-8')
+
+    @staticmethod
+    def _encode_load_value(value, kind=None):
+        if value is None:
+            return '\\N'
+
+        if kind == MySQLConnector.LOAD_BINARY:
+            if isinstance(value, str):
+                value = value.encode('utf-8')
+
+            return binascii.hexlify(value).decode('ascii')
+
+        # BIT values exported from MySQL may be read back as raw bytes
+        if kind == MySQLConnector.LOAD_BIT and isinstance(value, (bytes, bytearray)):
+            return str(int.from_bytes(value, 'big'))
+
+        if isinstance(value, bool):
+            return '1' if value else '0'
+
+        if isinstance(value, (int, float, decimal.Decimal)):
+            return str(value)
+
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value = bytes(value).decode('utf-8')
+
+        value = str(value)
+        for (char, escape) in MySQLConnector.LOAD_ESCAPES:
+            value = value.replace(char, escape)
+
+        return value
 
     def is_closed(self):
         if self.db is not None and self.db.is_connected():
@@ -275,25 +1341,282 @@ class MySQLConnector(DBConnector):
 
         return True
 
-    def start_transaction(self, readonly=False):
+    def supports_prepared_statements(self):
+        return True
+
+    def _prepare_statement(self, query):
+        # Prepared cursors prepare their statement on first execution, and only prepare it again if
+        # they're given a different statement; each cached statement gets a cursor of its own
+        return self.db.cursor(prepared=True)
+
+    def _execute_statement(self, cursor, statement, query, parameters):
+        statement.execute(query, parameters)
+        return statement.rowcount
+
+    def _deallocate_statement(self, statement):
+        statement.close()
+
+    def start_transaction(self, readonly=False, consistent=False, snapshot=None):
         # Impl note: Read-only isn't supported. We could hack it by making commit do a rollback instead,
         # but that feels worse than doing nothing. Eventually remove this and start supporting it again.
         log.debug("MySql read-only transactions are not supported; ignoring config");
 
+        if snapshot is not None:
+            raise ValueError("MySQL/MariaDB does not support adopting exported snapshots")
+
         self.db.autocommit=False
-        self.db.start_transaction()
+
+        if consistent:
+            self.db.start_transaction(consistent_snapshot=True, isolation_level='REPEATABLE READ')
+        else:
+            self.db.start_transaction()
+
         return DBConnector.TransactionContext(self)
 
+    def _get_server_version(self):
+        # MariaDB may report its version behind a "5.5.5-" prefix for compatibility with older clients,
+        # so we can't trust the parsed server version here. Returns a tuple of whether or not the server
+        # is MariaDB, and its version, or None if the version can't be parsed.
+        match = re.match(r'^(?:5\.5\.5-)?(\d+)\.(\d+)\.(\d+)', self.db.get_server_info())
+        if match is None:
+            return (False, None)
+
+        return ('mariadb' in self.db.get_server_info().lower(), tuple(int(part) for part in match.groups()))
+
+    def supports_recursive_queries(self):
+        # Recursive CTEs were added in MariaDB 10.2.2 and MySQL 8.0.1
+        (mariadb, version) = self._get_server_version()
+        if version is None:
+            return False
+
+        return version >= ((10, 2, 2) if mariadb else (8, 0, 1))
+
+    def _get_explain_prefix(self, analyze):
+        if not analyze:
+            return 'EXPLAIN '
+
+        # MariaDB's ANALYZE statement returns the same tabular plan as EXPLAIN with actual values added;
+        # MySQL added EXPLAIN ANALYZE in 8.0.18
+        (mariadb, version) = self._get_server_version()
+
+        if mariadb and version >= (10, 1, 0):
+            return 'ANALYZE '
+
+        if not mariadb and version is not None and version >= (8, 0, 18):
+            return 'EXPLAIN ANALYZE '
+
+        raise ValueError("Analyzing query plans requires MariaDB 10.1 or MySQL 8.0.18 or newer")
+
+    def _format_plan_row(self, columns, row):
+        if len(row) == 1:
+            return str(row[0])
+
+        return ' '.join(('%s=%s' % (column, value) for (column, value) in zip(columns, row)))
+
+    def current_schema(self):
+        return 'DATABASE()'
+
+    def lock_all_tables(self):
+        """
+        Acquires a global read lock on the server. Since MySQL/MariaDB can't share snapshots between
+        connections, holding this lock while several connections start consistent-snapshot transactions
+        is the only way to ensure they all see the same data. Requires the RELOAD privilege.
+        """
+        self.execUpdate('FLUSH TABLES WITH READ LOCK')
+
+    def unlock_all_tables(self):
+        self.execUpdate('UNLOCK TABLES')
+
     def in_transaction(self):
         return not self.is_closed() and self.db.in_transaction
 
 
 
+class ConnectionPool(object):
+    """
+    Hands out database connectors created by the given factory, keeping released connectors around for
+    reuse. The pool opens at least min_size and at most max_size connections; when every connection is
+    checked out, acquire blocks until one is released. Idle connections are validated before being handed
+    out again, and closed once they've been idle for longer than idle_timeout seconds, so long as the
+    pool stays at its minimum size. Failed connection attempts are retried with exponential backoff.
+
+    Checked out connectors are returned to the pool by calling their release method, or by using them
+    as context managers:
+
+        with pool.acquire() as db:
+            ...
+    """
+
+    # The longest to wait between attempts to connect, in seconds
+    MAX_BACKOFF = 30
+
+    def __init__(self, connect, min_size=0, max_size=4, idle_timeout=300, validate=True, retries=3, backoff=1.0):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid connection pool size: %d to %d" % (min_size, max_size))
+
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.validate = validate
+        self.retries = retries
+        self.backoff = backoff
+
+        # Idle connectors and the time they were released; the most recently released are reused first
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+        for i in range(min_size):
+            self._idle.append((self._open(), time.time()))
+            self._size = self._size + 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    @property
+    def size(self):
+        """
+        The number of connections currently open, whether idle or checked out
+        """
+        return self._size
+
+    def acquire(self, timeout=None):
+        """
+        Checks out a connector, opening a new connection if there are no idle connections and the pool
+        isn't yet at its maximum size. Raises an exception if no connection becomes available within the
+        given number of seconds.
+        """
+        deadline = (time.time() + timeout) if timeout is not None else None
+
+        while True:
+            with self._condition:
+                connector = self._checkout(deadline)
+
+            if connector is None:
+                try:
+                    connector = self._open()
+                except Exception:
+                    self._discard(None)
+                    raise
+            elif self.validate and not connector.ping():
+                log.info("Discarding pooled connection which failed validation")
+                self._discard(connector)
+                continue
+
+            connector.pool = self
+            return connector
+
+    def release(self, connector):
+        """
+        Returns a checked out connector to the pool. Any transaction left open on it is rolled back.
+        """
+        connector.pool = None
+
+        try:
+            if connector.in_transaction():
+                log.debug("Rolling back transaction left open on released connection")
+                connector.rollback()
+        except Exception as e:
+            log.debug("Unable to roll back released connection: %s", e)
+            connector.close()
+
+        with self._condition:
+            if self._closed or connector.is_closed():
+                self._size = self._size - 1
+                connector.close()
+            else:
+                self._idle.append((connector, time.time()))
+
+            self._condition.notify()
+
+    def close(self):
+        """
+        Closes the idle connections of the pool. Connectors still checked out are closed as they're
+        released.
+        """
+        with self._condition:
+            self._closed = True
+
+            while len(self._idle) > 0:
+                (connector, released) = self._idle.popleft()
+                self._size = self._size - 1
+                connector.close()
+
+            self._condition.notify_all()
+
+    def _checkout(self, deadline):
+        # Returns an idle connector, or None once a slot has been reserved for a new connection. Must be
+        # called with the condition held.
+        while True:
+            if self._closed:
+                raise Exception("Connection pool is closed")
+
+            self._expire_idle()
+
+            if len(self._idle) > 0:
+                return self._idle.pop()[0]
+
+            if self._size < self.max_size:
+                self._size = self._size + 1
+                return None
+
+            remaining = (deadline - time.time()) if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                raise Exception("Timed out waiting for a database connection")
+
+            self._condition.wait(remaining)
+
+    def _expire_idle(self):
+        # The longest idle connections are at the front of the queue
+        now = time.time()
+
+        while len(self._idle) > 0 and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            (connector, released) = self._idle.popleft()
+            self._size = self._size - 1
+            connector.close()
+
+    def _discard(self, connector):
+        if connector is not None:
+            connector.close()
+
+        with self._condition:
+            self._size = self._size - 1
+            self._condition.notify()
+
+    def _open(self):
+        attempt = 0
+
+        while True:
+            try:
+                return self.connect()
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+
+                delay = min(self.backoff * (2 ** attempt), ConnectionPool.MAX_BACKOFF)
+                attempt = attempt + 1
+
+                log.warning("Unable to connect to the database (attempt %d of %d); retrying in %.1f seconds: %s", attempt,
+                    self.retries + 1, delay, e)
+                time.sleep(delay)
+
+
+
 def set_log_level(level):
     log.setLevel(level)
 
-def get_http_connector(host, username, password, secure):
-    pass #TODO
+def set_type_cache_dir(path):
+    """
+    Sets the directory in which PostgreSQL connectors save the names of the server's built-in types
+    between runs, or disables the disk cache if the path is None
+    """
+    PSQLConnector.type_cache_dir = path
 
 def get_db_connector(type, host='localhost', port=None, username='candlepin', password='', dbname='candlepin'):
     connectors = {
@@ -307,3 +1630,10 @@ def get_db_connector(type, host='localhost', port=None, username='candlepin', pa
     }
 
     return connectors[str(type).lower()](host, port, username, password, dbname)
+
+def get_connection_pool(type, host='localhost', port=None, username='candlepin', password='', dbname='candlepin', **kwargs):
+    """
+    Creates a ConnectionPool handing out connectors to the given database. Any keyword arguments are
+    passed to the pool.
+    """
+    return ConnectionPool(partial(get_db_connector, type, host, port, username, password, dbname), **kwargs)
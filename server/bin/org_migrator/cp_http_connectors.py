@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+# Clients for Candlepin's REST API. As with cp_connectors, this file should be imported and used by other
+# scripts, rather than having business logic added to it directly.
+
+# HTTPConnector requires the requests package, and AsyncHTTPConnector the aiohttp package. Neither is
+# needed by the org migrator itself, so they aren't installed with it.
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import re
+import threading
+import time
+
+import logging
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(levelname)-7s %(name)-16s %(message)s")
+log = logging.getLogger('cp_connector')
+
+
+
+def import_requests():
+    try:
+        import requests
+        return requests
+    except ImportError:
+        raise Exception("HTTPConnector requires the requests package")
+
+def import_aiohttp():
+    try:
+        import aiohttp
+        return aiohttp
+    except ImportError:
+        raise Exception("AsyncHTTPConnector requires the aiohttp package")
+
+
+
+class HTTPConnector(object):
+    """
+    A client for Candlepin's REST API. Requests are sent over a session keeping a pool of persistent
+    connections to the server, with at most max_connections requests in flight at once no matter how
+    many threads share the connector. Responses may be gzip compressed, and idempotent requests which
+    fail to connect, time out, or are turned away by an overloaded server are retried with exponential
+    backoff.
+
+    Paths are relative to the base URL of the server, such as https://localhost:8443/candlepin. This
+    requires the requests package; see AsyncHTTPConnector for an asyncio equivalent.
+    """
+
+    # Methods which may safely be sent more than once
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+    # Statuses indicating the server may accept the request if it's retried later
+    RETRY_STATUSES = frozenset([429, 502, 503, 504])
+
+    # The longest to wait before retrying a request, in seconds
+    MAX_BACKOFF = 30
+
+    # The default number of results to request per page when iterating a paginated endpoint
+    DEFAULT_PAGE_SIZE = 100
+
+    def __init__(self, base_url, username=None, password=None, verify=True, cert=None, max_connections=10, retries=3, backoff=0.5,
+        timeout=60):
+        requests = import_requests()
+        from requests.adapters import HTTPAdapter
+        self.requests = requests
+
+        self.base_url = base_url.rstrip('/')
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        # Impl note:
+        # The adapter blocks rather than opening a throwaway connection once its pool is exhausted, and
+        # its own retries are disabled in favor of ours, which also cover error statuses
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections, pool_block=True, max_retries=0)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.verify = verify
+        self.session.cert = cert
+        self.session.headers.update({'Accept': 'application/json', 'Accept-Encoding': 'gzip'})
+
+        if username is not None:
+            self.session.auth = (username, password)
+
+        self._semaphore = threading.BoundedSemaphore(max_connections)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.session.close()
+
+    def build_url(self, path):
+        if re.match(r'https?://', path):
+            return path
+
+        return self.base_url + '/' + path.lstrip('/')
+
+    def request(self, method, path, params=None, json=None, headers=None, retry=None):
+        """
+        Sends a request to the given path, returning the response. Requests are retried if retry is set,
+        or by default if the method is idempotent. Raises an HTTPError if the server responds with an
+        error status.
+        """
+        method = method.upper()
+        url = self.build_url(path)
+
+        if retry is None:
+            retry = method in HTTPConnector.IDEMPOTENT_METHODS
+
+        attempt = 0
+
+        while True:
+            try:
+                with self._semaphore:
+                    response = self.session.request(method, url, params=params, json=json, headers=headers, timeout=self.timeout)
+            except (self.requests.ConnectionError, self.requests.Timeout) as e:
+                if not retry or attempt >= self.retries:
+                    raise
+
+                delay = HTTPConnector._get_retry_delay(attempt, self.backoff)
+                log.warning("%s %s failed; retrying in %.1f seconds: %s", method, url, delay, e)
+            else:
+                if not retry or attempt >= self.retries or response.status_code not in HTTPConnector.RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response
+
+                delay = HTTPConnector._get_retry_delay(attempt, self.backoff, response.headers.get('Retry-After'))
+                log.warning("%s %s returned status %d; retrying in %.1f seconds", method, url, response.status_code, delay)
+                response.close()
+
+            time.sleep(delay)
+            attempt = attempt + 1
+
+    def get(self, path, params=None):
+        return HTTPConnector._decode(self.request('GET', path, params))
+
+    def post(self, path, data=None, params=None):
+        return HTTPConnector._decode(self.request('POST', path, params, data))
+
+    def put(self, path, data=None, params=None):
+        return HTTPConnector._decode(self.request('PUT', path, params, data))
+
+    def delete(self, path, params=None):
+        return HTTPConnector._decode(self.request('DELETE', path, params))
+
+    def iterate(self, path, params=None, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Lazily iterates the results of a paginated endpoint, requesting each page as the results of the
+        previous page are consumed. Pages are followed through the next link Candlepin returns in the
+        Link header of each page, so iteration ends with the last page, or the first page of endpoints
+        which don't support paging.
+        """
+        params = HTTPConnector._build_page_params(params, page_size)
+
+        while path is not None:
+            response = self.request('GET', path, params)
+
+            for item in response.json():
+                yield item
+
+            # The next link carries every parameter of the request
+            (path, params) = (response.links.get('next', {}).get('url'), None)
+
+    def get_many(self, paths, params=None):
+        """
+        Fetches each of the given paths concurrently, returning their results in order
+        """
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            return list(executor.map(lambda path: self.get(path, params), paths))
+
+    @staticmethod
+    def build_base_url(host, secure, port=None, prefix='/candlepin'):
+        if port is None:
+            port = 8443 if secure else 8080
+
+        return '%s://%s:%d/%s' % ('https' if secure else 'http', host, port, prefix.strip('/'))
+
+    @staticmethod
+    def _decode(response):
+        return HTTPConnector._decode_body(response.content)
+
+    @staticmethod
+    def _decode_body(body):
+        return json.loads(body.decode('utf-8')) if len(body) > 0 else None
+
+    @staticmethod
+    def _build_page_params(params, page_size):
+        # Candlepin only pages results when asked to, starting from the first page
+        params = dict(params) if params is not None else {}
+        params.setdefault('page', 1)
+        params.setdefault('per_page', page_size)
+
+        return params
+
+    @staticmethod
+    def _get_retry_delay(attempt, backoff, retry_after=None):
+        # The delay the server asks for in a Retry-After header is preferred, but capped all the same
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), HTTPConnector.MAX_BACKOFF)
+
+        return min(backoff * (2 ** attempt), HTTPConnector.MAX_BACKOFF)
+
+
+
+class AsyncHTTPConnector(object):
+    """
+    An asyncio client for Candlepin's REST API, for callers sending many requests at once. Behaves as
+    HTTPConnector does, with every request method a coroutine and iterate an asynchronous generator.
+    The connector must be created, used and closed within a running event loop. This requires the
+    aiohttp package.
+    """
+
+    def __init__(self, base_url, username=None, password=None, verify=True, cert=None, max_connections=10, retries=3, backoff=0.5,
+        timeout=60):
+        aiohttp = import_aiohttp()
+        import asyncio
+        self.aiohttp = aiohttp
+        self.asyncio = asyncio
+
+        self.base_url = base_url.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+
+        # verify and cert take the same values as they do for requests
+        connector_params = {'limit': max_connections}
+
+        if verify is False:
+            connector_params['ssl'] = False
+        elif isinstance(verify, str) or cert is not None:
+            import ssl
+            connector_params['ssl'] = ssl.create_default_context(cafile=verify if isinstance(verify, str) else None)
+
+            if cert is not None:
+                connector_params['ssl'].load_cert_chain(*(cert if isinstance(cert, tuple) else (cert,)))
+
+        # aiohttp decompresses gzip responses itself, and keeps up to max_connections connections alive
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(**connector_params),
+            auth=aiohttp.BasicAuth(username, password) if username is not None else None,
+            headers={'Accept': 'application/json', 'Accept-Encoding': 'gzip'},
+            timeout=aiohttp.ClientTimeout(total=timeout))
+
+        self._semaphore = asyncio.Semaphore(max_connections)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
+
+    async def close(self):
+        await self.session.close()
+
+    def build_url(self, path):
+        if re.match(r'https?://', path):
+            return path
+
+        return self.base_url + '/' + path.lstrip('/')
+
+    async def request(self, method, path, params=None, json=None, headers=None, retry=None):
+        """
+        Sends a request to the given path, returning a tuple of the response and its decoded body, or
+        None if it has no body. Retries as HTTPConnector.request does, and raises a ClientResponseError
+        if the server responds with an error status.
+        """
+        method = method.upper()
+        url = self.build_url(path)
+
+        if retry is None:
+            retry = method in HTTPConnector.IDEMPOTENT_METHODS
+
+        attempt = 0
+
+        while True:
+            try:
+                async with self._semaphore:
+                    async with self.session.request(method, url, params=params, json=json, headers=headers) as response:
+                        if not retry or attempt >= self.retries or response.status not in HTTPConnector.RETRY_STATUSES:
+                            response.raise_for_status()
+
+                            body = await response.read()
+                            return (response, HTTPConnector._decode_body(body))
+
+                        delay = HTTPConnector._get_retry_delay(attempt, self.backoff, response.headers.get('Retry-After'))
+                        log.warning("%s %s returned status %d; retrying in %.1f seconds", method, url, response.status, delay)
+
+                        # Reading the body lets the connection be kept alive for the retry
+                        await response.read()
+            except (self.aiohttp.ClientConnectionError, self.asyncio.TimeoutError) as e:
+                if not retry or attempt >= self.retries:
+                    raise
+
+                delay = HTTPConnector._get_retry_delay(attempt, self.backoff)
+                log.warning("%s %s failed; retrying in %.1f seconds: %s", method, url, delay, e)
+
+            await self.asyncio.sleep(delay)
+            attempt = attempt + 1
+
+    async def get(self, path, params=None):
+        return (await self.request('GET', path, params))[1]
+
+    async def post(self, path, data=None, params=None):
+        return (await self.request('POST', path, params, data))[1]
+
+    async def put(self, path, data=None, params=None):
+        return (await self.request('PUT', path, params, data))[1]
+
+    async def delete(self, path, params=None):
+        return (await self.request('DELETE', path, params))[1]
+
+    async def iterate(self, path, params=None, page_size=HTTPConnector.DEFAULT_PAGE_SIZE):
+        """
+        Lazily iterates the results of a paginated endpoint, as HTTPConnector.iterate does
+        """
+        params = HTTPConnector._build_page_params(params, page_size)
+
+        while path is not None:
+            (response, items) = await self.request('GET', path, params)
+
+            for item in items:
+                yield item
+
+            link = response.links.get('next')
+            (path, params) = (str(link['url']) if link is not None else None, None)
+
+    async def get_many(self, paths, params=None):
+        """
+        Fetches each of the given paths concurrently, returning their results in order
+        """
+        return await self.asyncio.gather(*[self.get(path, params) for path in paths])
+
+
+
+def get_http_connector(host, username, password, secure, port=None, prefix='/candlepin', **kwargs):
+    """
+    Creates an HTTPConnector for the Candlepin server on the given host. Any keyword arguments are passed
+    to the connector.
+    """
+    return HTTPConnector(HTTPConnector.build_base_url(host, secure, port, prefix), username, password, **kwargs)
+
+def get_async_http_connector(host, username, password, secure, port=None, prefix='/candlepin', **kwargs):
+    """
+    Creates an AsyncHTTPConnector for the Candlepin server on the given host. This must be called within
+    a running event loop.
+    """
+    return AsyncHTTPConnector(HTTPConnector.build_base_url(host, secure, port, prefix), username, password, **kwargs)
@@ -0,0 +1,408 @@
+from collections import OrderedDict
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+import org_migrator
+
+
+
+class ModelManagerTest(unittest.TestCase):
+
+    def _build_manager(self, db, archive_key=None, upsert=True):
+        archive = Mock()
+        archive.get_primary_key.return_value = archive_key
+
+        return org_migrator.ModelManager('org_id', archive, db, False, batch_size=2, upsert=upsert)
+
+    def test_upsert_into_keyed_table_should_upsert_rows(self):
+        db = Mock()
+        db.get_primary_key.return_value = ['id']
+        db.upsert_rows.return_value = 2
+
+        manager = self._build_manager(db)
+        self.assertTrue(manager._upsert_rows('cp_product', ['id', 'name'], [('1', 'a'), ('2', 'b')]))
+
+        db.upsert_rows.assert_called_once_with('cp_product', ['id', 'name'], ['id'], [('1', 'a'), ('2', 'b')], 2)
+        db.execQuery.assert_not_called()
+
+    def test_upsert_into_keyless_table_should_insert_missing_rows(self):
+        db = Mock()
+        db.get_primary_key.return_value = []
+        db.insert_rows.side_effect = lambda table, columns, rows, ignore_dupes, batch_size: len(rows)
+
+        # The first batch has one row present already; the second repeats a row within itself
+        existing = [[('p1', 'p2')], []]
+        db.execQuery.side_effect = lambda query, params: Mock(fetchall=Mock(return_value=existing.pop(0)))
+
+        rows = [['p1', 'p2'], ['p1', 'p3'], ['p4', 'p5'], ['p4', 'p5']]
+        manager = self._build_manager(db)
+        self.assertTrue(manager._upsert_rows('cp2_product_provided_products', ['product_uuid', 'provided_product_uuid'], rows))
+
+        self.assertEqual(db.execQuery.call_count, 2)
+        (query, params) = db.execQuery.call_args_list[0][0]
+        self.assertEqual(query, 'SELECT product_uuid, provided_product_uuid FROM cp2_product_provided_products ' +
+            'WHERE (product_uuid, provided_product_uuid) IN ((%s, %s), (%s, %s))')
+        self.assertEqual(params, ['p1', 'p2', 'p1', 'p3'])
+
+        inserted = [call[0][2] for call in db.insert_rows.call_args_list]
+        self.assertEqual(inserted, [[('p1', 'p3')], [('p4', 'p5')]])
+        db.upsert_rows.assert_not_called()
+
+    def test_upsert_into_keyless_table_should_skip_present_rows(self):
+        db = Mock()
+        db.get_primary_key.return_value = []
+        db.execQuery.return_value.fetchall.return_value = [('c1',), ('c2',)]
+
+        manager = self._build_manager(db)
+        self.assertTrue(manager._upsert_rows('cp_consumer_content_tags', ['content_tag'], [['c1'], ['c2']]))
+
+        self.assertEqual(db.execQuery.call_args[0][0], 'SELECT content_tag FROM cp_consumer_content_tags WHERE content_tag IN (%s, %s)')
+        db.insert_rows.assert_not_called()
+
+    def test_bulk_insert_should_upsert_on_the_given_connection(self):
+        (db, worker) = (Mock(), Mock())
+        worker.get_primary_key.return_value = ['id']
+        worker.upsert_rows.return_value = 1
+
+        manager = self._build_manager(db)
+        self.assertTrue(manager._bulk_insert('cp_product', ['id'], [('1',)], db=worker))
+
+        worker.upsert_rows.assert_called_once_with('cp_product', ['id'], ['id'], [('1',)], 2)
+        db.upsert_rows.assert_not_called()
+
+    def test_bulk_insert_should_not_upsert_into_staging_tables(self):
+        db = Mock()
+
+        manager = self._build_manager(db)
+        with self.assertRaises(Exception):
+            manager._bulk_insert('cp_product', ['id'], [('1',)], db=db, target='org_migrator_stage_0')
+
+        db.upsert_rows.assert_not_called()
+        db.copy_rows.assert_not_called()
+
+
+
+class PoolManagerTest(unittest.TestCase):
+
+    def test_import_should_import_every_tree_level_present(self):
+        # A delta with no changed pools at depth 0, and no entitlements at depth 2
+        archive = Mock()
+        archive.get_entries.return_value = ['cp_cdn.json', 'cp_entitlement-0.json', 'cp_pool-1.json', 'cp_entitlement-1.json',
+            'cp_pool-2.json', 'cp_pool_attribute.json']
+
+        manager = org_migrator.PoolManager('org_id', archive, Mock(), False)
+        manager._import_json = Mock(return_value=True)
+
+        self.assertTrue(manager.do_import())
+
+        files = [call[0][0] for call in manager._import_json.call_args_list]
+        tree = [file for file in files if org_migrator.PoolManager.TREE_ENTRY_PATTERN.match(file)]
+        self.assertEqual(tree, ['cp_entitlement-0.json', 'cp_pool-1.json', 'cp_entitlement-1.json', 'cp_pool-2.json'])
+        self.assertEqual(files[-1], 'cp_ent_certificate.json')
+
+
+
+class ColumnarTableFormatTest(unittest.TestCase):
+
+    def _round_trip(self, columns, rows, batch_size=2):
+        fp = io.BytesIO()
+        table_format = org_migrator.ColumnarTableFormat()
+        table_format.write(fp, 'cp_test', columns, ['text'] * len(columns), rows, batch_size)
+
+        fp.seek(0)
+        data = table_format.read(fp)
+        self.assertEqual(data.table, 'cp_test')
+        self.assertEqual(list(data.columns), columns)
+
+        return [list(row) for row in data.rows]
+
+    def _assert_round_trip(self, columns, rows, batch_size=2):
+        result = self._round_trip(columns, rows, batch_size)
+
+        self.assertEqual(result, rows)
+        for (expected, actual) in zip(rows, result):
+            self.assertEqual([type(value) for value in actual], [type(value) for value in expected])
+
+    def test_round_trip_should_preserve_scalar_columns(self):
+        rows = [
+            [True, 1, 1.5, 'a', b'\x00\x01'],
+            [False, -(2 ** 63), -0.25, '', b''],
+            [None, 2 ** 63 - 1, None, 'caf\u00e9', None]
+        ]
+
+        self._assert_round_trip(['b', 'i', 'f', 't', 'y'], rows)
+
+    def test_round_trip_should_preserve_null_columns(self):
+        self._assert_round_trip(['a', 'b'], [[None, None], [None, None], [None, 'x']])
+
+    def test_round_trip_should_preserve_mixed_bool_and_int_chunks(self):
+        self._assert_round_trip(['flag'], [[True], [2], [0], [False], [None]], batch_size=3)
+
+    def test_round_trip_should_preserve_integers_beyond_64_bits(self):
+        self._assert_round_trip(['big'], [[2 ** 63], [-(2 ** 63) - 1], [1]])
+
+    def test_round_trip_should_preserve_json_values(self):
+        rows = [[{'key': [1, 'two']}], [[True, None]], ['text'], [3]]
+        self._assert_round_trip(['value'], rows)
+
+    def test_round_trip_should_handle_empty_tables(self):
+        self.assertEqual(self._round_trip(['id'], []), [])
+
+
+
+class FakeArchive(object):
+    """
+    Stands in for an ArchiveReader holding the given tables, each as a single entry
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.manifest = None
+
+    def get_tables(self):
+        return list(self.tables.keys())
+
+    def get_entries(self):
+        return [table + '.json' for table in self.tables]
+
+    def get_primary_key(self, table):
+        return None
+
+    @contextlib.contextmanager
+    def read_table(self, file):
+        table = file[:-len('.json')]
+        (columns, rows) = self.tables[table]
+
+        yield org_migrator.TableData(table, columns, ['text'] * len(columns), iter([list(row) for row in rows]))
+
+
+
+class IDRemapperTest(unittest.TestCase):
+
+    TABLES = OrderedDict([
+        ('cp_owner', (['id', 'name'], [['o1', 'a'], ['o2', 'b']])),
+        ('cp_event', (['id', 'owner_id'], [[5, 'o1'], [9, 'o2'], [6, 'o2']])),
+        ('cp_pool', (['id', 'owner_id'], [['p1', 'o1'], ['p2', 'o2']])),
+        ('cp_pool_source_stack', (['derivedpool_id', 'sourceconsumer_id'], [['p1', 'c1']]))
+    ])
+
+    # The keys already present in the target database, and the highest key of each table
+    EXISTING = {'cp_owner': ['o1'], 'cp_event': [5, 6], 'cp_pool': []}
+    HIGHEST = {'cp_event': 7}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.map_file = os.path.join(self.directory, 'archive.zip.idmap.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _build_db(self):
+        db = Mock()
+        db.get_primary_key.side_effect = lambda table: {'cp_pool_source_stack': ['derivedpool_id', 'sourceconsumer_id']}.get(table, ['id'])
+        db.get_foreign_keys.side_effect = lambda table: {'cp_event': [('owner_id', 'cp_owner', 'id')],
+            'cp_pool': [('owner_id', 'cp_owner', 'id')]}.get(table, [])
+
+        staged = {}
+        db.create_staging_table.side_effect = lambda stage, table, columns: staged.__setitem__(stage, table)
+        db.copy_rows.side_effect = lambda stage, columns, rows, ignore_dupes, batch_size: len(list(rows))
+
+        def execQuery(query, params=()):
+            table = re.search(r'FROM (\w+)', query).group(1)
+
+            if query.startswith('SELECT MAX'):
+                return Mock(fetchone=Mock(return_value=(IDRemapperTest.HIGHEST.get(table),)))
+
+            # Collisions are found by joining the staged keys against the table
+            table = staged[table]
+            archived = [row[0] for row in IDRemapperTest.TABLES[table][1]]
+            return Mock(__iter__=Mock(return_value=iter([(value,) for value in archived if value in IDRemapperTest.EXISTING[table]])))
+
+        db.execQuery.side_effect = execQuery
+        return db
+
+    def _prepare(self, db, resuming=False):
+        remapper = org_migrator.IDRemapper(db, FakeArchive(IDRemapperTest.TABLES), self.map_file)
+        remapper.prepare(resuming)
+
+        return remapper
+
+    def test_prepare_should_remap_colliding_ids(self):
+        db = self._build_db()
+        remapper = self._prepare(db)
+
+        self.assertEqual(set(remapper.mapping.keys()), set(['cp_owner', 'cp_event']))
+
+        (key, owners) = remapper.mapping['cp_owner']
+        self.assertEqual(key, 'id')
+        self.assertEqual(list(owners.keys()), ['o1'])
+        self.assertNotIn(owners['o1'], ['o1', 'o2'])
+
+        # Integer keys are numbered on from the highest key of either the table or the archive
+        self.assertEqual(remapper.mapping['cp_event'], ('id', {5: 10, 6: 11}))
+
+        # Tables with composite keys are never staged, and every staging table is dropped
+        self.assertEqual(db.create_staging_table.call_count, 3)
+        dropped = [call[0][0] for call in db.execUpdate.call_args_list if call[0][0].startswith('DROP TABLE')]
+        self.assertEqual(len(dropped), 3)
+
+    def test_get_transform_should_remap_keys_and_foreign_keys(self):
+        remapper = self._prepare(self._build_db())
+        new_owner = remapper.mapping['cp_owner'][1]['o1']
+
+        def transform(table):
+            (columns, rows) = IDRemapperTest.TABLES[table]
+            return list(org_migrator.transform_rows([list(row) for row in rows], columns, remapper.get_transform(table, columns)))
+
+        self.assertEqual(transform('cp_owner'), [[new_owner, 'a'], ['o2', 'b']])
+        self.assertEqual(transform('cp_event'), [[10, new_owner], [9, 'o2'], [11, 'o2']])
+        self.assertEqual(transform('cp_pool'), [['p1', new_owner], ['p2', 'o2']])
+        self.assertIsNone(remapper.get_transform('cp_pool_source_stack', ['derivedpool_id', 'sourceconsumer_id']))
+
+    def test_prepare_should_reuse_the_map_when_resuming(self):
+        mapping = self._prepare(self._build_db()).mapping
+
+        db = self._build_db()
+        remapper = self._prepare(db, resuming=True)
+
+        self.assertEqual(remapper.mapping, mapping)
+        db.create_staging_table.assert_not_called()
+
+        # The foreign keys are still needed to rewrite the remaining entries
+        self.assertEqual(remapper.get_transform('cp_pool', ['id', 'owner_id']).columns, ['owner_id'])
+
+    def test_advance_sequences_should_advance_integer_keys(self):
+        db = self._build_db()
+        self._prepare(db).advance_sequences()
+
+        db.advance_sequence.assert_called_once_with('cp_event', 'id')
+
+
+
+class RowTransformTest(unittest.TestCase):
+
+    COLUMNS = ['id', 'owner_id', 'active', 'content', 'name']
+
+    def _build_transform(self, hook=None):
+        remapper = org_migrator.IDRemapper(Mock(), Mock(), None)
+        remapper.mapping = {'cp_owner': ('id', {'o1': 'o9'})}
+        remapper._foreign_keys = {'cp_pool': [('owner_id', 'cp_owner', 'id')]}
+
+        converters = org_migrator.boolean_converter(['active'], org_migrator.base64_decoder(['content'], hook))
+        return remapper.get_transform('cp_pool', RowTransformTest.COLUMNS, converters)
+
+    def test_chained_transforms_should_convert_every_column_of_a_batch(self):
+        rows = [
+            ['p1', 'o1', 1, 'AAE=', 'a'],
+            ['p2', 'o2', 0, None, 'b'],
+            ['p3', 'o1', None, 'aGk=', 'c']
+        ]
+
+        transform = self._build_transform()
+        self.assertIsInstance(transform, org_migrator.RowTransform)
+
+        result = list(org_migrator.transform_rows([list(row) for row in rows], RowTransformTest.COLUMNS, transform, batch_size=2))
+
+        self.assertEqual([row[0] for row in result], ['p1', 'p2', 'p3'])
+        self.assertEqual([row[1] for row in result], ['o9', 'o2', 'o9'])
+        self.assertEqual([row[2] for row in result], [True, False, None])
+        self.assertEqual([row[3] for row in result], [b'\x00\x01', None, b'hi'])
+        self.assertEqual([row[4] for row in result], ['a', 'b', 'c'])
+
+    def test_chained_transforms_should_end_with_row_hooks(self):
+        hook = Mock(side_effect=lambda columns, row: row + [len(columns)])
+        transform = self._build_transform(hook)
+
+        self.assertEqual(transform(RowTransformTest.COLUMNS, ['p1', 'o1', 1, 'AAE=', 'a']), ['p1', 'o9', True, b'\x00\x01', 'a', 5])
+        hook.assert_called_once_with(RowTransformTest.COLUMNS, ['p1', 'o9', True, b'\x00\x01', 'a'])
+
+
+
+class JSONTableReaderTest(unittest.TestCase):
+
+    ROWS = [
+        ['caf\u00e9 \u2603 \U0001f600', 12345678901234567890, -1.5e10, True, None],
+        ['tab\t"quoted" back\\slash\nnewline', 0, 0.25, False, {'nested': ['\u00e9', 1]}],
+        ['', -7, 1e-07, True, []]
+    ]
+
+    def _read(self, document, block_size):
+        with patch.object(org_migrator.JSONTableReader, 'BLOCK_SIZE', block_size):
+            data = org_migrator.JSONTableReader(io.BytesIO(document.encode('utf-8'))).read()
+            return (data.table, data.columns, data.column_types, list(data.rows))
+
+    def test_read_should_parse_values_split_across_blocks(self):
+        fp = io.BytesIO()
+        org_migrator.write_json_table(fp, 'cp_test', ['a', 'b', 'c', 'd', 'e'], ['text'] * 5, JSONTableReaderTest.ROWS)
+
+        # The writer escapes non-ASCII characters; written raw, their UTF-8 bytes are split between blocks
+        written = fp.getvalue().decode('utf-8')
+        raw = json.dumps(json.loads(written), ensure_ascii=False)
+
+        for document in (written, raw):
+            for block_size in range(1, 65):
+                (table, columns, column_types, rows) = self._read(document, block_size)
+
+                self.assertEqual(table, 'cp_test')
+                self.assertEqual(columns, ['a', 'b', 'c', 'd', 'e'])
+                self.assertEqual(column_types, ['text'] * 5)
+                self.assertEqual(rows, JSONTableReaderTest.ROWS, 'block size %d' % (block_size,))
+
+    def test_read_should_parse_escape_sequences_across_blocks(self):
+        document = '{"table": "cp_test", "columns": ["a", "b"], "rows": [["\\u00e9\\ud83d\\ude00\\n\\"\\\\", 1.5], [12, -3e2]]}'
+
+        for block_size in range(1, 17):
+            self.assertEqual(self._read(document, block_size)[3], [['é\U0001f600\n"\\', 1.5], [12, -300.0]])
+
+    def test_read_should_read_rows_placed_before_columns(self):
+        document = '{"rows": [[1, "a"], [2, "b"]], "table": "cp_test", "columns": ["id", "name"], "column_types": ["int4", "text"]}'
+
+        for block_size in (1, 3, 1024):
+            self.assertEqual(self._read(document, block_size), ('cp_test', ['id', 'name'], ['int4', 'text'], [[1, 'a'], [2, 'b']]))
+
+    def test_read_should_read_empty_tables(self):
+        document = ' { "table" : "cp_test" , "columns" : [ "id" ] , "rows" : [ ] } '
+        self.assertEqual(self._read(document, 2), ('cp_test', ['id'], None, []))
+
+    def test_read_should_reject_truncated_documents(self):
+        with self.assertRaises(Exception):
+            self._read('{"table": "cp_test", "columns": ["id"], "rows": [[1], [2', 4)
+
+
+
+class QueryExplainerTest(unittest.TestCase):
+
+    def test_explain_content_should_explain_staged_queries(self):
+        db = Mock()
+        db.explain.return_value = []
+        db.get_plan_warnings.return_value = []
+
+        staging = Mock()
+        staging.is_prepared.return_value = True
+
+        explainer = org_migrator.QueryExplainer()
+        manager = org_migrator.ContentManager('org_id', None, db, False, explainer=explainer, staging=staging)
+        manager._export_query = Mock()
+
+        self.assertTrue(manager.do_export())
+        explainer.run(db)
+
+        queries = [call[0][0] for call in db.explain.call_args_list]
+        self.assertEqual(queries[1:], [org_migrator.ContentManager.STAGED_CONTENT_QUERY, org_migrator.ContentManager.STAGED_CMP_QUERY])
+
+        # The staged UUIDs are populated before the queries joining against them are explained
+        statements = [call[0][0] for call in db.execUpdate.call_args_list]
+        self.assertEqual(statements[0], 'DELETE FROM org_migrator_content')
+        self.assertTrue(statements[1].startswith('INSERT INTO org_migrator_content (uuid) SELECT'))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,31 @@
 #!/usr/bin/env python
 
+from array import array
 import binascii
+import codecs
+from collections import namedtuple, OrderedDict
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import datetime
+import decimal
 from functools import partial
+import hashlib
+import itertools
 import json
 import logging
 from optparse import OptionParser
 import os
+import queue
 import re
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import weakref
 import zipfile
 
 import cp_connectors as cp
@@ -18,6 +36,18 @@ log = logging.getLogger('org_migrator')
 LOGLVL_TRACE = 5
 logging.addLevelName(LOGLVL_TRACE, 'TRACE')
 
+# The number of rows to fetch from the database and encode at a time during export
+DEFAULT_BATCH_SIZE = 5000
+
+# The number of keys to delete per statement when applying the deletions of a delta archive
+DELETE_BATCH_SIZE = 1000
+
+# The number of rows to commit at a time during a resumable import
+DEFAULT_CHECKPOINT_ROWS = 50000
+
+# How far before a previous archive's export time a delta export begins looking for changes
+DELTA_OVERLAP = datetime.timedelta(minutes=10)
+
 
 
 def get_cursor_columns(db, cursor):
@@ -31,25 +61,43 @@ def get_cursor_columns(db, cursor):
 
 def get_cursor_column_types(db, cursor):
     if hasattr(cursor, 'column_names'):
-        return [db.get_type_as_string(col[1]) for col in cursor.description]
+        return db.get_types_as_strings([col[1] for col in cursor.description])
     elif hasattr(cursor, 'description'):
-        return [db.get_type_as_string(col.type_code) for col in cursor.description]
+        return db.get_types_as_strings([col.type_code for col in cursor.description])
     else:
         raise Exception('Cannot determine column types for cursor')
 
 
-def resolve_org(db, org):
-    org_id = None
+def resolve_orgs(db, orgs=None):
+    """
+    Resolves the given org keys to org IDs in a single query, returning an ordered dictionary mapping
+    each key to its ID. Orgs which do not exist are omitted. If no keys are given, every org is resolved.
+    """
+    resolved = OrderedDict()
+
+    if orgs is None:
+        cursor = db.execQuery("SELECT account, id FROM cp_owner ORDER BY account")
+    elif len(orgs) > 0:
+        cursor = db.execQuery("SELECT account, id FROM cp_owner WHERE account IN (" + ', '.join(['%s'] * len(orgs)) + ")", orgs)
+    else:
+        return resolved
+
+    found = dict((row[0], row[1]) for row in cursor)
+    cursor.close()
+
+    for org in (orgs if orgs is not None else found.keys()):
+        if org in found:
+            resolved[org] = found[org]
 
-    cursor = db.execQuery("SELECT id FROM cp_owner WHERE account=%s", (org,))
-    row = cursor.fetchone()
+    return resolved
 
-    if row is not None:
-        org_id = row[0]
 
+def get_db_timestamp(db):
+    cursor = db.execQuery('SELECT CURRENT_TIMESTAMP')
+    timestamp = cursor.fetchone()[0]
     cursor.close()
 
-    return org_id
+    return str(timestamp)
 
 
 def list_orgs(db):
@@ -62,16 +110,78 @@ def list_orgs(db):
     return orgs
 
 
-def jsonify(data):
-    def data_converter(obj):
-        if isinstance(obj, (bytearray, buffer, memoryview)):
-            return binascii.b2a_base64(obj)
-        if isinstance(obj, datetime.datetime):
-            return str(obj)
+def json_data_converter(obj):
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return binascii.b2a_base64(obj).decode('ascii')
+    if isinstance(obj, datetime.datetime):
+        return str(obj)
+
+    raise TypeError("Unexpected type: %s" % (type(obj)))
+
+
+def iterate_cursor(cursor, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Yields rows from the given cursor, fetching at most batch_size rows from the driver at a time
+    """
+    while True:
+        rows = cursor.fetchmany(batch_size)
+
+        if not rows:
+            break
+
+        for row in rows:
+            yield row
+
+
+def trace_rows(rows):
+    for row in rows:
+        log.log(LOGLVL_TRACE, '  row: %s', row)
+        yield row
+
+
+def iterate_batches(rows, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Yields lists of at most batch_size rows from the given iterable
+    """
+    iterator = iter(rows)
+
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+
+        if not batch:
+            break
+
+        yield batch
+
+
+def write_json_table(fp, table, columns, column_types, rows, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Streams a table into the given file object as a JSON document of the form:
+    { "table": ..., "columns": [...], "column_types": [...], "rows": [[...], ...] }
 
-        raise TypeError("Unexpected type: %s" % (type(obj)))
+    Rows are encoded and written in blocks of batch_size rows, so memory use is bounded by the
+    block size rather than the size of the table. Returns the number of rows written.
+    """
+    encoder = json.JSONEncoder(default=json_data_converter)
 
-    return json.dumps(data, default=data_converter)
+    header = encoder.encode({
+        'table':        table,
+        'columns':      list(columns),
+        'column_types': list(column_types)
+    })
+
+    count = 0
+
+    # Splice the rows array into the header object so we don't need to hold the rows to encode it
+    fp.write((header[:-1] + ', "rows": [').encode('utf-8'))
+
+    for block in iterate_batches(rows, batch_size):
+        fp.write(((', ' if count > 0 else '') + ', '.join(encoder.encode(row) for row in block)).encode('utf-8'))
+        count = count + len(block)
+
+    fp.write(b']}')
+
+    return count
 
 
 dbobj_re = re.compile('[A-Za-z0-9_]+')
@@ -84,147 +194,2316 @@ def validate_column_names(table, columns):
             raise Exception("Column %s.%s uses invalid characters" % (table, column))
 
 
-def boolean_converter(columns, chain=None):
-    def convert_row(col_names, row):
-        for col in columns:
-            idx = col_names.index(col)
-            row[idx] = bool(row[idx])
+class RowTransform(object):
+    """
+    Converts the values of a set of named columns during import. Transforms may be chained, and are
+    compiled against the column list of a table, resolving the column indexes once. The compiled
+    transform converts a batch of rows in place, one column at a time.
+
+    For compatibility with plain row hooks, a transform may also be called on a single row as
+    transform(col_names, row).
+    """
+
+    def __init__(self, columns, convert, chain=None):
+        self.columns = list(columns)
+        self.convert = convert
+        self.chain = chain
 
-        if callable(chain):
-            row = chain(col_names, row)
+        self._compiled = {}
 
-        return row
-    return convert_row
+    def compile(self, col_names):
+        """
+        Returns a function which converts a list of rows of the given columns in place, returning the
+        list
+        """
+        indexes = [col_names.index(col) for col in self.columns]
+        convert = self.convert
 
+        chained = None
+        if isinstance(self.chain, RowTransform):
+            chained = self.chain.compile(col_names)
+        elif callable(self.chain):
+            hook = self.chain
+            chained = lambda rows: [hook(col_names, row) for row in rows]
+
+        def convert_rows(rows):
+            for idx in indexes:
+                values = list(map(convert, [row[idx] for row in rows]))
+
+                for (row, value) in zip(rows, values):
+                    row[idx] = value
+
+            if chained is not None:
+                rows = chained(rows)
+
+            return rows
+
+        return convert_rows
+
+    def __call__(self, col_names, row):
+        key = tuple(col_names)
+
+        if key not in self._compiled:
+            self._compiled[key] = self.compile(col_names)
+
+        return self._compiled[key]([row])[0]
+
+
+def transform_rows(rows, columns, transform, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Applies the given transform or row hook to the rows of the given columns, yielding the converted
+    rows. Transforms are applied to batches of batch_size rows.
+    """
+    if not isinstance(transform, RowTransform):
+        return (transform(columns, row) for row in rows)
+
+    convert = transform.compile(columns)
+    return itertools.chain.from_iterable(convert(batch) for batch in iterate_batches(rows, batch_size))
+
+
+def convert_boolean(value):
+    return bool(value) if value is not None else None
+
+def decode_base64(value):
+    # Formats which store byte columns raw won't need decoding
+    return binascii.a2b_base64(value) if isinstance(value, str) else value
+
+def boolean_converter(columns, chain=None):
+    return RowTransform(columns, convert_boolean, chain)
 
 def base64_decoder(columns, chain=None):
-    def decode_row(col_names, row):
-        for col in columns:
-            idx = col_names.index(col)
-            row[idx] = binascii.a2b_base64(row[idx])
+    return RowTransform(columns, decode_base64, chain)
 
-        if callable(chain):
-            row = chain(row)
 
-        return row
-    return decode_row
 
+TableData = namedtuple('TableData', ['table', 'columns', 'column_types', 'rows'])
 
 
-class ModelManager(object):
-    def __init__(self, org_id, archive, db, ignore_dupes):
-        self.org_id = org_id
-        self.db = db
+class JSONTableReader(object):
+    """
+    Incrementally parses a JSON table document written by write_json_table. The header fields are read
+    up front, and the rows array is decoded one row at a time as it's iterated, so memory use is bounded
+    by the size of a row rather than the size of the table.
+
+    Rows can only be streamed once the table and columns have been read. Should the rows array precede
+    them, it is decoded in full instead.
+    """
+
+    # The size of the blocks read from the underlying file
+    BLOCK_SIZE = 64 * 1024
+
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, fp):
+        self.fp = fp
+
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def read(self):
+        header = {}
+        rows = None
+
+        self._expect('{')
+
+        if self._peek() == '}':
+            self._pos = self._pos + 1
+        else:
+            while True:
+                key = self._value()
+                self._expect(':')
+
+                if key == 'rows' and self._peek() == '[' and 'table' in header and 'columns' in header:
+                    self._pos = self._pos + 1
+                    rows = self._iterate_rows()
+                    break
+
+                header[key] = self._value()
+
+                if self._expect(',}') == '}':
+                    break
+
+        if rows is None and type(header.get('rows')) == list:
+            rows = header['rows']
+
+        return TableData(header.get('table'), header.get('columns'), header.get('column_types'), rows)
+
+    def _iterate_rows(self):
+        if self._peek() == ']':
+            self._pos = self._pos + 1
+            return
+
+        while True:
+            yield self._value()
+
+            if self._expect(',]') == ']':
+                break
+
+    def _fill(self):
+        # Reads the next block into the buffer, discarding the data already parsed. Returns False once
+        # the end of the file has been reached.
+        if self._eof:
+            return False
+
+        block = self.fp.read(JSONTableReader.BLOCK_SIZE)
+        self._eof = not block
+
+        self._buffer = self._buffer[self._pos:] + self._utf8.decode(block, final=self._eof)
+        self._pos = 0
+
+        return True
+
+    def _peek(self):
+        # Skips any whitespace, returning the next character, or an empty string at the end of the file
+        while True:
+            self._pos = JSONTableReader.WHITESPACE.match(self._buffer, self._pos).end()
+
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        char = self._peek()
+
+        if char == '' or char not in chars:
+            raise Exception("Malformed JSON table; expected one of %r but found %r" % (chars, char))
+
+        self._pos = self._pos + 1
+        return char
+
+    def _value(self):
+        self._peek()
+
+        while True:
+            try:
+                (value, end) = self._decoder.raw_decode(self._buffer, self._pos)
+
+                # A number ending at the end of the buffer may continue in the next block
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+
+            self._fill()
+
+
+class JSONTableFormat(object):
+    """
+    Stores each table as a single JSON document. Byte columns are base64 encoded, and must be decoded
+    again during import.
+    """
+    name = 'json'
+    version = 1
+    extension = '.json'
+
+    def write(self, fp, table, columns, column_types, rows, batch_size=DEFAULT_BATCH_SIZE):
+        return write_json_table(fp, table, columns, column_types, rows, batch_size)
+
+    def read(self, fp):
+        return JSONTableReader(fp).read()
+
+
+class ColumnarTableFormat(object):
+    """
+    Stores each table as a sequence of chunks of typed columns:
+
+        entry   := MAGIC header_length:u32 header:json chunk* 0:u32
+        chunk   := row_count:u32 column*
+        column  := kind:u8 payload_length:u32 payload
+        payload := has_nulls:u8 [validity:u8 * row_count] values
+
+    The values of the non-null rows in a column are packed according to the column kind: booleans as
+    single bytes, integers and floats as little-endian 64-bit values, and text and byte columns as a
+    block of u32 lengths followed by the raw data. Byte columns are stored as-is rather than base64
+    encoded. All integers are little-endian.
+    """
+    name = 'columnar'
+    version = 2
+    extension = '.col'
+
+    MAGIC = b'CPCOL\x02'
+
+    KIND_NULL = 0
+    KIND_BOOL = 1
+    KIND_INT = 2
+    KIND_FLOAT = 3
+    KIND_TEXT = 4
+    KIND_BYTES = 5
+    KIND_JSON = 6
+
+    INT64_MIN = -(2 ** 63)
+    INT64_MAX = 2 ** 63 - 1
+
+    BYTE_TYPES = (bytes, bytearray, memoryview)
+    TEXT_TYPES = (str, datetime.datetime, datetime.date, datetime.time, decimal.Decimal)
+
+    def write(self, fp, table, columns, column_types, rows, batch_size=DEFAULT_BATCH_SIZE):
+        header = json.dumps({
+            'table':        table,
+            'columns':      list(columns),
+            'column_types': list(column_types)
+        }).encode('utf-8')
+
+        fp.write(ColumnarTableFormat.MAGIC + struct.pack('<I', len(header)) + header)
+
+        count = 0
+        for chunk in iterate_batches(rows, batch_size):
+            fp.write(struct.pack('<I', len(chunk)))
+
+            for values in zip(*chunk):
+                (kind, payload) = self._encode_column(values)
+                fp.write(struct.pack('<BI', kind, len(payload)))
+                fp.write(payload)
+
+            count = count + len(chunk)
+
+        fp.write(struct.pack('<I', 0))
+
+        return count
+
+    def read(self, fp):
+        magic = self._read_bytes(fp, len(ColumnarTableFormat.MAGIC))
+        if magic != ColumnarTableFormat.MAGIC:
+            raise Exception("Malformed columnar table; unexpected magic: %r" % (magic,))
+
+        (header_length,) = struct.unpack('<I', self._read_bytes(fp, 4))
+        header = json.loads(self._read_bytes(fp, header_length).decode('utf-8'))
+
+        rows = self._read_rows(fp, len(header.get('columns') or []))
+        return TableData(header.get('table'), header.get('columns'), header.get('column_types'), rows)
+
+    def _read_rows(self, fp, column_count):
+        while True:
+            (count,) = struct.unpack('<I', self._read_bytes(fp, 4))
+            if count == 0:
+                break
+
+            columns = []
+            for idx in range(column_count):
+                (kind, length) = struct.unpack('<BI', self._read_bytes(fp, 5))
+                columns.append(self._decode_column(kind, self._read_bytes(fp, length), count))
+
+            for row in zip(*columns):
+                yield list(row)
+
+    def _read_bytes(self, fp, length):
+        # Decompressing streams may return fewer bytes than requested, so keep reading until we have
+        # the full block or hit the end of the entry
+        data = fp.read(length)
+
+        while len(data) < length:
+            block = fp.read(length - len(data))
+
+            if not block:
+                raise Exception("Malformed columnar table; unexpected end of data")
+
+            data = data + block
+
+        return data
+
+    def _column_kind(self, values):
+        if len(values) < 1:
+            return ColumnarTableFormat.KIND_NULL
+
+        types = set(type(value) for value in values)
+
+        if types == {bool}:
+            return ColumnarTableFormat.KIND_BOOL
+
+        # Columns mixing booleans and integers, or holding integers too large for 64 bits, fall through
+        # to JSON, which preserves both exactly
+        if types == {int} and min(values) >= ColumnarTableFormat.INT64_MIN and max(values) <= ColumnarTableFormat.INT64_MAX:
+            return ColumnarTableFormat.KIND_INT
+
+        if types == {float}:
+            return ColumnarTableFormat.KIND_FLOAT
+
+        if all(issubclass(t, ColumnarTableFormat.BYTE_TYPES) for t in types):
+            return ColumnarTableFormat.KIND_BYTES
+
+        if all(issubclass(t, ColumnarTableFormat.TEXT_TYPES) for t in types):
+            return ColumnarTableFormat.KIND_TEXT
+
+        return ColumnarTableFormat.KIND_JSON
+
+    def _encode_column(self, column):
+        values = [value for value in column if value is not None]
+        kind = self._column_kind(values)
+
+        if len(values) == len(column):
+            head = b'\x00'
+        else:
+            head = b'\x01' + bytes(bytearray(value is not None for value in column))
+
+        if kind == ColumnarTableFormat.KIND_BOOL:
+            data = bytes(bytearray(values))
+        elif kind == ColumnarTableFormat.KIND_INT:
+            data = struct.pack('<%dq' % (len(values),), *values)
+        elif kind == ColumnarTableFormat.KIND_FLOAT:
+            data = struct.pack('<%dd' % (len(values),), *values)
+        elif kind == ColumnarTableFormat.KIND_TEXT:
+            data = self._pack_blobs([(value if isinstance(value, str) else str(value)).encode('utf-8') for value in values])
+        elif kind == ColumnarTableFormat.KIND_BYTES:
+            data = self._pack_blobs([bytes(value) for value in values])
+        elif kind == ColumnarTableFormat.KIND_JSON:
+            data = self._pack_blobs([json.dumps(value, default=json_data_converter).encode('utf-8') for value in values])
+        else:
+            data = b''
+
+        return (kind, head + data)
+
+    def _pack_blobs(self, blobs):
+        return struct.pack('<%dI' % (len(blobs),), *(len(blob) for blob in blobs)) + b''.join(blobs)
+
+    def _unpack_blobs(self, data, offset, count):
+        lengths = struct.unpack_from('<%dI' % (count,), data, offset)
+        offset = offset + 4 * count
+
+        blobs = []
+        for length in lengths:
+            blobs.append(data[offset:offset + length])
+            offset = offset + length
+
+        return blobs
+
+    def _decode_column(self, kind, payload, count):
+        offset = 1
+        present = None
+
+        if payload[0]:
+            present = payload[1:1 + count]
+            offset = offset + count
+
+        size = count if present is None else count - present.count(0)
+
+        if kind == ColumnarTableFormat.KIND_BOOL:
+            values = [value != 0 for value in payload[offset:offset + size]]
+        elif kind == ColumnarTableFormat.KIND_INT:
+            values = list(struct.unpack_from('<%dq' % (size,), payload, offset))
+        elif kind == ColumnarTableFormat.KIND_FLOAT:
+            values = list(struct.unpack_from('<%dd' % (size,), payload, offset))
+        elif kind == ColumnarTableFormat.KIND_TEXT:
+            values = [blob.decode('utf-8') for blob in self._unpack_blobs(payload, offset, size)]
+        elif kind == ColumnarTableFormat.KIND_BYTES:
+            values = self._unpack_blobs(payload, offset, size)
+        elif kind == ColumnarTableFormat.KIND_JSON:
+            values = [json.loads(blob.decode('utf-8')) for blob in self._unpack_blobs(payload, offset, size)]
+        elif kind == ColumnarTableFormat.KIND_NULL:
+            values = []
+        else:
+            raise Exception("Malformed columnar table; unknown column kind: %d" % (kind,))
+
+        if present is None:
+            return values
+
+        iterator = iter(values)
+        return [next(iterator) if flag else None for flag in present]
+
+
+TABLE_FORMATS = {
+    JSONTableFormat.name:       JSONTableFormat(),
+    ColumnarTableFormat.name:   ColumnarTableFormat()
+}
+
+# The name of the archive entry describing the format and tables of an archive. Archives created before
+# the manifest was introduced are all JSON.
+MANIFEST_FILE = 'manifest.json'
+
+# Maps the supported archive compression codecs to the zip compression method used to store entries.
+# zipfile does not support zstd, so zstd entries are compressed by us and stored in the archive as-is.
+COMPRESSION_CODECS = {
+    'none':     zipfile.ZIP_STORED,
+    'deflate':  zipfile.ZIP_DEFLATED,
+    'bzip2':    zipfile.ZIP_BZIP2,
+    'lzma':     zipfile.ZIP_LZMA,
+    'zstd':     zipfile.ZIP_STORED
+}
+
+# The range of compression levels accepted by each codec; codecs which are not listed have no levels
+COMPRESSION_LEVELS = {
+    'deflate':  (0, 9),
+    'bzip2':    (1, 9),
+    'zstd':     (1, 22)
+}
+
+DEFAULT_COMPRESSION = 'deflate'
+
+# The kinds of entries recorded in the archive manifest: table data, the complete primary key set of a
+# table in a delta export, and the keys of the rows deleted from a table since the previous export
+ENTRY_KIND_DATA = 'data'
+ENTRY_KIND_KEYS = 'keys'
+ENTRY_KIND_DELETIONS = 'deletions'
+DEFAULT_ZSTD_LEVEL = 3
+
+
+def import_zstd():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        raise Exception("zstd compression requires the zstandard package")
+
+
+
+class CountingWriter(object):
+    """
+    Wraps a writable file object, counting the bytes written through it
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.count = 0
+
+    def write(self, data):
+        self.count = self.count + len(data)
+        return self.fp.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+
+class ArchiveWriter(object):
+    """
+    Wraps the zip archive an export is written to. A zip file only allows a single entry to be open for
+    writing at a time, so when spool is set, each entry is first staged in a temporary file and copied
+    into the archive once complete. This allows multiple threads to write entries concurrently.
+
+    When the archive is compressed, entries are always spooled, and compressed into the archive by a
+    background thread so compression of one table overlaps the fetching of the next.
+    """
+
+    # The size of the blocks to use when copying spooled entries into the archive
+    COPY_BLOCK_SIZE = 1024 * 1024
+
+    # The amount of data a spooled entry may hold in memory before it is rolled over to disk
+    SPOOL_MEMORY_LIMIT = 16 * 1024 * 1024
+
+    # The maximum number of completed entries which may be waiting on the background writer
+    MAX_PENDING_ENTRIES = 4
+
+    def __init__(self, archive, table_format=JSONTableFormat.name, spool=False, batch_size=DEFAULT_BATCH_SIZE,
+        compression=DEFAULT_COMPRESSION, compression_level=None, metrics=None):
+
         self.archive = archive
-        self.ignore_dupes = ignore_dupes
+        self.metrics = metrics
+        self.format = TABLE_FORMATS[table_format]
+        self.batch_size = batch_size
+        self.compression = compression
+        self.compression_level = compression_level
+
+        background = compression != 'none'
+        self.spool = spool or background
+
+        self.manifest = {
+            'format_version':   self.format.version,
+            'compression':      compression,
+            'entries':          {}
+        }
 
-        self._imported = False
-        self._exported = False
+        self._lock = threading.Lock()
+        self._zstd = import_zstd() if compression == 'zstd' else None
+
+        self._pending = None
+        self._writer = None
+        self._error = None
+
+        if background:
+            self._pending = queue.Queue(maxsize=ArchiveWriter.MAX_PENDING_ENTRIES)
+            self._writer = threading.Thread(target=self._write_pending_entries, name='archive-writer')
+            self._writer.daemon = True
+            self._writer.start()
+
+    def write_table(self, file, table, columns, column_types, rows, kind=ENTRY_KIND_DATA):
+        """
+        Writes a table to the archive in this writer's format, returning the number of rows written.
+        The entry is recorded in the manifest under the given file name, which is used to look up the
+        table during import regardless of the name and format of the entry backing it.
+        """
+        entry = os.path.splitext(file)[0] + self.format.extension
+
+        if self.metrics is not None:
+            self.metrics.start_entry(file, table)
+            rows = self.metrics.track_rows(file, rows, self.batch_size)
+
+        with self.open_entry(entry) as fp:
+            fp = CountingWriter(fp)
+            count = self.format.write(fp, table, columns, column_types, rows, self.batch_size)
+
+        if self.metrics is not None:
+            self.metrics.finish_entry(file, fp.count)
+
+        with self._lock:
+            self.manifest['entries'][file] = {
+                'entry':        entry,
+                'kind':         kind,
+                'format':       self.format.name,
+                'codec':        self.compression,
+                'table':        table,
+                'columns':      list(columns),
+                'column_types': list(column_types),
+                'rows':         count
+            }
 
-    def do_export(self):
-        raise NotImplementedError("Not yet implemented")
+        return count
+
+    def annotate(self, key, value):
+        """
+        Sets a top-level property of the archive manifest
+        """
+        with self._lock:
+            self.manifest[key] = value
+
+    def annotate_primary_key(self, table, key_columns):
+        with self._lock:
+            self.manifest.setdefault('primary_keys', {})[table] = list(key_columns)
+
+    @contextmanager
+    def open_entry(self, file):
+        if not self.spool:
+            with self._lock:
+                with self._open_archive_entry(file) as fp:
+                    yield fp
+        else:
+            spool = tempfile.SpooledTemporaryFile(max_size=ArchiveWriter.SPOOL_MEMORY_LIMIT)
 
-    def do_import(self):
-        raise NotImplementedError("Not yet implemented")
+            try:
+                yield spool
+            except:
+                spool.close()
+                raise
 
-    def depends_on(self):
-        return []
+            if self._writer is not None:
+                self._check_writer()
+                self._pending.put((file, spool))
+            else:
+                try:
+                    with self._lock:
+                        self._copy_into_archive(file, spool)
+                finally:
+                    spool.close()
+
+    def _write_pending_entries(self):
+        while True:
+            item = self._pending.get()
+
+            if item is None:
+                break
+
+            (file, spool) = item
+
+            try:
+                # Once an entry fails, there's no point in writing the rest; just drain the queue so
+                # producers don't block
+                if self._error is None:
+                    self._copy_into_archive(file, spool)
+            except Exception as e:
+                log.error('Unable to write entry to archive: %s', file)
+                self._error = e
+            finally:
+                spool.close()
+
+    def _check_writer(self):
+        if self._error is not None:
+            raise self._error
+
+    def _copy_into_archive(self, file, spool):
+        spool.seek(0)
+
+        with self._open_archive_entry(file) as fp:
+            if self._zstd is not None:
+                level = self.compression_level if self.compression_level is not None else DEFAULT_ZSTD_LEVEL
+                self._zstd.ZstdCompressor(level=level).copy_stream(spool, fp, read_size=ArchiveWriter.COPY_BLOCK_SIZE)
+            else:
+                shutil.copyfileobj(spool, fp, ArchiveWriter.COPY_BLOCK_SIZE)
+
+    def _open_archive_entry(self, file):
+        # Entries take the codec and level the archive was opened with. The final size of the entry is
+        # unknown up front, so we need to force zip64 extensions to allow entries larger than 2GB.
+        return self.archive.open(file, mode='w', force_zip64=True)
+
+    def close(self):
+        if self._writer is not None:
+            self._pending.put(None)
+            self._writer.join()
+            self._writer = None
+
+            self._check_writer()
+
+        if self.archive.fp is not None:
+            self.archive.writestr(MANIFEST_FILE, json.dumps(self.manifest, indent=2, sort_keys=True), zipfile.ZIP_DEFLATED)
+            self.archive.close()
+
+            if self.metrics is not None:
+                for (file, details) in self.manifest['entries'].items():
+                    self.metrics.set_stored_size(file, self.archive.getinfo(details['entry']).compress_size)
+
+
+
+class ArchiveReader(object):
+    """
+    Wraps the zip archive an import is read from, detecting the format of each table from the archive
+    manifest
+    """
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.manifest = None
+
+        # The tables read from the archive, in the order they were first read
+        self.read_order = []
+
+        if MANIFEST_FILE in self.archive.namelist():
+            self.manifest = json.loads(self.archive.read(MANIFEST_FILE).decode('utf-8'))
+
+            for entry in self.manifest.get('entries', {}).values():
+                if entry.get('format') not in TABLE_FORMATS:
+                    raise Exception("Unsupported table format in archive: %s" % (entry.get('format'),))
 
     @property
-    def exported(self):
-        return self._exported
+    def format_version(self):
+        if self.manifest is None:
+            return JSONTableFormat.version
+
+        return self.manifest.get('format_version')
 
     @property
-    def imported(self):
-        return self._imported
+    def exported_at(self):
+        """
+        The database time at which the archive was exported, or None if the archive does not record it
+        """
+        return self.manifest.get('exported_at') if self.manifest is not None else None
+
+    @property
+    def is_delta(self):
+        return self.manifest is not None and self.manifest.get('delta') is not None
+
+    def get_primary_key(self, table):
+        """
+        Returns the primary key columns recorded for the given table, or None if the archive doesn't
+        record them
+        """
+        if self.manifest is None:
+            return None
+
+        return self.manifest.get('primary_keys', {}).get(table)
+
+    def get_entries(self, kind=ENTRY_KIND_DATA, table=None):
+        """
+        Returns the file names of the entries of the given kind, optionally limited to the given table
+        """
+        if self.manifest is None:
+            if kind != ENTRY_KIND_DATA:
+                return []
+
+            return [os.path.splitext(name)[0] + '.json' for name in self.archive.namelist()]
+
+        return sorted(file for (file, details) in self.manifest['entries'].items()
+            if details.get('kind', ENTRY_KIND_DATA) == kind and (table is None or details.get('table') == table))
+
+    def get_tables(self, kind=ENTRY_KIND_DATA):
+        """
+        Returns the names of the tables with entries of the given kind, without duplicates
+        """
+        tables = OrderedDict()
+
+        for file in self.get_entries(kind):
+            if self.manifest is not None:
+                tables[self.manifest['entries'][file]['table']] = True
+            else:
+                with self.read_table(file) as data:
+                    tables[data.table] = True
+
+        return list(tables)
+
+    @contextmanager
+    def read_table(self, file):
+        """
+        Opens the table recorded under the given file name, yielding a TableData tuple. The rows of the
+        table may be read lazily, and must be consumed before the context exits. Raises a KeyError if
+        the archive does not contain the table.
+        """
+        codec = None
+
+        if self.manifest is not None:
+            if file not in self.manifest['entries']:
+                raise KeyError("There is no item named %r in the archive" % (file,))
+
+            details = self.manifest['entries'][file]
+            (entry, table_format, codec) = (details['entry'], TABLE_FORMATS[details['format']], details.get('codec'))
+        else:
+            (entry, table_format) = (file, TABLE_FORMATS[JSONTableFormat.name])
+
+        with self.archive.open(entry) as fp:
+            if codec == 'zstd':
+                with import_zstd().ZstdDecompressor().stream_reader(fp) as zfp:
+                    data = table_format.read(zfp)
+                    self._record_read(data.table)
+
+                    yield data
+            else:
+                data = table_format.read(fp)
+                self._record_read(data.table)
+
+                yield data
+
+    def _record_read(self, table):
+        if table is not None and table not in self.read_order:
+            self.read_order.append(table)
+
+    def close(self):
+        self.archive.close()
+
+
+
+class DeltaTracker(object):
+    """
+    Tracks the state of a delta export: the time since which changed rows are exported, and the queries
+    selecting every row of each exported table. Once the changed rows have been exported, the complete
+    key set of each table is written to the archive so later deltas can diff against it, and any keys
+    present in the previous archive which no longer exist are recorded as deletions.
+    """
+
+    # The columns used to determine whether or not a row has changed since the previous export
+    TIMESTAMP_COLUMNS = ['created', 'updated']
+
+    def __init__(self, since, previous=None):
+        self.since = since
+        self.previous = previous
+
+        self._sources = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def tables(self):
+        with self._lock:
+            return list(self._sources.keys())
+
+    def add_key_source(self, table, query, params=()):
+        """
+        Registers a query selecting rows of the given table which are part of the export. The union of
+        the rows selected by every query registered for a table makes up its complete key set.
+        """
+        with self._lock:
+            self._sources.setdefault(table, []).append((query, params))
+
+    def filter_query(self, db, table, query, params, order_by=None):
+        """
+        Wraps the given query so it only selects rows created or updated since the delta timestamp.
+        Tables lacking timestamp columns can't be filtered, and are always exported in full.
+        """
+        columns = [col for col in DeltaTracker.TIMESTAMP_COLUMNS if col in db.get_table_columns(table)]
+
+        if len(columns) < 1:
+            log.debug('Table has no timestamp columns; exporting all rows: %s', table)
+            return (query, params)
+
+        query = 'SELECT * FROM (' + query + ') delta_src WHERE ' + ' OR '.join(('delta_src.%s > %%s' % (col,) for col in columns))
+
+        if order_by is not None:
+            query = query + ' ORDER BY delta_src.' + order_by
+
+        return (query, tuple(params) + (self.since,) * len(columns))
+
+    def export_keys(self, db, archive, table, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Writes the complete key set of the given table to the archive, along with the keys of any rows
+        deleted since the previous export if a previous archive is available
+        """
+        key_columns = db.get_primary_key(table)
+
+        if len(key_columns) < 1:
+            log.warning('Table has no primary key; deletions cannot be tracked: %s', table)
+            return False
+
+        validate_column_names(table, key_columns)
+        archive.annotate_primary_key(table, key_columns)
+
+        previous_keys = self._read_previous_keys(table, key_columns)
+        projection = 'SELECT ' + ', '.join(('delta_keys.' + col for col in key_columns)) + ' FROM ('
+
+        def iterate_keys():
+            for (query, params) in self._sources[table]:
+                cursor = db.execQuery(projection + query + ') delta_keys', params, server_side=True)
+
+                for row in iterate_cursor(cursor, batch_size):
+                    if previous_keys is not None:
+                        previous_keys.discard(tuple(row))
+
+                    yield row
+
+                cursor.close()
+
+        key_types = [None] * len(key_columns)
+
+        count = archive.write_table('keys/%s.json' % (table,), table, key_columns, key_types, iterate_keys(), ENTRY_KIND_KEYS)
+        log.debug('Exported %d keys for table: %s', count, table)
+
+        if previous_keys is not None:
+            count = archive.write_table('deleted/%s.json' % (table,), table, key_columns, key_types, sorted(previous_keys), ENTRY_KIND_DELETIONS)
+            log.debug('Exported %d deletions for table: %s', count, table)
+
+        return True
+
+    def _read_previous_keys(self, table, key_columns):
+        if self.previous is None:
+            return None
+
+        # Delta archives record the complete key set of each table; full archives contain every row,
+        # so the key set can be pulled from the table data itself
+        files = self.previous.get_entries(ENTRY_KIND_KEYS, table)
+        if len(files) < 1:
+            files = self.previous.get_entries(ENTRY_KIND_DATA, table)
+
+        keys = set()
+
+        for file in files:
+            with self.previous.read_table(file) as data:
+                if data.table != table:
+                    continue
+
+                if not all(col in data.columns for col in key_columns):
+                    log.warning('Previous archive lacks key columns for table; deletions cannot be tracked: %s', table)
+                    return None
+
+                indexes = [data.columns.index(col) for col in key_columns]
+                for row in data.rows:
+                    keys.add(tuple(row[idx] for idx in indexes))
+
+        return keys
+
+
+
+class SharedTableCache(object):
+    """
+    Caches the contents of reference tables which are not specific to any org, such that exporting a
+    batch of orgs to separate archives only reads each of them from the database once
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, db, table, query, params=()):
+        key = (table, query, tuple(params))
+
+        with self._lock:
+            if key not in self._tables:
+                cursor = db.execQuery(query, params)
+                rows = cursor.fetchall()
+
+                self._tables[key] = TableData(table, get_cursor_columns(db, cursor), get_cursor_column_types(db, cursor), rows)
+                cursor.close()
+
+            return self._tables[key]
+
+
+
+class MigrationMetrics(object):
+    """
+    Collects timing and throughput statistics for a migration: the latency of each distinct query, and
+    the rows, bytes, duration and time to first row of each archive entry. The statistics drive the
+    progress display, and are written out as a JSON report once the migration is complete.
+
+    When counting is set, the rows each export query will produce are counted up front so progress can
+    be reported against a known total.
+    """
+
+    def __init__(self, operation, counting=False):
+        self.operation = operation
+        self.counting = counting
+
+        self.started = time.time()
+        self.finished = None
+        self.rows = 0
+        self.expected_rows = 0
+
+        self._queries = OrderedDict()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record_query(self, query, elapsed, calls=1):
+        # Whitespace is collapsed so the same statement built over several lines is recorded once
+        query = ' '.join(query.split())
+
+        with self._lock:
+            stats = self._queries.get(query)
+
+            if stats is None:
+                stats = self._queries[query] = {'query': query, 'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+
+            stats['calls'] = stats['calls'] + calls
+            stats['seconds'] = stats['seconds'] + elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed / calls)
+
+    def expect_rows(self, count):
+        with self._lock:
+            self.expected_rows = self.expected_rows + count
+
+    def start_entry(self, file, table):
+        with self._lock:
+            if file not in self._entries:
+                self._entries[file] = {
+                    'file':         file,
+                    'table':        table,
+                    'started':      time.time(),
+                    'first_row':    None,
+                    'finished':     None,
+                    'rows':         0,
+                    'bytes':        None,
+                    'stored_bytes': None
+                }
+
+    def finish_entry(self, file, size=None):
+        with self._lock:
+            entry = self._entries[file]
+            entry['finished'] = time.time()
+
+            if size is not None:
+                entry['bytes'] = size
+
+    def set_stored_size(self, file, size):
+        with self._lock:
+            if file in self._entries:
+                self._entries[file]['stored_bytes'] = size
+
+    def track_rows(self, file, rows, block_size=DEFAULT_BATCH_SIZE):
+        """
+        Wraps the given row iterable, counting the rows passing through it against the given entry. The
+        shared counters are only updated once per block of rows to keep the overhead negligible.
+        """
+        entry = self._entries[file]
+        count = 0
+
+        for row in rows:
+            if entry['first_row'] is None:
+                entry['first_row'] = time.time()
+
+            yield row
+            count = count + 1
+
+            if count >= block_size:
+                self._add_rows(entry, count)
+                count = 0
+
+        self._add_rows(entry, count)
+
+    def _add_rows(self, entry, count):
+        with self._lock:
+            entry['rows'] = entry['rows'] + count
+            self.rows = self.rows + count
+
+    def finish(self):
+        self.finished = time.time()
+
+    def get_progress(self):
+        """
+        Returns a tuple containing the number of rows processed, the number of rows expected (or None if
+        unknown), the average rows per second, and the estimated seconds remaining (or None if unknown)
+        """
+        elapsed = (self.finished or time.time()) - self.started
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+
+        if self.expected_rows < 1:
+            return (self.rows, None, rate, None)
+
+        remaining = max(self.expected_rows - self.rows, 0)
+        eta = remaining / rate if rate > 0 else None
+
+        return (self.rows, self.expected_rows, rate, eta)
+
+    def report(self):
+        end = self.finished or time.time()
+
+        with self._lock:
+            entries = []
+            for entry in self._entries.values():
+                finished = entry['finished'] or end
+                seconds = finished - entry['started']
+
+                entries.append({
+                    'file':                 entry['file'],
+                    'table':                entry['table'],
+                    'rows':                 entry['rows'],
+                    'seconds':              round(seconds, 6),
+                    'rows_per_second':      round(entry['rows'] / seconds, 2) if seconds > 0 else None,
+                    'time_to_first_row':    round(entry['first_row'] - entry['started'], 6) if entry['first_row'] is not None else None,
+                    'bytes':                entry['bytes'],
+                    'stored_bytes':         entry['stored_bytes']
+                })
+
+            queries = [dict(stats, seconds=round(stats['seconds'], 6), max_seconds=round(stats['max_seconds'], 6))
+                for stats in self._queries.values()]
+
+        return {
+            'operation':        self.operation,
+            'started':          datetime.datetime.fromtimestamp(self.started).isoformat(),
+            'seconds':          round(end - self.started, 6),
+            'rows':             self.rows,
+            'expected_rows':    self.expected_rows if self.expected_rows > 0 else None,
+            'entries':          sorted(entries, key=lambda entry: entry['seconds'], reverse=True),
+            'queries':          sorted(queries, key=lambda stats: stats['seconds'], reverse=True)
+        }
+
+    def write_report(self, file):
+        with open(file, 'w') as fp:
+            json.dump(self.report(), fp, indent=2)
+
+        log.info('Wrote timing report to file: %s', file)
+
+
+
+class ProgressReporter(object):
+    """
+    Periodically reports the progress of a migration from its metrics. On a terminal the progress is
+    redrawn in place on stderr; otherwise it is logged.
+    """
+
+    def __init__(self, metrics, interval=2.0):
+        self.metrics = metrics
+        self.interval = interval
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._interactive = sys.stderr.isatty()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='org_migrator-progress')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+            self._report(final=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._report()
+
+    def _report(self, final=False):
+        (rows, expected, rate, eta) = self.metrics.get_progress()
+
+        if expected is not None:
+            message = '%s: %d/%d rows (%.1f%%), %.0f rows/s, ETA %s' % (self.metrics.operation, rows, expected,
+                min(100.0 * rows / expected, 100.0), rate, datetime.timedelta(seconds=int(eta)) if eta is not None else '?')
+        else:
+            message = '%s: %d rows, %.0f rows/s' % (self.metrics.operation, rows, rate)
+
+        if self._interactive:
+            sys.stderr.write('\r\033[K' + message + ('\n' if final else ''))
+            sys.stderr.flush()
+        else:
+            log.info(message)
+
+
+
+class StagingArea(object):
+    """
+    Manages the temporary tables used to stage intermediate results during export, such as the set of
+    content UUIDs referenced by an org. Temporary tables are only visible to the connection which
+    created them, and PostgreSQL does not allow creating tables in a read-only transaction, so the
+    tables must be created on each connection before its export transaction begins. Rows may still be
+    written to them from within the transaction.
+    """
+
+    TABLES = OrderedDict([
+        ('org_migrator_content', '(uuid VARCHAR(64) NOT NULL PRIMARY KEY)')
+    ])
+
+    def __init__(self):
+        self._prepared = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def prepare(self, db):
+        """
+        Creates the staging tables on the given connection, which must not be in a transaction
+        """
+        with self._lock:
+            if db in self._prepared:
+                return
+
+            if db.in_transaction():
+                log.warning('Unable to prepare staging tables on a connection with an active transaction')
+                return
+
+            for (table, definition) in StagingArea.TABLES.items():
+                db.execUpdate('CREATE TEMPORARY TABLE ' + table + ' ' + definition)
+
+            self._prepared.add(db)
+
+    def is_prepared(self, db):
+        with self._lock:
+            return db in self._prepared
+
+
+
+class QueryExplainer(object):
+    """
+    Collects the queries an export would run, and audits their execution plans for operations which
+    are likely to be expensive on large orgs, such as sequential scans and sorts
+    """
+
+    def __init__(self, analyze=False):
+        self.analyze = analyze
+        self.queries = OrderedDict()
+
+    def add(self, file, table, query, params=(), setup=()):
+        """
+        Adds a query to explain. Any setup statements, given as (statement, params) tuples, are executed
+        before the query is explained, such as to populate the staging tables it reads from.
+        """
+        self.queries[file] = (table, query, params, setup)
+
+    def run(self, db):
+        """
+        Explains every collected query on the given connection, logging the plans and any operations
+        flagged. Returns a list of dictionaries describing the plan of each query.
+        """
+        results = []
+
+        for (file, (table, query, params, setup)) in self.queries.items():
+            for (statement, statement_params) in setup:
+                log.debug('Setup: %s', ' '.join(statement.split()))
+                db.execUpdate(statement, statement_params)
+
+            plan = db.explain(query, params, self.analyze)
+            warnings = db.get_plan_warnings(plan)
+
+            if len(warnings) > 0:
+                log.warning('Query for %s: %s', file, ', '.join(warnings))
+            else:
+                log.info('Query for %s: no issues found', file)
+
+            log.debug('Query: %s', ' '.join(query.split()))
+            for line in plan:
+                log.debug('  %s', line)
+
+            results.append({'file': file, 'table': table, 'query': ' '.join(query.split()), 'warnings': warnings, 'plan': plan})
+
+        flagged = len([result for result in results if len(result['warnings']) > 0])
+        log.info('Explained %d queries; %d flagged', len(results), flagged)
+
+        return results
+
+
+
+class ExportWorkerPool(object):
+    """
+    Runs export jobs concurrently over a pool of database connections. Every connection in the pool
+    shares the snapshot of the transaction active on the primary connection, so the data exported by
+    each job is consistent with that of every other job. The connections are checked out of a
+    ConnectionPool created with the given factory for as long as the worker pool is open.
+    """
+
+    def __init__(self, db, connect, jobs, setup=None):
+        self.db = db
+        self.connect = connect
+        self.jobs = jobs
+        self.setup = setup
+
+        self._pool = None
+        self._workers = []
+        self._idle = queue.Queue()
+        self._futures = []
+        self._executor = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def open(self):
+        log.debug('Opening %d worker connections', self.jobs)
+        snapshot = self.db.export_snapshot()
+        lock_db = None
+
+        # One more connection than there are workers is needed to lock the tables
+        self._pool = cp.ConnectionPool(self.connect, max_size=self.jobs + 1)
+
+        if snapshot is None:
+            # The backend can't share snapshots, so we need to block writes while the worker
+            # transactions are started to ensure they all see the same data. Without the lock the
+            # workers' snapshots could differ, so the export can't continue.
+            lock_db = self._pool.acquire()
+
+            try:
+                lock_db.lock_all_tables()
+            except Exception as e:
+                lock_db.release()
+                self.close()
+
+                raise Exception("Unable to lock tables for a consistent export across %d connections; grant the RELOAD privilege or use --jobs 1: %s" %
+                    (self.jobs, e))
+
+        try:
+            # The primary's transaction was started before the lock was taken, so it's restarted while the
+            # lock is held to take the same snapshot as the workers
+            if lock_db is not None and self.db.in_transaction():
+                self.db.rollback()
+                self.db.start_transaction(readonly=True, consistent=True)
+
+            for i in range(self.jobs):
+                worker = self._pool.acquire()
+                worker.itersize = self.db.itersize
+                worker.query_listener = self.db.query_listener
+                self._workers.append(worker)
+
+                if callable(self.setup):
+                    self.setup(worker)
+
+                worker.start_transaction(readonly=True, consistent=True, snapshot=snapshot)
+                self._idle.put(worker)
+        finally:
+            if lock_db is not None:
+                if not lock_db.is_closed():
+                    lock_db.unlock_all_tables()
+
+                lock_db.release()
+
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+    def submit(self, job, *args):
+        future = self._executor.submit(self._run, job, args)
+        self._futures.append(future)
+
+        return future
+
+    def _run(self, job, args):
+        db = self._idle.get()
+
+        try:
+            return job(db, *args)
+        finally:
+            self._idle.put(db)
+
+    def wait(self):
+        """
+        Waits for all submitted jobs to complete, raising the first error encountered by any of them
+        """
+        (futures, self._futures) = (self._futures, [])
+
+        try:
+            for future in futures:
+                future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+
+            raise
+
+        return True
+
+    def close(self):
+        if self._executor is not None:
+            for future in self._futures:
+                future.cancel()
+
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+        # Nothing is written by the workers, so releasing them rolls back their transactions
+        for worker in self._workers:
+            worker.release()
+
+        self._workers = []
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+
+
+class DeferredExecutor(object):
+    """
+    Collects the jobs submitted to it rather than running them, so they can be started together later
+    """
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, job, *args):
+        self.jobs.append((job, args))
+
+    def run(self, pool, db):
+        """
+        Submits the collected jobs to the given worker pool, or runs them in order on the given
+        connection if there is no pool
+        """
+        (jobs, self.jobs) = (self.jobs, [])
+
+        for (job, args) in jobs:
+            if pool is not None:
+                pool.submit(job, *args)
+            else:
+                job(db, *args)
+
+
+
+class IndexRebuilder(object):
+    """
+    Drops the secondary indexes of the tables being imported before the import begins, and rebuilds
+    them once it has ended, so each index is built once from the imported data rather than maintained
+    through every insert. Indexes enforcing a constraint are left in place, as they're needed to detect
+    duplicate rows during import.
+
+    The definitions of the indexes are written to a file before any index is dropped, and the file is
+    removed once they've all been rebuilt, so the indexes can be recreated by hand should the migrator
+    be interrupted. Indexes are rebuilt concurrently over the given number of connections from the
+    given ConnectionPool.
+    """
+
+    def __init__(self, db, pool, jobs, tables, definitions_file):
+        self.db = db
+        self.pool = pool
+        self.jobs = jobs
+        self.tables = tables
+        self.definitions_file = definitions_file
+
+        self.dropped = []
+
+    def drop(self):
+        """
+        Drops the secondary indexes of the tables, recording their definitions. Some backends commit
+        any active transaction when an index is dropped, so this must be called before the import
+        transaction is started.
+        """
+        indexes = [(table, name, definition) for table in self.tables for (name, definition) in self.db.get_secondary_indexes(table)]
+
+        # End the transaction the catalog queries may have implicitly started, or the import transaction
+        # can't be started afterward
+        self.db.commit()
+
+        if len(indexes) < 1:
+            log.info('No secondary indexes to drop')
+            return
+
+        with open(self.definitions_file, 'w') as fp:
+            json.dump([{'table': table, 'index': name, 'definition': definition} for (table, name, definition) in indexes], fp, indent=2)
+
+        for (table, name, definition) in indexes:
+            try:
+                self.db.drop_index(table, name)
+                self.db.commit()
+
+                self.dropped.append((table, name, definition))
+            except Exception as e:
+                # Some backends won't drop an index needed by a foreign key; such indexes just stay put
+                log.warning('Unable to drop index %s on table %s; leaving it in place: %s', name, table, e)
+
+        log.info('Dropped %d secondary indexes; their definitions were saved to: %s', len(self.dropped), self.definitions_file)
+
+    def rebuild(self):
+        """
+        Recreates the dropped indexes and updates the planner statistics of the tables, returning False
+        if any index could not be rebuilt. The import transaction must have ended before this is called,
+        so the connections building the indexes can see the imported data.
+        """
+        (dropped, self.dropped) = (self.dropped, [])
+
+        if len(dropped) < 1:
+            return True
+
+        log.info('Rebuilding %d secondary indexes', len(dropped))
+        start = time.time()
+
+        failed = self._run([partial(self._create_index, table, name, definition) for (table, name, definition) in dropped])
+        self._run([partial(self._analyze_table, table) for table in self.tables])
+
+        if failed > 0:
+            log.error('Unable to rebuild %d indexes; their definitions can be found in: %s', failed, self.definitions_file)
+            return False
+
+        os.remove(self.definitions_file)
+        log.info('Rebuilt secondary indexes in %.1f seconds', time.time() - start)
+
+        return True
+
+    def _run(self, tasks):
+        # Runs each task with a connection to run it on, returning the number of tasks which failed
+        if self.jobs < 2 or self.pool is None:
+            return sum(1 for task in tasks if not task(self.db))
+
+        def run(task):
+            with self.pool.acquire() as db:
+                db.query_listener = self.db.query_listener
+                return task(db)
+
+        with ThreadPoolExecutor(max_workers=min(self.jobs, len(tasks))) as executor:
+            return sum(1 for result in executor.map(run, tasks) if not result)
+
+    def _create_index(self, table, name, definition, db):
+        try:
+            db.execUpdate(definition)
+            db.commit()
+
+            log.debug('Rebuilt index %s on table: %s', name, table)
+            return True
+        except Exception as e:
+            log.error('Unable to rebuild index %s on table %s: %s', name, table, e)
+            return False
+
+    def _analyze_table(self, table, db):
+        try:
+            db.analyze_table(table)
+            db.commit()
+        except Exception as e:
+            log.warning('Unable to analyze table %s: %s', table, e)
+
+        return True
+
+
+
+class ImportCheckpoints(object):
+    """
+    Records the progress of a resumable import in a table in the target database, keyed by a hash of
+    the archive being imported. The rows of each archive entry are committed in chunks along with the
+    checkpoint covering them, so the recorded progress always matches the rows actually committed, and
+    an interrupted import can pick up where it stopped. The checkpoints of an archive are removed once
+    it has been imported in full.
+    """
+
+    TABLE = 'org_migrator_checkpoint'
+    COLUMNS = ['archive', 'entry', 'rows_imported', 'complete']
+
+    # The size of the blocks read when hashing the archive
+    HASH_BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, db, archive_file, chunk_size=DEFAULT_CHECKPOINT_ROWS):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.archive_hash = ImportCheckpoints.hash_file(archive_file)
+
+        self._progress = {}
+
+    @staticmethod
+    def hash_file(path):
+        digest = hashlib.sha256()
+
+        with open(path, 'rb') as fp:
+            for block in iter(partial(fp.read, ImportCheckpoints.HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+
+        return digest.hexdigest()
+
+    def prepare(self):
+        """
+        Creates the checkpoint table if necessary and loads the progress of any previous attempt at
+        importing the archive. This must be called before any transaction is started.
+        """
+        self.db.execUpdate('CREATE TABLE IF NOT EXISTS ' + ImportCheckpoints.TABLE + ' (' +
+            'archive VARCHAR(64) NOT NULL, entry VARCHAR(255) NOT NULL, rows_imported BIGINT NOT NULL, ' +
+            'complete BOOLEAN NOT NULL, PRIMARY KEY (archive, entry))')
+
+        cursor = self.db.execQuery('SELECT entry, rows_imported, complete FROM ' + ImportCheckpoints.TABLE + ' WHERE archive = %s',
+            (self.archive_hash,))
+
+        for (entry, rows, complete) in cursor:
+            self._progress[entry] = (rows, bool(complete))
+
+        cursor.close()
+        self.db.commit()
+
+        if self.resuming:
+            log.info('Resuming import of archive %s; %d of its files were already imported', self.archive_hash,
+                sum(1 for (rows, complete) in self._progress.values() if complete))
+
+    @property
+    def resuming(self):
+        """
+        Whether or not a previous attempt at importing the archive committed any of it
+        """
+        return len(self._progress) > 0
+
+    def get_progress(self, file):
+        """
+        Returns a tuple of the number of rows of the given archive entry which have been committed, and
+        whether or not the entry has been imported in full
+        """
+        return self._progress.get(file, (0, False))
+
+    def record(self, db, file, rows, complete=False):
+        """
+        Records the progress of the given archive entry. This must be done in the transaction committing
+        the rows it covers.
+        """
+        db.upsert_rows(ImportCheckpoints.TABLE, ImportCheckpoints.COLUMNS, ['archive', 'entry'],
+            [[self.archive_hash, file, rows, complete]])
+
+        self._progress[file] = (rows, complete)
+
+    def clear(self, db):
+        db.execUpdate('DELETE FROM ' + ImportCheckpoints.TABLE + ' WHERE archive = %s', (self.archive_hash,))
+        self._progress = {}
+
+
+
+class IDRemapper(object):
+    """
+    Assigns new IDs to imported rows whose primary keys collide with rows already present in the target
+    database, and rewrites every foreign key referencing them as the rows are streamed in, such that an
+    org can be merged into a database which shares some of its IDs.
+
+    Collisions are found before anything is imported, with one query per table: the keys of the table
+    are loaded from the archive into a staging table which is joined against the table itself. Only
+    tables with a single-column primary key are remapped, and foreign keys are read from the catalog.
+    The resulting map is written to a sidecar file, both as a record of the IDs changed and so that a
+    resumable import can be continued with the same IDs.
+
+    Colliding integer keys are numbered on from MAX(id) + 1 of the table and the archive, bypassing any
+    sequence backing the column, so advance_sequences must be called once the rows are imported.
+    """
+
+    # Tables whose imported rows are matched to existing rows by other means
+    MATCHED_TABLES = ['cp_consumer_type']
+
+    STAGING_PREFIX = 'org_migrator_remap_'
+
+    def __init__(self, db, archive, map_file, batch_size=DEFAULT_BATCH_SIZE):
+        self.db = db
+        self.archive = archive
+        self.map_file = map_file
+        self.batch_size = batch_size
+
+        # table => (key column, {old ID => new ID})
+        self.mapping = {}
+
+        # table => [(column, referenced table, referenced column)], for every table in the archive
+        self._foreign_keys = {}
+
+    def prepare(self, resuming=False):
+        """
+        Builds the map of the IDs to replace. If resuming, the map written by the previous attempt at
+        the import is reused. This must be called before any transaction is started.
+        """
+        if resuming and os.path.isfile(self.map_file):
+            with open(self.map_file, 'r') as fp:
+                self.mapping = {table: (key, dict((old, new) for (old, new) in ids)) for (table, (key, ids)) in json.load(fp).items()}
+
+            log.info('Reusing the ID map of the previous import: %s', self.map_file)
+        else:
+            self._build_mapping()
+
+        # Transforms are built as entries are imported, possibly on worker threads, so the catalog is
+        # read up front on the primary connection
+        if len(self.mapping) > 0:
+            self._foreign_keys = self._find_foreign_keys()
+
+    def _build_mapping(self):
+        keys = self._find_key_columns()
+
+        if len(keys) > 0:
+            token = uuid.uuid4().hex[:12]
+            stages = OrderedDict((table, '%s%s_%d' % (IDRemapper.STAGING_PREFIX, token, n)) for (n, table) in enumerate(keys))
+
+            try:
+                highest = self._stage_keys(keys, stages)
+
+                for (table, stage) in stages.items():
+                    collisions = self._find_collisions(table, keys[table], stage)
+
+                    if len(collisions) > 0:
+                        log.info('Remapping %d colliding IDs of table: %s', len(collisions), table)
+                        self.mapping[table] = (keys[table], self._assign_ids(table, keys[table], collisions, highest.get(table)))
+            finally:
+                for stage in stages.values():
+                    self.db.execUpdate('DROP TABLE IF EXISTS ' + stage)
+
+                self.db.commit()
+
+        with open(self.map_file, 'w') as fp:
+            json.dump({table: (key, list(ids.items())) for (table, (key, ids)) in self.mapping.items()}, fp)
+
+        log.info('Remapped %d IDs across %d tables; the ID map was written to: %s', sum(len(ids) for (key, ids) in self.mapping.values()),
+            len(self.mapping), self.map_file)
+
+    def get_transform(self, table, columns, chain=None):
+        """
+        Returns a transform which rewrites the remapped IDs of the given table's columns, followed by
+        the given transform or row hook
+        """
+        if len(self.mapping) < 1:
+            return chain
+
+        remapped = []
+
+        if table in self.mapping and self.mapping[table][0] in columns:
+            remapped.append((self.mapping[table][0], self.mapping[table][1]))
+
+        for (column, referenced_table, referenced_column) in self._foreign_keys.get(table, []):
+            if column in columns and referenced_table in self.mapping and self.mapping[referenced_table][0] == referenced_column:
+                remapped.append((column, self.mapping[referenced_table][1]))
+
+        for (column, ids) in remapped:
+            chain = RowTransform([column], partial(IDRemapper._remap, ids), chain)
+
+        return chain
+
+    @staticmethod
+    def _remap(ids, value):
+        return ids.get(value, value)
+
+    def advance_sequences(self):
+        """
+        Advances the sequences of the key columns which were assigned integer IDs past the IDs assigned,
+        so rows created later don't collide with the imported rows
+        """
+        for (table, (key, ids)) in self.mapping.items():
+            if any((isinstance(value, int) and not isinstance(value, bool)) for value in ids.values()):
+                self.db.advance_sequence(table, key)
+
+    def _find_foreign_keys(self):
+        foreign_keys = {}
+
+        for table in self.archive.get_tables():
+            foreign_keys[table] = self.db.get_foreign_keys(table)
+
+            if foreign_keys[table] is None:
+                raise Exception("Unable to remap the foreign keys of table %s; the %s backend does not report foreign keys" % (table, self.db.backend()))
+
+        return foreign_keys
+
+    def _find_key_columns(self):
+        keys = OrderedDict()
+
+        for table in self.archive.get_tables():
+            if table in IDRemapper.MATCHED_TABLES:
+                continue
+
+            primary_key = self.archive.get_primary_key(table) or self.db.get_primary_key(table)
+
+            if len(primary_key) == 1:
+                keys[table] = primary_key[0]
+
+        return keys
+
+    def _stage_keys(self, keys, stages):
+        # Impl note:
+        # A table may be spread across several entries, so its keys are loaded from every one of them
+        # before looking for collisions. The highest integer key of each table is tracked along the way,
+        # as new integer keys must not collide with the imported rows either.
+        for (table, stage) in stages.items():
+            self.db.create_staging_table(stage, table, [keys[table]])
+
+        highest = {}
+
+        for file in self.archive.get_entries():
+            if self.archive.manifest is not None and self.archive.manifest['entries'][file]['table'] not in stages:
+                continue
+
+            with self.archive.read_table(file) as data:
+                if data.table not in stages or data.rows is None:
+                    continue
+
+                rows = self._key_rows(data.table, data.rows, data.columns.index(keys[data.table]), highest)
+                self.db.copy_rows(stages[data.table], [keys[data.table]], rows, False, self.batch_size)
+
+        return highest
+
+    @staticmethod
+    def _key_rows(table, rows, idx, highest):
+        for row in rows:
+            value = row[idx]
+
+            if isinstance(value, int) and not isinstance(value, bool):
+                highest[table] = max(highest.get(table, value), value)
+
+            yield [value]
+
+    def _find_collisions(self, table, key, stage):
+        cursor = self.db.execQuery('SELECT s.' + key + ' FROM ' + stage + ' s JOIN ' + table + ' t ON t.' + key + ' = s.' + key)
+        collisions = [value for (value,) in cursor]
+        cursor.close()
+
+        return collisions
+
+    def _assign_ids(self, table, key, collisions, highest):
+        ids = {}
+        next_id = None
+
+        for value in collisions:
+            if isinstance(value, int) and not isinstance(value, bool):
+                # Integer keys are numbered on from the highest key in either the table or the archive
+                if next_id is None:
+                    cursor = self.db.execQuery('SELECT MAX(' + key + ') FROM ' + table)
+                    (current,) = cursor.fetchone()
+                    cursor.close()
+
+                    next_id = max(current or 0, highest or 0) + 1
+
+                ids[value] = next_id
+                next_id = next_id + 1
+            else:
+                ids[value] = uuid.uuid4().hex
+
+        return ids
+
+
+
+ImportTask = namedtuple('ImportTask', ['file', 'table', 'columns', 'stage', 'future', 'job', 'depends'])
+
+
+class ImportScheduler(object):
+    """
+    Imports the entries of an archive concurrently over connections from the given ConnectionPool. Each
+    entry is loaded by a worker connection into a staging table lacking the constraints and indexes of its
+    table, and then merged into the table by the primary connection. Every merge runs in the primary
+    connection's transaction, so the import still commits or rolls back as a whole.
+
+    Entries are merged as their loads complete, in dependency order: an entry may be merged once every
+    entry submitted before it for a table it references has been merged. Jobs which must run on the
+    primary connection are scheduled the same way, but have nothing to load.
+    """
+
+    STAGING_PREFIX = 'org_migrator_stage_'
+
+    def __init__(self, db, archive, pool, jobs, ignore_dupes, checkpoints=None):
+        self.db = db
+        self.archive = archive
+        self.pool = pool
+        self.jobs = jobs
+        self.ignore_dupes = ignore_dupes
+        self.checkpoints = checkpoints
+
+        self._tasks = []
+        self._staging_tables = []
+        self._token = uuid.uuid4().hex[:12]
+
+        self._executor = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def open(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+    def submit(self, file, load):
+        """
+        Schedules the given entry to be loaded by a worker connection. The load function is called with
+        the connection and the name of the staging table to load the entry into, and returns whether or
+        not the load succeeded. Raises a KeyError if the archive does not contain the entry.
+        """
+        (table, columns) = self._read_header(file)
+
+        if self._is_complete(file):
+            return True
+
+        stage = '%s%s_%d' % (ImportScheduler.STAGING_PREFIX, self._token, len(self._tasks))
+        self._staging_tables.append(stage)
+
+        # Worker threads never touch the primary connection, so anything needing it is done before the
+        # load starts
+        depends = self._get_dependencies(table)
+
+        future = self._executor.submit(self._load, load, table, columns, stage, self.db.query_listener)
+        self._add_task(ImportTask(file, table, columns, stage, future, None, depends))
+
+        return True
+
+    def submit_job(self, file, job):
+        """
+        Schedules the given job to run on the primary connection once the tables referenced by the
+        table of the given entry have been merged. The job returns whether or not it succeeded.
+        """
+        (table, columns) = self._read_header(file)
+
+        if self._is_complete(file):
+            return True
+
+        self._add_task(ImportTask(file, table, columns, None, None, job, self._get_dependencies(table)))
+
+        return True
+
+    def run(self):
+        """
+        Merges the scheduled entries into their tables on the primary connection as they become ready,
+        returning False if any entry could not be imported
+        """
+        pending = list(self._tasks)
+        merged = set()
+
+        while len(pending) > 0:
+            task = next((task for task in pending if self._is_ready(task, merged)), None)
+
+            if task is None:
+                # The earliest pending task depends only on merged tasks, so it must still be loading
+                loading = [task.future for task in pending if task.future is not None and not task.future.done()]
+                futures.wait(loading, return_when=futures.FIRST_COMPLETED)
+                continue
+
+            pending.remove(task)
+
+            if not self._merge(task):
+                log.error('Unable to import data from file: %s', task.file)
+                return False
+
+            merged.add(task.file)
+
+        return True
+
+    def close(self):
+        if self._executor is not None:
+            for task in self._tasks:
+                if task.future is not None:
+                    task.future.cancel()
+
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def drop_staging_tables(self):
+        """
+        Drops the staging tables created during the import. The tables are read by the transaction of
+        the primary connection, so this must not be called until that transaction has ended.
+        """
+        (tables, self._staging_tables) = (self._staging_tables, [])
+
+        for table in tables:
+            self.db.execUpdate('DROP TABLE IF EXISTS ' + table)
+
+        if len(tables) > 0:
+            self.db.commit()
+
+    def _read_header(self, file):
+        with self.archive.read_table(file) as data:
+            if data.table is None:
+                raise Exception("Malformed table name in archive file: %s => %s" % (file, data.table))
+
+            if type(data.columns) != list:
+                raise Exception("Malformed column list in archive file: %s => %s" % (file, data.columns))
+
+            validate_column_names(data.table, data.columns)
+            return (data.table, data.columns)
+
+    def _is_complete(self, file):
+        # Entries imported by a previous attempt at a resumable import are committed, and need not be
+        # waited on
+        if self.checkpoints is not None and self.checkpoints.get_progress(file)[1]:
+            log.debug('Skipping file imported by a previous attempt: %s', file)
+            return True
+
+        return False
+
+    def _get_dependencies(self, table):
+        # Backends which can't report foreign keys merge everything in the order it was submitted
+        referenced = self.db.get_referenced_tables(table)
+
+        if referenced is None:
+            return list(self._tasks)
+
+        return [task for task in self._tasks if task.table in referenced]
+
+    def _add_task(self, task):
+        self._tasks.append(task)
+        log.debug('Scheduled import of file %s after %d other files', task.file, len(task.depends))
+
+    def _load(self, load, table, columns, stage, query_listener):
+        # Released connections have any uncommitted work rolled back
+        with self.pool.acquire() as db:
+            db.query_listener = query_listener
+
+            # The staging table must be committed before the primary connection can read it
+            db.create_staging_table(stage, table, columns)
+            result = load(db, stage)
+            db.commit()
+
+            return result
+
+    def _is_ready(self, task, merged):
+        if task.future is not None and not task.future.done():
+            return False
+
+        return all(dependency.file in merged for dependency in task.depends)
+
+    def _merge(self, task):
+        if task.future is not None and not task.future.result():
+            return False
+
+        if self.checkpoints is None:
+            return self._merge_task(task)
+
+        # Resumable imports commit each entry along with its checkpoint as it's merged
+        with self.db.start_transaction() as transaction:
+            if not self._merge_task(task):
+                transaction.rollback()
+                return False
+
+            (rows, complete) = self.checkpoints.get_progress(task.file)
+            self.checkpoints.record(self.db, task.file, rows, True)
+            transaction.commit()
+
+        return True
+
+    def _merge_task(self, task):
+        if task.job is not None:
+            return task.job()
+
+        count = self.db.insert_from(task.table, task.columns, task.stage, self.ignore_dupes)
+        log.debug('Merged %d rows into table %s from file: %s', count, task.table, task.file)
+
+        return True
+
+
+
+class ModelManager(object):
+    def __init__(self, org_id, archive, db, ignore_dupes, batch_size=DEFAULT_BATCH_SIZE, executor=None, delta=None, upsert=False,
+        shared_tables=None, metrics=None, explainer=None, staging=None, scheduler=None, checkpoints=None, remapper=None):
+        self.org_id = org_id
+        self.db = db
+        self.archive = archive
+        self.ignore_dupes = ignore_dupes
+        self.batch_size = batch_size
+        self.executor = executor
+        self.delta = delta
+        self.upsert = upsert
+        self.shared_tables = shared_tables
+        self.metrics = metrics
+        self.explainer = explainer
+        self.staging = staging
+        self.scheduler = scheduler
+        self.checkpoints = checkpoints
+        self.remapper = remapper
+
+        self._imported = False
+        self._exported = False
+
+    def do_export(self):
+        raise NotImplementedError("Not yet implemented")
+
+    def do_import(self):
+        raise NotImplementedError("Not yet implemented")
+
+    def depends_on(self):
+        return []
+
+    @property
+    def exported(self):
+        return self._exported
+
+    @property
+    def imported(self):
+        return self._imported
+
+    @property
+    def org_ids(self):
+        """
+        The IDs of the orgs being migrated; managers may operate on several orgs at once
+        """
+        return list(self.org_id) if isinstance(self.org_id, (list, tuple)) else [self.org_id]
+
+    def _owner_clause(self, column):
+        """
+        Returns a condition matching the given owner column against the orgs being migrated. The
+        parameters for the condition are provided by _owner_params.
+        """
+        org_count = len(self.org_ids)
+
+        if org_count == 1:
+            return column + '=%s'
+
+        return column + ' IN (' + ', '.join(['%s'] * org_count) + ')'
+
+    def _owner_params(self, repeat=1):
+        return tuple(self.org_ids) * repeat
+
+    def _submit(self, job, *args):
+        """
+        Runs the given export job, passing it the database connection to use as its first argument. If
+        this manager has an executor, the job is handed off to it and may run concurrently with other
+        jobs; otherwise it is run immediately on this manager's connection.
+        """
+        if self.executor is not None:
+            return self.executor.submit(job, *args)
+
+        return job(self.db, *args)
+
+    def _write_cursor_to_json(self, db, file, table, cursor, row_cb=None):
+        # Server-side cursors don't describe their columns until the first fetch, so we need to pull
+        # the first block before we can build the table header
+        block = cursor.fetchmany(self.batch_size)
+
+        columns = get_cursor_columns(db, cursor)
+        column_types = get_cursor_column_types(db, cursor)
+
+        rows = itertools.chain(block, iterate_cursor(cursor, self.batch_size))
+        if callable(row_cb):
+            rows = (row_cb(row) for row in rows)
+
+        count = self.archive.write_table(file, table, columns, column_types, rows)
+        log.debug('Exported %d rows for table: %s', count, table)
+
+        return count
+
+    def _export_query(self, file, table, query, params=()):
+        if self.explainer is not None:
+            return self.explainer.add(file, table, query, params)
+
+        self._track_keys(table, query, params)
+        self._expect_rows(table, query, params)
+        self._submit(self._export_query_job, file, table, query, params)
+
+    def _expect_rows(self, table, query, params=()):
+        # Counting runs on the primary connection before any of the export jobs are started, so the total
+        # is known by the time progress is first reported
+        if self.metrics is None or not self.metrics.counting:
+            return
+
+        if self.delta is not None:
+            (query, params) = self.delta.filter_query(self.db, table, query, params)
+
+        cursor = self.db.execQuery('SELECT COUNT(*) FROM (' + query + ') count_src', params)
+        self.metrics.expect_rows(cursor.fetchone()[0])
+        cursor.close()
+
+    def _track_keys(self, table, query, params=()):
+        if self.delta is not None:
+            self.delta.add_key_source(table, query, params)
+
+    def _export_query_job(self, db, file, table, query, params):
+        if self.delta is not None:
+            (query, params) = self.delta.filter_query(db, table, query, params)
+
+        # Start the clock before the query is issued so the entry's time to first row includes it
+        if self.metrics is not None:
+            self.metrics.start_entry(file, table)
+
+        cursor = db.execQuery(query, params, server_side=True)
+        count = self._write_cursor_to_json(db, file, table, cursor)
+        cursor.close()
+
+        return count
+
+    def _export_shared(self, file, table, query, params=()):
+        # Shared reference tables are identical in every archive of a batch export, so they're read once
+        # and written from the cache for each subsequent org
+        if self.shared_tables is None or self.explainer is not None:
+            return self._export_query(file, table, query, params)
+
+        self._track_keys(table, query, params)
+        self._expect_rows(table, query, params)
+        self._submit(self._export_shared_job, file, table, query, params)
+
+    def _export_shared_job(self, db, file, table, query, params):
+        if self.delta is not None:
+            (query, params) = self.delta.filter_query(db, table, query, params)
+
+        data = self.shared_tables.fetch(db, table, query, params)
+
+        count = self.archive.write_table(file, data.table, data.columns, data.column_types, data.rows)
+        log.debug('Exported %d rows for table: %s', count, file)
+
+    def _bulk_insert(self, table, columns, rows, row_hook=None, db=None, target=None):
+        db = db if db is not None else self.db
+
+        # Upserts match rows against those already in the table, which a staging table can't do
+        if self.upsert:
+            if target is not None:
+                raise Exception("Rows can't be upserted into a staging table: %s => %s" % (table, target))
+
+            return self._upsert_rows(table, columns, rows, row_hook, db)
+
+        validate_column_names(table, columns)
+
+        log.debug('Importing rows into table: %s', table)
+
+        # try:
+        if callable(row_hook):
+            rows = transform_rows(rows, columns, row_hook, self.batch_size)
+
+        if log.isEnabledFor(LOGLVL_TRACE):
+            rows = trace_rows(rows)
+
+        # Impl note:
+        # The connector streams the rows through its bulk loading interface where it has one (COPY on
+        # PostgreSQL), and otherwise sends many rows per statement, limited to what the backend accepts
+        # in a single statement. Either way the statements are reported to the query listener.
+        # Rows may instead be loaded into a staging table on another connection. Staging tables have no
+        # constraints, so duplicates are only dealt with once the rows are merged into the table.
+        if target is not None:
+            count = db.copy_rows(target, columns, rows, False, self.batch_size)
+        else:
+            count = db.copy_rows(table, columns, rows, self.ignore_dupes, self.batch_size)
+
+        log.debug('Imported %d rows into table: %s', count, table)
+
+        return True
+        # TODO: Uncomment this if we figure out a sane way to get Python to not hide the original
+        # stack trace
+        # except Exception as e:
+        #     self.db.rollback()
+        #     raise e
+
+    def _upsert_rows(self, table, columns, rows, row_hook=None, db=None):
+        db = db if db is not None else self.db
+        key_columns = self.archive.get_primary_key(table) or db.get_primary_key(table)
 
-    def _write_cursor_to_json(self, file, table, cursor, row_cb=None):
-        output = {
-            'table':        table,
-            'columns':      get_cursor_columns(self.db, cursor),
-            'column_types': get_cursor_column_types(self.db, cursor),
-            'rows':         []
-        }
+        validate_column_names(table, columns)
+        validate_column_names(table, key_columns or [])
 
-        for row in cursor:
-            if callable(row_cb):
-                row = row_cb(row)
+        if callable(row_hook):
+            rows = transform_rows(rows, columns, row_hook, self.batch_size)
 
-            output['rows'].append(row)
+        if log.isEnabledFor(LOGLVL_TRACE):
+            rows = trace_rows(rows)
 
-        self.archive.writestr(file, jsonify(output))
-        log.debug('Exported %d rows for table: %s', len(output['rows']), table)
+        if not key_columns:
+            return self._insert_missing_rows(table, columns, rows, db)
 
-    def _export_query(self, file, table, query, params=()):
-        cursor = self.db.execQuery(query, params)
-        self._write_cursor_to_json(file, table, cursor)
-        cursor.close()
+        log.debug('Upserting rows into table: %s', table)
 
-    def _bulk_insert(self, table, columns, rows, row_hook=None):
-        validate_column_names(table, columns)
+        count = db.upsert_rows(table, columns, key_columns, rows, self.batch_size)
 
-        log.debug('Importing %d rows into table: %s', len(rows), table)
-        statement = self.db.build_insert_statement(table, columns, self.ignore_dupes)
+        log.debug('Upserted %d rows into table: %s', count, table)
+        return True
 
-        # try:
-        cursor = self.db.cursor()
+    def _insert_missing_rows(self, table, columns, rows, db=None):
+        # Impl note:
+        # Tables without a primary key are link tables, which have no timestamps and are always exported
+        # in full, so most of their rows will already be present. Each batch is matched against the
+        # existing rows on every column, and only the rows not yet present are inserted. NULL never
+        # matches, but none of these tables have nullable columns.
+        log.debug('Table has no primary key; inserting rows not already present: %s', table)
+
+        db = db if db is not None else self.db
 
-        if len(rows) > 0:
-            log.log(LOGLVL_TRACE, 'Inserting using statement: %s', statement)
+        if len(columns) > 1:
+            pblock = '(' + ', '.join(['%s'] * len(columns)) + ')'
+            target = '(' + ', '.join(columns) + ')'
         else:
-            log.log(LOGLVL_TRACE, 'No rows to insert; skipping insert')
+            pblock = '%s'
+            target = columns[0]
 
-        for row in rows:
-            if callable(row_hook):
-                row = row_hook(columns, row)
+        count = 0
+        for block in iterate_batches(rows, self.batch_size):
+            block = [tuple(row) for row in block]
 
-            log.log(LOGLVL_TRACE, '  row: %s', row)
-            cursor.execute(statement, row)
+            cursor = db.execQuery('SELECT ' + ', '.join(columns) + ' FROM ' + table + ' WHERE ' + target + ' IN (' +
+                ', '.join([pblock] * len(block)) + ')', [value for row in block for value in row])
+            present = set(tuple(row) for row in cursor.fetchall())
+            cursor.close()
 
-        cursor.close()
+            missing = []
+            for row in block:
+                if row not in present:
+                    missing.append(row)
+                    present.add(row)
 
+            if len(missing) > 0:
+                count = count + db.insert_rows(table, columns, missing, False, self.batch_size)
+
+        log.debug('Inserted %d rows into table: %s', count, table)
         return True
-        # TODO: Uncomment this if we figure out a sane way to get Python to not hide the original
-        # stack trace
-        # except Exception as e:
-        #     self.db.rollback()
-        #     raise e
 
     def _import_json(self, file, row_hook=None):
+        """
+        Imports the table stored in the given archive entry. If this manager has a scheduler, the entry
+        is handed off to it and imported once its dependencies have been; otherwise it is imported
+        immediately on this manager's connection.
+        """
+        if self.scheduler is not None:
+            return self.scheduler.submit(file, partial(self._import_entry, file, row_hook))
+
+        return self._import_entry(file, row_hook)
+
+    def _import_checkpointed(self, file, table, columns, rows, row_hook, imported):
+        # Each chunk of rows is committed along with the checkpoint recording it
+        for chunk in iterate_batches(rows, self.checkpoints.chunk_size):
+            with self.db.start_transaction() as transaction:
+                if not self._bulk_insert(table, columns, chunk, row_hook):
+                    transaction.rollback()
+                    return False
+
+                imported = imported + len(chunk)
+                self.checkpoints.record(self.db, file, imported)
+                transaction.commit()
+
+        with self.db.start_transaction() as transaction:
+            self.checkpoints.record(self.db, file, imported, True)
+            transaction.commit()
+
+        return True
+
+    def _import_entry(self, file, row_hook=None, db=None, target=None):
+        (imported, complete) = self.checkpoints.get_progress(file) if self.checkpoints is not None else (0, False)
+
+        if complete:
+            log.debug('Skipping file imported by a previous attempt: %s', file)
+            return True
+
         log.debug('Importing data from file: %s', file)
         result = False
 
-        with self.archive.open(file) as fp:
-            data = json.load(fp)
+        with self.archive.read_table(file) as data:
+            if data.table is None:
+                raise Exception("Malformed table name in archive file: %s => %s" % (file, data.table))
 
-            if data.get('table') is None:
-                raise Exception("Malformed table name in json file: %s => %s" % (file, data.get('table')))
+            if type(data.columns) != list or len(data.columns) < 0:
+                raise Exception("Malformed column list in archive file: %s => %s" % (file, data.columns))
 
-            if type(data.get('columns')) != list or len(data.get('columns')) < 0:
-                raise Exception("Malformed column list in JSON file: %s => %s" % (file, data.get('columns')))
+            if data.rows is not None:
+                rows = data.rows
 
-            if type(data.get('rows')) == list:
-                if len(data.get('rows')) > 0:
-                    result = self._bulk_insert(data['table'], data['columns'], data['rows'], row_hook)
+                if self.remapper is not None:
+                    row_hook = self.remapper.get_transform(data.table, data.columns, row_hook)
+
+                # Skip the rows committed by a previous attempt at a resumable import
+                if imported > 0:
+                    log.info('Resuming import of file %s after %d rows', file, imported)
+                    rows = itertools.islice(rows, imported, None)
+
+                if self.metrics is not None:
+                    self.metrics.start_entry(file, data.table)
+                    rows = self.metrics.track_rows(file, rows, self.batch_size)
+
+                if self.checkpoints is not None and target is None:
+                    result = self._import_checkpointed(file, data.table, data.columns, rows, row_hook, imported)
                 else:
-                    result = True
+                    result = self._bulk_insert(data.table, data.columns, rows, row_hook, db, target)
+
+                if self.metrics is not None:
+                    self.metrics.finish_entry(file)
 
         if not result:
-            log.error('Unable to import JSON from file: %s', file)
+            log.error('Unable to import data from file: %s', file)
 
         return result
 
 
 
 class OwnerManager(ModelManager):
-    def __init__(self, org_id, archive, db, ignore_dupes):
-        super(OwnerManager, self).__init__(org_id, archive, db, ignore_dupes)
+    def __init__(self, org_id, archive, db, ignore_dupes, **kwargs):
+        super(OwnerManager, self).__init__(org_id, archive, db, ignore_dupes, **kwargs)
 
     def do_export(self):
         if self.exported:
             return True
 
-        self._export_query('cp_owner.json', 'cp_owner', 'SELECT * FROM cp_owner WHERE id=%s', (self.org_id,))
+        self._export_query('cp_owner.json', 'cp_owner', 'SELECT * FROM cp_owner WHERE ' + self._owner_clause('id'), self._owner_params())
 
         self._exported = True
         return True
@@ -241,8 +2520,8 @@ class OwnerManager(ModelManager):
 
 
 class UeberCertManager(ModelManager):
-    def __init__(self, org_id, archive, db, ignore_dupes):
-        super(UeberCertManager, self).__init__(org_id, archive, db, ignore_dupes)
+    def __init__(self, org_id, archive, db, ignore_dupes, **kwargs):
+        super(UeberCertManager, self).__init__(org_id, archive, db, ignore_dupes, **kwargs)
 
     def depends_on(self):
         return [OwnerManager]
@@ -251,8 +2530,8 @@ class UeberCertManager(ModelManager):
         if self.exported:
             return True
 
-        self._export_query('cp_cert_serial-ueber.json', 'cp_cert_serial', 'SELECT cs.* FROM cp_cert_serial cs JOIN cp_ueber_cert uc ON uc.serial_id = cs.id WHERE uc.owner_id=%s', (self.org_id,))
-        self._export_query('cp_ueber_cert.json', 'cp_ueber_cert', 'SELECT * FROM cp_ueber_cert WHERE owner_id=%s', (self.org_id,))
+        self._export_query('cp_cert_serial-ueber.json', 'cp_cert_serial', 'SELECT cs.* FROM cp_cert_serial cs JOIN cp_ueber_cert uc ON uc.serial_id = cs.id WHERE ' + self._owner_clause('uc.owner_id'), self._owner_params())
+        self._export_query('cp_ueber_cert.json', 'cp_ueber_cert', 'SELECT * FROM cp_ueber_cert WHERE ' + self._owner_clause('owner_id'), self._owner_params())
 
         self._exported = True
         return True
@@ -273,8 +2552,11 @@ class UeberCertManager(ModelManager):
 
 
 class ContentManager(ModelManager):
-    def __init__(self, org_id, archive, db, ignore_dupes):
-        super(ContentManager, self).__init__(org_id, archive, db, ignore_dupes)
+    STAGED_CONTENT_QUERY = 'SELECT c.* FROM cp2_content c JOIN org_migrator_content sc ON sc.uuid = c.uuid'
+    STAGED_CMP_QUERY = 'SELECT cmp.* FROM cp2_content_modified_products cmp JOIN org_migrator_content sc ON sc.uuid = cmp.content_uuid'
+
+    def __init__(self, org_id, archive, db, ignore_dupes, **kwargs):
+        super(ContentManager, self).__init__(org_id, archive, db, ignore_dupes, **kwargs)
 
     def depends_on(self):
         return [OwnerManager]
@@ -283,33 +2565,32 @@ class ContentManager(ModelManager):
         if self.exported:
             return True
 
-        content_query = 'SELECT DISTINCT * FROM ' + \
-            '(SELECT c.* FROM cp2_content c ' + \
-            'JOIN cp2_owner_content oc ON oc.content_uuid = c.uuid AND oc.owner_id = %s ' + \
+        # Content is pulled in by the org directly, through its products and through its environments.
+        # The UUIDs are collected from all three once, and the content tables joined against the result,
+        # rather than taking the distinct rows of a union of full content rows for each table.
+        uuid_query = 'SELECT oc.content_uuid FROM cp2_owner_content oc WHERE ' + self._owner_clause('oc.owner_id') + ' ' + \
             'UNION ' + \
-            'SELECT c.* FROM cp2_content c ' + \
-            'JOIN cp2_product_content pc ON pc.content_uuid = c.uuid  ' + \
-            'JOIN cp2_owner_products op ON op.product_uuid = pc.product_uuid AND op.owner_id = %s ' + \
+            'SELECT pc.content_uuid FROM cp2_product_content pc ' + \
+            'JOIN cp2_owner_products op ON op.product_uuid = pc.product_uuid WHERE ' + self._owner_clause('op.owner_id') + ' ' + \
             'UNION ' + \
-            'SELECT c.* FROM cp2_content c ' + \
-            'JOIN cp2_environment_content ec ON ec.content_uuid = c.uuid ' + \
-            'JOIN cp_environment e ON ec.environment_id = e.id AND e.owner_id = %s) AS content'
+            'SELECT ec.content_uuid FROM cp2_environment_content ec ' + \
+            'JOIN cp_environment e ON ec.environment_id = e.id WHERE ' + self._owner_clause('e.owner_id')
+        uuid_params = self._owner_params(3)
 
-        cmp_query = 'SELECT DISTINCT * FROM ' + \
-            '(SELECT cmp.* FROM cp2_content_modified_products cmp ' + \
-            'JOIN cp2_owner_content oc ON oc.content_uuid = cmp.content_uuid AND oc.owner_id = %s ' + \
-            'UNION ' + \
-            'SELECT cmp.* FROM cp2_content_modified_products cmp ' + \
-            'JOIN cp2_product_content pc ON pc.content_uuid = cmp.content_uuid  ' + \
-            'JOIN cp2_owner_products op ON op.product_uuid = pc.product_uuid AND op.owner_id = %s ' + \
-            'UNION ' + \
-            'SELECT cmp.* FROM cp2_content_modified_products cmp ' + \
-            'JOIN cp2_environment_content ec ON ec.content_uuid = cmp.content_uuid ' + \
-            'JOIN cp_environment e ON ec.environment_id = e.id AND e.owner_id = %s) AS content'
+        content_query = 'SELECT c.* FROM cp2_content c WHERE c.uuid IN (' + uuid_query + ')'
+        cmp_query = 'SELECT cmp.* FROM cp2_content_modified_products cmp WHERE cmp.content_uuid IN (' + uuid_query + ')'
+
+        if self.explainer is not None:
+            self._explain_content(uuid_query, uuid_params, content_query, cmp_query)
+        else:
+            self._track_keys('cp2_content', content_query, uuid_params)
+            self._track_keys('cp2_content_modified_products', cmp_query, uuid_params)
+            self._expect_rows('cp2_content', content_query, uuid_params)
+            self._expect_rows('cp2_content_modified_products', cmp_query, uuid_params)
+
+            self._submit(self._export_content, uuid_query, uuid_params, content_query, cmp_query)
 
-        self._export_query('cp2_content.json', 'cp2_content', content_query, (self.org_id, self.org_id, self.org_id,))
-        self._export_query('cp2_content_modified_products.json', 'cp2_content_modified_products', cmp_query, (self.org_id, self.org_id, self.org_id,))
-        self._export_query('cp2_owner_content.json', 'cp2_owner_content', 'SELECT * FROM cp2_owner_content WHERE owner_id=%s', (self.org_id,))
+        self._export_query('cp2_owner_content.json', 'cp2_owner_content', 'SELECT * FROM cp2_owner_content WHERE ' + self._owner_clause('owner_id'), self._owner_params())
 
         self._exported = True
         return True
@@ -326,10 +2607,43 @@ class ContentManager(ModelManager):
         return result
 
 
+    def _explain_content(self, uuid_query, uuid_params, content_query, cmp_query):
+        # The content tables are explained as the export would run them: joined against the staged
+        # UUIDs where the connection has a staging table, and as semi-joins otherwise
+        self.explainer.add('org_migrator_content', 'org_migrator_content', uuid_query, uuid_params)
+
+        if self.staging is not None and self.staging.is_prepared(self.db):
+            setup = [('DELETE FROM org_migrator_content', ()), ('INSERT INTO org_migrator_content (uuid) ' + uuid_query, uuid_params)]
+
+            self.explainer.add('cp2_content.json', 'cp2_content', ContentManager.STAGED_CONTENT_QUERY, (), setup)
+            self.explainer.add('cp2_content_modified_products.json', 'cp2_content_modified_products', ContentManager.STAGED_CMP_QUERY, ())
+        else:
+            self.explainer.add('cp2_content.json', 'cp2_content', content_query, uuid_params)
+            self.explainer.add('cp2_content_modified_products.json', 'cp2_content_modified_products', cmp_query, uuid_params)
+
+    def _export_content(self, db, uuid_query, uuid_params, content_query, cmp_query):
+        # Impl note:
+        # The staged UUIDs are only visible to this connection, so both content tables are exported by
+        # this one job. Without a staging table, we fall back to semi-joins against the UUID query.
+        params = uuid_params
+
+        if self.staging is not None and self.staging.is_prepared(db):
+            db.execUpdate('DELETE FROM org_migrator_content')
+            count = db.execUpdate('INSERT INTO org_migrator_content (uuid) ' + uuid_query, uuid_params)
+            log.debug('Staged %d content UUIDs', count)
+
+            content_query = ContentManager.STAGED_CONTENT_QUERY
+            cmp_query = ContentManager.STAGED_CMP_QUERY
+            params = ()
+
+        self._export_query_job(db, 'cp2_content.json', 'cp2_content', content_query, params)
+        self._export_query_job(db, 'cp2_content_modified_products.json', 'cp2_content_modified_products', cmp_query, params)
+
+
 
 class ProductManager(ModelManager):
-    def __init__(self, org_id, archive, db, ignore_dupes):
-        super(ProductManager, self).__init__(org_id, archive, db, ignore_dupes)
+    def __init__(self, org_id, archive, db, ignore_dupes, **kwargs):
+        super(ProductManager, self).__init__(org_id, archive, db, ignore_dupes, **kwargs)
 
     def depends_on(self):
         return [OwnerManager, ContentManager]
@@ -338,13 +2652,13 @@ class ProductManager(ModelManager):
         if self.exported:
             return True
 
-        self._export_query('cp2_products.json', 'cp2_products', 'SELECT p.* FROM cp2_products p JOIN cp2_owner_products op ON op.product_uuid = p.uuid WHERE op.owner_id = %s', (self.org_id,))
-        self._export_query('cp2_product_attributes.json', 'cp2_product_attributes', 'SELECT pa.* FROM cp2_product_attributes pa JOIN cp2_owner_products op ON op.product_uuid = pa.product_uuid WHERE op.owner_id = %s', (self.org_id,))
-        self._export_query('cp2_product_certificates.json', 'cp2_product_certificates', 'SELECT pc.* FROM cp2_product_certificates pc JOIN cp2_owner_products op ON op.product_uuid = pc.product_uuid WHERE op.owner_id = %s', (self.org_id,))
-        self._export_query('cp2_product_content.json', 'cp2_product_content', 'SELECT pc.* FROM cp2_product_content pc JOIN cp2_owner_products op ON op.product_uuid = pc.product_uuid WHERE op.owner_id = %s', (self.org_id,))
-        self._export_query('cp2_owner_products.json', 'cp2_owner_products', 'SELECT * FROM cp2_owner_products WHERE owner_id=%s', (self.org_id,))
-        self._export_query('cp2_product_branding.json', 'cp2_product_branding', 'SELECT pb.* FROM cp2_product_branding pb JOIN cp2_owner_products op ON op.product_uuid = pb.product_uuid WHERE op.owner_id = %s', (self.org_id,))
-        self._export_query('cp2_product_provided_products.json', 'cp2_product_provided_products', 'SELECT ppp.* FROM cp2_product_provided_products ppp JOIN cp2_owner_products op ON op.product_uuid = ppp.product_uuid WHERE op.owner_id = %s', (self.org_id,))
+        self._export_query('cp2_products.json', 'cp2_products', 'SELECT p.* FROM cp2_products p JOIN cp2_owner_products op ON op.product_uuid = p.uuid WHERE ' + self._owner_clause('op.owner_id'), self._owner_params())
+        self._export_query('cp2_product_attributes.json', 'cp2_product_attributes', 'SELECT pa.* FROM cp2_product_attributes pa JOIN cp2_owner_products op ON op.product_uuid = pa.product_uuid WHERE ' + self._owner_clause('op.owner_id'), self._owner_params())
+        self._export_query('cp2_product_certificates.json', 'cp2_product_certificates', 'SELECT pc.* FROM cp2_product_certificates pc JOIN cp2_owner_products op ON op.product_uuid = pc.product_uuid WHERE ' + self._owner_clause('op.owner_id'), self._owner_params())
+        self._export_query('cp2_product_content.json', 'cp2_product_content', 'SELECT pc.* FROM cp2_product_content pc JOIN cp2_owner_products op ON op.product_uuid = pc.product_uuid WHERE ' + self._owner_clause('op.owner_id'), self._owner_params())
+        self._export_query('cp2_owner_products.json', 'cp2_owner_products', 'SELECT * FROM cp2_owner_products WHERE ' + self._owner_clause('owner_id'), self._owner_params())
+        self._export_query('cp2_product_branding.json', 'cp2_product_branding', 'SELECT pb.* FROM cp2_product_branding pb JOIN cp2_owner_products op ON op.product_uuid = pb.product_uuid WHERE ' + self._owner_clause('op.owner_id'), self._owner_params())
+        self._export_query('cp2_product_provided_products.json', 'cp2_product_provided_products', 'SELECT ppp.* FROM cp2_product_provided_products ppp JOIN cp2_owner_products op ON op.product_uuid = ppp.product_uuid WHERE ' + self._owner_clause('op.owner_id'), self._owner_params())
 
         self._exported = True
         return True
@@ -367,8 +2681,8 @@ class ProductManager(ModelManager):
 
 
 class EnvironmentManager(ModelManager):
-    def __init__(self, org_id, archive, db, ignore_dupes):
-        super(EnvironmentManager, self).__init__(org_id, archive, db, ignore_dupes)
+    def __init__(self, org_id, archive, db, ignore_dupes, **kwargs):
+        super(EnvironmentManager, self).__init__(org_id, archive, db, ignore_dupes, **kwargs)
 
     def depends_on(self):
         return [OwnerManager, ContentManager]
@@ -377,9 +2691,9 @@ class EnvironmentManager(ModelManager):
         if self.exported:
             return True
 
-        self._export_query('cp_environment.json', 'cp_environment', 'SELECT * FROM cp_environment WHERE owner_id=%s', (self.org_id,))
-        self._export_query('cp2_environment_content.json', 'cp2_environment_content', 'SELECT ec.* FROM cp2_environment_content ec JOIN cp_environment e ON ec.environment_id = e.id WHERE e.owner_id=%s', (self.org_id,))
-        self._export_query('cp_owner_env_content_access.json', 'cp_owner_env_content_access', 'SELECT eca.* FROM cp_owner_env_content_access eca JOIN cp_environment e ON eca.environment_id = e.id WHERE e.owner_id=%s', (self.org_id,))
+        self._export_query('cp_environment.json', 'cp_environment', 'SELECT * FROM cp_environment WHERE ' + self._owner_clause('owner_id'), self._owner_params())
+        self._export_query('cp2_environment_content.json', 'cp2_environment_content', 'SELECT ec.* FROM cp2_environment_content ec JOIN cp_environment e ON ec.environment_id = e.id WHERE ' + self._owner_clause('e.owner_id'), self._owner_params())
+        self._export_query('cp_owner_env_content_access.json', 'cp_owner_env_content_access', 'SELECT eca.* FROM cp_owner_env_content_access eca JOIN cp_environment e ON eca.environment_id = e.id WHERE ' + self._owner_clause('e.owner_id'), self._owner_params())
 
         self._exported = True
         return True
@@ -398,8 +2712,8 @@ class EnvironmentManager(ModelManager):
 
 
 class ConsumerManager(ModelManager):
-    def __init__(self, org_id, archive, db, ignore_dupes):
-        super(ConsumerManager, self).__init__(org_id, archive, db, ignore_dupes)
+    def __init__(self, org_id, archive, db, ignore_dupes, **kwargs):
+        super(ConsumerManager, self).__init__(org_id, archive, db, ignore_dupes, **kwargs)
 
     def depends_on(self):
         return [OwnerManager, ContentManager, EnvironmentManager]
@@ -409,33 +2723,33 @@ class ConsumerManager(ModelManager):
             return True
 
         # Consumer certificate stuff
-        self._export_query('cp_cert_serial-cac.json', 'cp_cert_serial', 'SELECT cs.* FROM cp_cert_serial cs JOIN cp_cont_access_cert cac ON cac.serial_id = cs.id JOIN cp_consumer c ON c.cont_acc_cert_id = cac.id WHERE c.owner_id=%s', (self.org_id,))
-        self._export_query('cp_cont_access_cert.json', 'cp_cont_access_cert', 'SELECT cac.* FROM cp_cont_access_cert cac JOIN cp_consumer c ON c.cont_acc_cert_id = cac.id WHERE c.owner_id=%s', (self.org_id,))
+        self._export_query('cp_cert_serial-cac.json', 'cp_cert_serial', 'SELECT cs.* FROM cp_cert_serial cs JOIN cp_cont_access_cert cac ON cac.serial_id = cs.id JOIN cp_consumer c ON c.cont_acc_cert_id = cac.id WHERE ' + self._owner_clause('c.owner_id'), self._owner_params())
+        self._export_query('cp_cont_access_cert.json', 'cp_cont_access_cert', 'SELECT cac.* FROM cp_cont_access_cert cac JOIN cp_consumer c ON c.cont_acc_cert_id = cac.id WHERE ' + self._owner_clause('c.owner_id'), self._owner_params())
 
-        self._export_query('cp_cert_serial-ic.json', 'cp_cert_serial', 'SELECT cs.* FROM cp_cert_serial cs JOIN cp_id_cert ic ON ic.serial_id = cs.id JOIN cp_consumer c ON c.consumer_idcert_id = ic.id WHERE c.owner_id=%s', (self.org_id,))
-        self._export_query('cp_id_cert-local.json', 'cp_id_cert', 'SELECT ic.* FROM cp_id_cert ic JOIN cp_consumer c ON c.consumer_idcert_id = ic.id WHERE c.owner_id=%s', (self.org_id,))
+        self._export_query('cp_cert_serial-ic.json', 'cp_cert_serial', 'SELECT cs.* FROM cp_cert_serial cs JOIN cp_id_cert ic ON ic.serial_id = cs.id JOIN cp_consumer c ON c.consumer_idcert_id = ic.id WHERE ' + self._owner_clause('c.owner_id'), self._owner_params())
+        self._export_query('cp_id_cert-local.json', 'cp_id_cert', 'SELECT ic.* FROM cp_id_cert ic JOIN cp_consumer c ON c.consumer_idcert_id = ic.id WHERE ' + self._owner_clause('c.owner_id'), self._owner_params())
 
-        self._export_query('cp_cert_serial-uc.json', 'cp_cert_serial', 'SELECT cs.* FROM cp_cert_serial cs JOIN cp_id_cert ic ON ic.serial_id = cs.id JOIN cp_upstream_consumer uc ON uc.consumer_idcert_id = ic.id WHERE uc.owner_id=%s', (self.org_id,))
-        self._export_query('cp_id_cert-upstream.json', 'cp_id_cert', 'SELECT ic.* FROM cp_id_cert ic JOIN cp_upstream_consumer uc ON uc.consumer_idcert_id = ic.id WHERE uc.owner_id=%s', (self.org_id,))
+        self._export_query('cp_cert_serial-uc.json', 'cp_cert_serial', 'SELECT cs.* FROM cp_cert_serial cs JOIN cp_id_cert ic ON ic.serial_id = cs.id JOIN cp_upstream_consumer uc ON uc.consumer_idcert_id = ic.id WHERE ' + self._owner_clause('uc.owner_id'), self._owner_params())
+        self._export_query('cp_id_cert-upstream.json', 'cp_id_cert', 'SELECT ic.* FROM cp_id_cert ic JOIN cp_upstream_consumer uc ON uc.consumer_idcert_id = ic.id WHERE ' + self._owner_clause('uc.owner_id'), self._owner_params())
 
-        self._export_query('cp_key_pair.json', 'cp_key_pair', 'SELECT ckp.* FROM cp_key_pair ckp JOIN cp_consumer c ON c.keypair_id = ckp.id WHERE c.owner_id=%s', (self.org_id,))
+        self._export_query('cp_key_pair.json', 'cp_key_pair', 'SELECT ckp.* FROM cp_key_pair ckp JOIN cp_consumer c ON c.keypair_id = ckp.id WHERE ' + self._owner_clause('c.owner_id'), self._owner_params())
 
         # Consumer
-        self._export_query('cp_consumer_type.json', 'cp_consumer_type', 'SELECT * FROM cp_consumer_type', [])
-        self._export_query('cp_consumer.json', 'cp_consumer', 'SELECT * FROM cp_consumer WHERE owner_id=%s', (self.org_id,))
-        self._export_query('cp_consumer_capability.json', 'cp_consumer_capability', 'SELECT cc.* FROM cp_consumer_capability cc JOIN cp_consumer c ON c.id = cc.consumer_id WHERE c.owner_id=%s', (self.org_id,))
-        self._export_query('cp_consumer_content_tags.json', 'cp_consumer_content_tags', 'SELECT cct.* FROM cp_consumer_content_tags cct JOIN cp_consumer c ON c.id = cct.consumer_id WHERE c.owner_id=%s', (self.org_id,))
-        self._export_query('cp_consumer_facts.json', 'cp_consumer_facts', 'SELECT cf.* FROM cp_consumer_facts cf JOIN cp_consumer c ON c.id = cf.cp_consumer_id WHERE c.owner_id=%s', (self.org_id,))
-        self._export_query('cp_consumer_guests.json', 'cp_consumer_guests', 'SELECT cg.* FROM cp_consumer_guests cg JOIN cp_consumer c ON c.id = cg.consumer_id WHERE c.owner_id=%s', (self.org_id,))
-        self._export_query('cp_consumer_guests_attributes.json', 'cp_consumer_guests_attributes', 'SELECT cga.* FROM cp_consumer_guests_attributes cga JOIN cp_consumer_guests cg ON cg.guest_id = cga.cp_consumer_guest_id JOIN cp_consumer c ON c.id = cg.consumer_id WHERE c.owner_id=%s', (self.org_id,))
-        self._export_query('cp_consumer_hypervisor.json', 'cp_consumer_hypervisor', 'SELECT ch.* FROM cp_consumer_hypervisor ch JOIN cp_consumer c ON c.id = ch.consumer_id WHERE c.owner_id=%s', (self.org_id,))
-        self._export_query('cp_installed_products.json', 'cp_installed_products', 'SELECT ip.* FROM cp_installed_products ip JOIN cp_consumer c ON c.id = ip.consumer_id WHERE c.owner_id=%s', (self.org_id,))
-        self._export_query('cp_content_override.json', 'cp_content_override', 'SELECT co.* FROM cp_content_override co JOIN cp_consumer c ON c.id = co.consumer_id WHERE c.owner_id=%s', (self.org_id,))
-        self._export_query('cp_sp_add_on.json', 'cp_sp_add_on', 'SELECT spa.* FROM cp_sp_add_on spa JOIN cp_consumer c ON c.id = spa.consumer_id WHERE c.owner_id=%s', (self.org_id,))
+        self._export_shared('cp_consumer_type.json', 'cp_consumer_type', 'SELECT * FROM cp_consumer_type')
+        self._export_query('cp_consumer.json', 'cp_consumer', 'SELECT * FROM cp_consumer WHERE ' + self._owner_clause('owner_id'), self._owner_params())
+        self._export_query('cp_consumer_capability.json', 'cp_consumer_capability', 'SELECT cc.* FROM cp_consumer_capability cc JOIN cp_consumer c ON c.id = cc.consumer_id WHERE ' + self._owner_clause('c.owner_id'), self._owner_params())
+        self._export_query('cp_consumer_content_tags.json', 'cp_consumer_content_tags', 'SELECT cct.* FROM cp_consumer_content_tags cct JOIN cp_consumer c ON c.id = cct.consumer_id WHERE ' + self._owner_clause('c.owner_id'), self._owner_params())
+        self._export_query('cp_consumer_facts.json', 'cp_consumer_facts', 'SELECT cf.* FROM cp_consumer_facts cf JOIN cp_consumer c ON c.id = cf.cp_consumer_id WHERE ' + self._owner_clause('c.owner_id'), self._owner_params())
+        self._export_query('cp_consumer_guests.json', 'cp_consumer_guests', 'SELECT cg.* FROM cp_consumer_guests cg JOIN cp_consumer c ON c.id = cg.consumer_id WHERE ' + self._owner_clause('c.owner_id'), self._owner_params())
+        self._export_query('cp_consumer_guests_attributes.json', 'cp_consumer_guests_attributes', 'SELECT cga.* FROM cp_consumer_guests_attributes cga JOIN cp_consumer_guests cg ON cg.guest_id = cga.cp_consumer_guest_id JOIN cp_consumer c ON c.id = cg.consumer_id WHERE ' + self._owner_clause('c.owner_id'), self._owner_params())
+        self._export_query('cp_consumer_hypervisor.json', 'cp_consumer_hypervisor', 'SELECT ch.* FROM cp_consumer_hypervisor ch JOIN cp_consumer c ON c.id = ch.consumer_id WHERE ' + self._owner_clause('c.owner_id'), self._owner_params())
+        self._export_query('cp_installed_products.json', 'cp_installed_products', 'SELECT ip.* FROM cp_installed_products ip JOIN cp_consumer c ON c.id = ip.consumer_id WHERE ' + self._owner_clause('c.owner_id'), self._owner_params())
+        self._export_query('cp_content_override.json', 'cp_content_override', 'SELECT co.* FROM cp_content_override co JOIN cp_consumer c ON c.id = co.consumer_id WHERE ' + self._owner_clause('c.owner_id'), self._owner_params())
+        self._export_query('cp_sp_add_on.json', 'cp_sp_add_on', 'SELECT spa.* FROM cp_sp_add_on spa JOIN cp_consumer c ON c.id = spa.consumer_id WHERE ' + self._owner_clause('c.owner_id'), self._owner_params())
 
         # Misc consumer stuff
-        self._export_query('cp_upstream_consumer.json', 'cp_upstream_consumer', 'SELECT * FROM cp_upstream_consumer WHERE owner_id=%s', (self.org_id,))
-        self._export_query('cp_deleted_consumers.json', 'cp_deleted_consumers', 'SELECT * FROM cp_deleted_consumers WHERE owner_id=%s', (self.org_id,))
+        self._export_query('cp_upstream_consumer.json', 'cp_upstream_consumer', 'SELECT * FROM cp_upstream_consumer WHERE ' + self._owner_clause('owner_id'), self._owner_params())
+        self._export_query('cp_deleted_consumers.json', 'cp_deleted_consumers', 'SELECT * FROM cp_deleted_consumers WHERE ' + self._owner_clause('owner_id'), self._owner_params())
 
         self._exported = True
         return True
@@ -472,23 +2786,50 @@ class ConsumerManager(ModelManager):
         return result
 
     def _import_consumer_types(self, file):
+        # Types are matched to the existing types by label, which can't be done from a staging table
+        if self.scheduler is not None:
+            return self.scheduler.submit_job(file, partial(self._import_consumer_types_entry, file))
+
+        if self.checkpoints is None:
+            return self._import_consumer_types_entry(file)
+
+        # The types are few, so resumable imports commit them all at once
+        if self.checkpoints.get_progress(file)[1]:
+            log.debug('Skipping file imported by a previous attempt: %s', file)
+            return True
+
+        with self.db.start_transaction() as transaction:
+            if not self._import_consumer_types_entry(file):
+                transaction.rollback()
+                return False
+
+            self.checkpoints.record(self.db, file, 0, True)
+            transaction.commit()
+
+        return True
+
+    def _import_consumer_types_entry(self, file):
         log.debug('Importing consumer types from file: %s', file)
         result = False
 
-        with self.archive.open(file) as fp:
-            data = json.load(fp)
+        with self.archive.read_table(file) as data:
+            if data.table is None:
+                raise Exception("Malformed table name in archive file: %s => %s" % (file, data.table))
 
-            if data.get('table') is None:
-                raise Exception("Malformed table name in json file: %s => %s" % (file, data.get('table')))
+            if type(data.columns) != list or len(data.columns) < 0:
+                raise Exception("Malformed column list in archive file: %s => %s" % (file, data.columns))
 
-            if type(data.get('columns')) != list or len(data.get('columns')) < 0:
-                raise Exception("Malformed column list in JSON file: %s => %s" % (file, data.get('columns')))
+            if data.rows is not None:
+                rows = data.rows
 
-            if type(data.get('rows')) == list:
-                if len(data.get('rows')) > 0:
-                    result = self._insert_types(data['table'], data['columns'], data['rows'])
-                else:
-                    result = True
+                if self.metrics is not None:
+                    self.metrics.start_entry(file, data.table)
+                    rows = self.metrics.track_rows(file, rows, self.batch_size)
+
+                result = self._insert_types(data.table, data.columns, rows)
+
+                if self.metrics is not None:
+                    self.metrics.finish_entry(file)
 
         if not result:
             log.error('Unable to import consumer types from file: %s', file)
@@ -496,58 +2837,31 @@ class ConsumerManager(ModelManager):
         return result
 
     def _insert_types(self, table, columns, rows):
-        log.debug('Importing %d rows into table: %s', len(rows), table)
-        pblock = ', '.join(['%s'] * len(columns))
-
+        log.debug('Importing rows into table: %s', table)
         validate_column_names(table, columns)
-        insert_stmt = 'INSERT INTO ' + table + ' (' + ', '.join(columns) + ') VALUES (' + pblock + ')'
-        update_stmt = 'UPDATE ' + table + ' SET ' + (', '.join((col + '=%s' for col in columns))) + ' WHERE id=%s'
-
-        label_idx = None
-
-        for (idx, col) in enumerate(columns):
-            if col == 'label':
-                label_idx = idx
-                break
 
-        if label_idx is None:
+        if 'label' not in columns:
             raise Exception("Consumer types lacks a label column")
 
-        inserted = 0
-        updated = 0
+        # impl note:
+        # Types are matched to the existing types by label rather than ID; where a type already exists,
+        # it's replaced with the imported type, ID and all
+        count = self.db.upsert_rows(table, columns, ['label'], rows, self.batch_size)
 
+        log.debug("Consumer types committed, %d upserted", count)
+        return True
 
-        # TODO: optimize this so we can do like 10-25 rows at a time, rather than just one
-        try:
-            for row in rows:
-                # impl note:
-                # This sucks, but at the time of writing, there is no platform-agnostic upsert statement
-                label = row[label_idx]
-                cursor = self.db.execQuery('SELECT id FROM ' + table + ' WHERE label=%s', (label,))
-
-                erow = cursor.fetchone()
-                cursor.close()
-
-                if erow is not None:
-                    # Existing row, update it with the data we have
-                    rowcount = self.db.execUpdate(update_stmt, row + [erow[0]])
-                    updated = updated + rowcount
-                else:
-                    # New consumer type, insert row as-is
-                    rowcount = self.db.execUpdate(insert_stmt, row)
-                    inserted = inserted + rowcount
 
-            log.debug("Consumer types committed, %d updated, %d inserted", updated, inserted)
-            return True
-        except Exception as e:
-            self.db.rollback()
-            raise e
 
+class PoolManager(ModelManager):
+    # The maximum depth of derived pools to follow when exporting the pool/entitlement tree
+    MAX_TREE_DEPTH = 100
 
+    # Matches the archive entries holding a level of the pool/entitlement tree, capturing the depth
+    TREE_ENTRY_PATTERN = re.compile(r'^cp_(?:pool|entitlement)-(\d+)\.json$')
 
-class PoolManager(ModelManager):
-    def __init__(self, org_id, archive, db, ignore_dupes):
-        super(PoolManager, self).__init__(org_id, archive, db, ignore_dupes)
+    def __init__(self, org_id, archive, db, ignore_dupes, **kwargs):
+        super(PoolManager, self).__init__(org_id, archive, db, ignore_dupes, **kwargs)
 
     def depends_on(self):
         return [OwnerManager, ProductManager, ConsumerManager]
@@ -557,108 +2871,137 @@ class PoolManager(ModelManager):
             return True
 
         # CDN
-        self._export_query('cp_cert_serial-cdn.json', 'cp_cert_serial', 'SELECT cs.* FROM cp_cert_serial cs JOIN cp_cdn_certificate cc ON cc.serial_id = cs.id JOIN cp_cdn c ON c.certificate_id = cc.id JOIN cp_pool p ON p.cdn_id = c.id WHERE p.owner_id=%s', (self.org_id,))
-        self._export_query('cp_cdn_certificate.json', 'cp_cdn_certificate', 'SELECT cc.* FROM cp_cdn_certificate cc JOIN cp_cdn c ON c.certificate_id = cc.id JOIN cp_pool p ON p.cdn_id = c.id WHERE p.owner_id=%s', (self.org_id,))
-        self._export_query('cp_cdn.json', 'cp_cdn', 'SELECT c.* FROM cp_cdn c JOIN cp_pool p ON p.cdn_id = c.id WHERE p.owner_id=%s', (self.org_id,))
+        self._export_query('cp_cert_serial-cdn.json', 'cp_cert_serial', 'SELECT cs.* FROM cp_cert_serial cs JOIN cp_cdn_certificate cc ON cc.serial_id = cs.id JOIN cp_cdn c ON c.certificate_id = cc.id JOIN cp_pool p ON p.cdn_id = c.id WHERE ' + self._owner_clause('p.owner_id'), self._owner_params())
+        self._export_query('cp_cdn_certificate.json', 'cp_cdn_certificate', 'SELECT cc.* FROM cp_cdn_certificate cc JOIN cp_cdn c ON c.certificate_id = cc.id JOIN cp_pool p ON p.cdn_id = c.id WHERE ' + self._owner_clause('p.owner_id'), self._owner_params())
+        self._export_query('cp_cdn.json', 'cp_cdn', 'SELECT c.* FROM cp_cdn c JOIN cp_pool p ON p.cdn_id = c.id WHERE ' + self._owner_clause('p.owner_id'), self._owner_params())
 
         # Pool certs
-        self._export_query('cp_cert_serial-pool.json', 'cp_cert_serial', 'SELECT cs.* FROM cp_cert_serial cs JOIN cp_certificate c ON c.serial_id = cs.id JOIN cp_pool p ON p.certificate_id = c.id WHERE p.owner_id=%s', (self.org_id,))
-        self._export_query('cp_certificate.json', 'cp_certificate', 'SELECT c.* FROM cp_certificate c JOIN cp_pool p ON p.certificate_id = c.id WHERE p.owner_id=%s', (self.org_id,))
+        self._export_query('cp_cert_serial-pool.json', 'cp_cert_serial', 'SELECT cs.* FROM cp_cert_serial cs JOIN cp_certificate c ON c.serial_id = cs.id JOIN cp_pool p ON p.certificate_id = c.id WHERE ' + self._owner_clause('p.owner_id'), self._owner_params())
+        self._export_query('cp_certificate.json', 'cp_certificate', 'SELECT c.* FROM cp_certificate c JOIN cp_pool p ON p.certificate_id = c.id WHERE ' + self._owner_clause('p.owner_id'), self._owner_params())
 
         # Recursive pool/entitlement lookup!
+        pool_query = 'SELECT p.* FROM cp_pool p WHERE ' + self._owner_clause('p.owner_id')
+        entitlement_query = 'SELECT e.* FROM cp_entitlement e JOIN cp_pool p ON p.id = e.pool_id WHERE ' + self._owner_clause('p.owner_id')
 
-        # 1 find pools for the org that have no source entitlement (sourceentitlement_id is null)
-        # 2 find entitlements for the pools
-        # 3 find pools for the org which originate from the entitlements found
-        # 4 if one or more pools is found in step 3, go to step 2
+        for (table, query) in (('cp_pool', pool_query), ('cp_entitlement', entitlement_query)):
+            self._track_keys(table, query, self._owner_params())
+            self._expect_rows(table, query, self._owner_params())
+
+        if self.explainer is not None:
+            self._explain_pool_tree()
+        else:
+            self._submit(self._export_pool_tree)
 
-        param_limit = 10000
+        # From here, we can blanket export any related pool data for pools in this org, since we're
+        # no longer worried about the circular referencing between pool and entitlement
 
-        def id_puller(list, col, row):
-            list.append(row[col])
-            return row
+        self._export_query('cp_pool_attribute.json', 'cp_pool_attribute', 'SELECT pa.* FROM cp_pool_attribute pa JOIN cp_pool p ON p.id = pa.pool_id WHERE ' + self._owner_clause('p.owner_id'), self._owner_params())
+        self._export_query('cp_pool_source_stack.json', 'cp_pool_source_stack', 'SELECT pss.* FROM cp_pool_source_stack pss JOIN cp_pool p ON p.id = pss.derivedpool_id WHERE ' + self._owner_clause('p.owner_id'), self._owner_params())
+        self._export_query('cp2_pool_source_sub.json', 'cp2_pool_source_sub', 'SELECT pss.* FROM cp2_pool_source_sub pss JOIN cp_pool p ON p.id = pss.pool_id WHERE ' + self._owner_clause('p.owner_id'), self._owner_params())
+        self._export_query('cp_product_pool_attribute.json', 'cp_product_pool_attribute', 'SELECT ppa.* FROM cp_product_pool_attribute ppa JOIN cp_pool p ON p.id = ppa.pool_id WHERE ' + self._owner_clause('p.owner_id'), self._owner_params())
 
-        def fetch_pools(eids, depth=0):
-            if len(eids) < 1:
-                return
+        # Entitlement certs (note: unlike all other certs, these must be inserted *after* entitlements)
+        self._export_query('cp_cert_serial-ent.json', 'cp_cert_serial', 'SELECT cs.* FROM cp_cert_serial cs JOIN cp_ent_certificate ec ON ec.serial_id = cs.id JOIN cp_entitlement e ON e.id = ec.entitlement_id JOIN cp_pool p ON p.id = e.pool_id WHERE ' + self._owner_clause('p.owner_id'), self._owner_params())
+        self._export_query('cp_ent_certificate.json', 'cp_ent_certificate', 'SELECT ec.* FROM cp_ent_certificate ec JOIN cp_entitlement e ON e.id = ec.entitlement_id JOIN cp_pool p ON p.id = e.pool_id WHERE ' + self._owner_clause('p.owner_id'), self._owner_params())
 
-            pids = []
-            rows = []
-            columns = None
+        self._exported = True
+        return True
 
-            while len(eids) > 0:
-                block = eids[:param_limit]
-                eids = eids[param_limit:]
+    def _export_pool_tree(self, db):
+        # Pools and entitlements reference each other (entitlement -> pool, derived pool -> source
+        # entitlement), so we walk the tree breadth-first and write each level to its own file:
+        #   cp_pool-0.json:         pools for the org that have no source entitlement
+        #   cp_entitlement-N.json:  entitlements consuming the pools in cp_pool-N.json
+        #   cp_pool-N+1.json:       pools for the org which originate from the entitlements found
+        #
+        # Importing the files in order of depth then never references a row that hasn't been inserted.
+        if db.supports_recursive_queries():
+            self._export_pool_tree_recursive(db)
+        else:
+            self._export_pool_tree_iterative(db)
 
-                pblock = ', '.join(['%s'] * len(block))
-                cursor = self.db.execQuery('SELECT e.* FROM cp_pool p WHERE p.sourceentitlement_id IN (' + pblock + ') ORDER BY created ASC', block)
-                columns = get_cursor_columns(self.db, cursor)
-                column_types = get_cursor_column_types(self.db, cursor)
-                rows = rows + list(cursor)
-                cursor.close()
+    def _explain_pool_tree(self):
+        # The iterative walk's queries depend on the contents of its temporary tables, so only the
+        # recursive queries can be explained up front
+        if self.db.supports_recursive_queries():
+            (pool_query, entitlement_query, params) = self._build_pool_tree_queries()
 
-            output = {
-                'table':        'cp_pool',
-                'columns':      columns,
-                'column_types': column_types,
-                'rows':         rows
-            }
+            self.explainer.add('cp_pool-N.json', 'cp_pool', pool_query, params)
+            self.explainer.add('cp_entitlement-N.json', 'cp_entitlement', entitlement_query, params)
+        else:
+            log.info('Recursive queries are not supported by the database; skipping pool tree queries')
 
-            self.archive.writestr("cp_pool-%d.json" % (depth,), jsonify(output))
-            fetch_entitlements(pids, depth)
+    def _export_pool_tree_recursive(self, db):
+        (pool_query, entitlement_query, params) = self._build_pool_tree_queries()
 
-        def fetch_entitlements(pids, depth=0):
-            if len(pids) < 1:
-                return
+        self._export_query_by_depth(db, 'cp_pool', pool_query, params)
+        self._export_query_by_depth(db, 'cp_entitlement', entitlement_query, params)
 
-            eids = []
-            rows = []
-            columns = None
+    def _build_pool_tree_queries(self):
+        tree_query = 'WITH RECURSIVE pool_tree (pool_id, depth) AS (' + \
+            'SELECT p.id, 0 FROM cp_pool p WHERE ' + self._owner_clause('p.owner_id') + ' AND p.sourceentitlement_id IS NULL ' + \
+            'UNION ALL ' + \
+            'SELECT p.id, pt.depth + 1 FROM pool_tree pt ' + \
+            'JOIN cp_entitlement e ON e.pool_id = pt.pool_id ' + \
+            'JOIN cp_pool p ON p.sourceentitlement_id = e.id ' + \
+            'WHERE ' + self._owner_clause('p.owner_id') + ' AND pt.depth < %s) '
 
-            while len(pids) > 0:
-                block = pids[:param_limit]
-                pids = pids[param_limit:]
+        pool_query = tree_query + 'SELECT pt.depth AS tree_depth, p.* FROM cp_pool p JOIN pool_tree pt ON pt.pool_id = p.id ORDER BY pt.depth ASC, p.created ASC'
+        entitlement_query = tree_query + 'SELECT pt.depth AS tree_depth, e.* FROM cp_entitlement e JOIN pool_tree pt ON pt.pool_id = e.pool_id ORDER BY pt.depth ASC, e.created ASC'
+        params = self._owner_params(2) + (PoolManager.MAX_TREE_DEPTH,)
 
-                pblock = ', '.join(['%s'] * len(block))
-                cursor = self.db.execQuery('SELECT e.* FROM cp_entitlement e WHERE e.pool_id IN (' + pblock + ') ORDER BY created ASC', block)
-                columns = get_cursor_columns(self.db, cursor)
-                column_types = get_cursor_column_types(self.db, cursor)
-                rows = rows + list(cursor)
-                cursor.close()
+        return (pool_query, entitlement_query, params)
 
-            output = {
-                'table':        'cp_entitlement',
-                'columns':      columns,
-                'column_types': column_types,
-                'rows':         rows
-            }
+    def _export_query_by_depth(self, db, table, query, params):
+        # The query is expected to return the tree depth as the first column of each row, ordered by
+        # depth. Each depth is streamed to its own file, and the depth column is dropped from the output.
+        if self.delta is not None:
+            (query, params) = self.delta.filter_query(db, table, query, params, order_by='tree_depth')
+
+        cursor = db.execQuery(query, params, server_side=True)
+        block = cursor.fetchmany(self.batch_size)
 
-            self.archive.writestr("cp_entitlement-%d.json" % (depth,), jsonify(output))
-            fetch_pools(eids, depth + 1)
+        columns = get_cursor_columns(db, cursor)[1:]
+        column_types = get_cursor_column_types(db, cursor)[1:]
 
-        # Fetch base pools (those not originating from source entitlements)
-        pids = []
+        rows = itertools.chain(block, iterate_cursor(cursor, self.batch_size))
+        for (depth, group) in itertools.groupby(rows, key=lambda row: row[0]):
+            file = '%s-%d.json' % (table, depth)
+            count = self.archive.write_table(file, table, columns, column_types, (row[1:] for row in group))
+            log.debug('Exported %d rows for table: %s', count, file)
 
-        cursor = self.db.execQuery('SELECT p.* FROM cp_pool p WHERE owner_id=%s AND sourceentitlement_id is NULL ORDER BY created ASC', (self.org_id,))
-        self._write_cursor_to_json('cp_pool-0.json', 'cp_pool', cursor, partial(id_puller, pids, 0))
         cursor.close()
 
-        fetch_entitlements(pids)
+    def _export_pool_tree_iterative(self, db):
+        # Impl note:
+        # This is only used for backends lacking recursive CTE support (older MySQL/MariaDB). Each level
+        # of the tree is staged in a temporary table and joined against to find the next, rather than
+        # passing the IDs back through the client as giant IN lists.
+        db.execUpdate('CREATE TEMPORARY TABLE org_migrator_pools (id VARCHAR(64) NOT NULL PRIMARY KEY)')
+        db.execUpdate('CREATE TEMPORARY TABLE org_migrator_entitlements (id VARCHAR(64) NOT NULL PRIMARY KEY)')
 
-        # From here, we can blanket export any related pool data for pools in this org, since we're
-        # no longer worried about the circular referencing between pool and entitlement
+        try:
+            depth = 0
+            count = db.execUpdate('INSERT INTO org_migrator_pools (id) SELECT p.id FROM cp_pool p WHERE ' + self._owner_clause('p.owner_id') + ' AND p.sourceentitlement_id IS NULL', self._owner_params())
 
-        self._export_query('cp_pool_attribute.json', 'cp_pool_attribute', 'SELECT pa.* FROM cp_pool_attribute pa JOIN cp_pool p ON p.id = pa.pool_id WHERE p.owner_id=%s', (self.org_id,))
-        self._export_query('cp_pool_source_stack.json', 'cp_pool_source_stack', 'SELECT pss.* FROM cp_pool_source_stack pss JOIN cp_pool p ON p.id = pss.derivedpool_id WHERE p.owner_id=%s', (self.org_id,))
-        self._export_query('cp2_pool_source_sub.json', 'cp2_pool_source_sub', 'SELECT pss.* FROM cp2_pool_source_sub pss JOIN cp_pool p ON p.id = pss.pool_id WHERE p.owner_id=%s', (self.org_id,))
-        self._export_query('cp_product_pool_attribute.json', 'cp_product_pool_attribute', 'SELECT ppa.* FROM cp_product_pool_attribute ppa JOIN cp_pool p ON p.id = ppa.pool_id WHERE p.owner_id=%s', (self.org_id,))
+            while count > 0 and depth <= PoolManager.MAX_TREE_DEPTH:
+                self._export_query_job(db, 'cp_pool-%d.json' % (depth,), 'cp_pool', 'SELECT p.* FROM cp_pool p JOIN org_migrator_pools tp ON tp.id = p.id ORDER BY p.created ASC', ())
 
-        # Entitlement certs (note: unlike all other certs, these must be inserted *after* entitlements)
-        self._export_query('cp_cert_serial-ent.json', 'cp_cert_serial', 'SELECT cs.* FROM cp_cert_serial cs JOIN cp_ent_certificate ec ON ec.serial_id = cs.id JOIN cp_entitlement e ON e.id = ec.entitlement_id JOIN cp_pool p ON p.id = e.pool_id WHERE p.owner_id=%s', (self.org_id,))
-        self._export_query('cp_ent_certificate.json', 'cp_ent_certificate', 'SELECT ec.* FROM cp_ent_certificate ec JOIN cp_entitlement e ON e.id = ec.entitlement_id JOIN cp_pool p ON p.id = e.pool_id WHERE p.owner_id=%s', (self.org_id,))
+                db.execUpdate('DELETE FROM org_migrator_entitlements')
+                count = db.execUpdate('INSERT INTO org_migrator_entitlements (id) SELECT e.id FROM cp_entitlement e JOIN org_migrator_pools tp ON tp.id = e.pool_id')
 
-        self._exported = True
-        return True
+                if count < 1:
+                    break
+
+                self._export_query_job(db, 'cp_entitlement-%d.json' % (depth,), 'cp_entitlement', 'SELECT e.* FROM cp_entitlement e JOIN org_migrator_entitlements te ON te.id = e.id ORDER BY e.created ASC', ())
+
+                db.execUpdate('DELETE FROM org_migrator_pools')
+                count = db.execUpdate('INSERT INTO org_migrator_pools (id) SELECT p.id FROM cp_pool p JOIN org_migrator_entitlements te ON te.id = p.sourceentitlement_id WHERE ' + self._owner_clause('p.owner_id'), self._owner_params())
+
+                depth = depth + 1
+        finally:
+            db.execUpdate('DROP TEMPORARY TABLE org_migrator_pools')
+            db.execUpdate('DROP TEMPORARY TABLE org_migrator_entitlements')
 
     def do_import(self):
         if self.imported:
@@ -670,17 +3013,17 @@ class PoolManager(ModelManager):
         result = result and self._import_json('cp_cert_serial-pool.json', boolean_converter(['collected', 'revoked']))
         result = result and self._import_json('cp_certificate.json', base64_decoder(['cert', 'privatekey']))
 
-        try:
-            # do iterative pool/entitlement import until we hit a key error, indicating we're out of
-            # files to import
-            depth = 0
-            while True:
+        # Import the pool tree a level at a time, up to the deepest level in the archive. Delta archives
+        # only hold the levels with changed rows, so any level of either table may be missing.
+        entries = set(self.archive.get_entries())
+        depths = [int(match.group(1)) for match in (PoolManager.TREE_ENTRY_PATTERN.match(file) for file in entries) if match is not None]
+
+        for depth in range(max(depths) + 1 if len(depths) > 0 else 0):
+            if "cp_pool-%d.json" % (depth,) in entries:
                 result = result and self._import_json("cp_pool-%d.json" % (depth,), boolean_converter(['activesubscription']))
-                result = result and self._import_json("cp_entitlement-%d.json" % (depth,), boolean_converter(['dirty', 'updatedonstart']))
 
-                depth = depth + 1
-        except KeyError:
-            pass
+            if "cp_entitlement-%d.json" % (depth,) in entries:
+                result = result and self._import_json("cp_entitlement-%d.json" % (depth,), boolean_converter(['dirty', 'updatedonstart']))
 
         result = result and self._import_json('cp_pool_attribute.json')
         result = result and self._import_json('cp_pool_source_stack.json')
@@ -695,8 +3038,8 @@ class PoolManager(ModelManager):
 
 
 class ActivationKeyManager(ModelManager):
-    def __init__(self, org_id, archive, db, ignore_dupes):
-        super(ActivationKeyManager, self).__init__(org_id, archive, db, ignore_dupes)
+    def __init__(self, org_id, archive, db, ignore_dupes, **kwargs):
+        super(ActivationKeyManager, self).__init__(org_id, archive, db, ignore_dupes, **kwargs)
 
     def depends_on(self):
         return [OwnerManager, ProductManager, PoolManager]
@@ -705,9 +3048,9 @@ class ActivationKeyManager(ModelManager):
         if self.exported:
             return True
 
-        self._export_query('cp_activation_key.json', 'cp_activation_key', 'SELECT * FROM cp_activation_key WHERE owner_id=%s', (self.org_id,))
-        self._export_query('cp_activationkey_pool.json', 'cp_activationkey_pool', 'SELECT akp.* FROM cp_activationkey_pool akp JOIN cp_activation_key ak ON ak.id = akp.key_id WHERE ak.owner_id=%s', (self.org_id,))
-        self._export_query('cp2_activation_key_products.json', 'cp2_activation_key_products', 'SELECT akp.* FROM cp2_activation_key_products akp JOIN cp2_owner_products op ON op.product_uuid = akp.product_uuid WHERE op.owner_id=%s', (self.org_id,))
+        self._export_query('cp_activation_key.json', 'cp_activation_key', 'SELECT * FROM cp_activation_key WHERE ' + self._owner_clause('owner_id'), self._owner_params())
+        self._export_query('cp_activationkey_pool.json', 'cp_activationkey_pool', 'SELECT akp.* FROM cp_activationkey_pool akp JOIN cp_activation_key ak ON ak.id = akp.key_id WHERE ' + self._owner_clause('ak.owner_id'), self._owner_params())
+        self._export_query('cp2_activation_key_products.json', 'cp2_activation_key_products', 'SELECT akp.* FROM cp2_activation_key_products akp JOIN cp2_owner_products op ON op.product_uuid = akp.product_uuid WHERE ' + self._owner_clause('op.owner_id'), self._owner_params())
 
         self._exported = True
         return True
@@ -728,24 +3071,42 @@ class ActivationKeyManager(ModelManager):
 class OrgMigrator(object):
     workers = [OwnerManager, ProductManager, ContentManager, EnvironmentManager, ConsumerManager, PoolManager, UeberCertManager, ActivationKeyManager]
 
-    def __init__(self, dbconn, archive, org_id, ignore_dupes):
+    def __init__(self, dbconn, archive, org_id, ignore_dupes, batch_size=DEFAULT_BATCH_SIZE):
         self.db = dbconn
         self.archive = archive
         self.org_id = org_id
         self.ignore_dupes = ignore_dupes
+        self.batch_size = batch_size
+        self.executor = None
+        self.delta = None
+        self.upsert = False
+        self.shared_tables = None
+        self.metrics = None
+        self.explainer = None
+        self.staging = None
+        self.scheduler = None
+        self.checkpoints = None
+        self.remapper = None
 
         self.exporters = {}
 
     def __del__(self):
         self.close()
 
+    @property
+    def org_ids(self):
+        return list(self.org_id) if isinstance(self.org_id, (list, tuple)) else [self.org_id]
+
     def close(self):
         if self.archive is not None:
             self.archive.close()
 
     def _get_model_exporter(self, exporter):
         if exporter not in self.exporters:
-            self.exporters[exporter] = exporter(self.org_id, self.archive, self.db, self.ignore_dupes)
+            self.exporters[exporter] = exporter(self.org_id, self.archive, self.db, self.ignore_dupes, batch_size=self.batch_size,
+                executor=self.executor, delta=self.delta, upsert=self.upsert, shared_tables=self.shared_tables, metrics=self.metrics,
+                explainer=self.explainer, staging=self.staging, scheduler=self.scheduler, checkpoints=self.checkpoints,
+                remapper=self.remapper)
 
         return self.exporters[exporter]
 
@@ -755,12 +3116,124 @@ class OrgMigrator(object):
 
 
 class OrgExporter(OrgMigrator):
-    def __init__(self, dbconn, archive_file, org_id, ignore_dupes):
-        archive = zipfile.ZipFile(archive_file, mode='w', compression=zipfile.ZIP_DEFLATED)
+    def __init__(self, dbconn, archive_file, org_id, ignore_dupes, batch_size=DEFAULT_BATCH_SIZE, jobs=1, connect=None,
+        table_format=JSONTableFormat.name, compression=DEFAULT_COMPRESSION, compression_level=None, since=None, pool=None,
+        shared_tables=None, metrics=None, staging=None):
+
+        if jobs > 1 and connect is None and pool is None:
+            raise ValueError("A connection factory is required to export using multiple jobs")
 
-        super(OrgExporter, self).__init__(dbconn, archive, org_id, ignore_dupes)
+        delta = self._build_delta_tracker(since) if since is not None else None
+        metrics = metrics if metrics is not None else MigrationMetrics('export')
+
+        # zstd entries are compressed before they're stored, so the level is applied by the archive writer
+        zip_level = compression_level if compression != 'zstd' else None
+
+        archive = zipfile.ZipFile(archive_file, mode='w', compression=COMPRESSION_CODECS[compression], compresslevel=zip_level)
+        archive = ArchiveWriter(archive, table_format, spool=(jobs > 1), batch_size=batch_size, compression=compression,
+            compression_level=compression_level, metrics=metrics)
+
+        super(OrgExporter, self).__init__(dbconn, archive, org_id, ignore_dupes, batch_size)
+
+        self.jobs = jobs
+        self.connect = connect
+        self.pool = pool
+        self.delta = delta
+        self.shared_tables = shared_tables
+        self.metrics = metrics
+        self.staging = staging if staging is not None else StagingArea()
+
+        dbconn.query_listener = metrics.record_query
+        self.archive.annotate('orgs', self.org_ids)
+
+        if delta is not None:
+            self.archive.annotate('delta', {
+                'since':    str(delta.since),
+                'base':     os.path.basename(since) if delta.previous is not None else None
+            })
+
+    def _build_delta_tracker(self, since):
+        # The since value is either a timestamp or a previous archive, in which case we export changes
+        # made since that archive was created and diff against its keys to find deletions
+        if not os.path.isfile(since):
+            log.warning('Exporting changes since a timestamp; deletions cannot be tracked without a previous archive')
+            return DeltaTracker(since)
+
+        previous = ArchiveReader(zipfile.ZipFile(since, 'r'))
+
+        if previous.exported_at is None:
+            raise Exception("Previous archive does not record its export time; provide a timestamp instead: %s" % (since,))
+
+        # Rows can be committed with timestamps from slightly before the previous export's snapshot was
+        # taken, so we overlap the window a bit. Upserting a row twice is harmless.
+        since = datetime.datetime.fromisoformat(previous.exported_at) - DELTA_OVERLAP
+        log.info('Exporting changes since previous archive export time, %s (with a %s overlap)', previous.exported_at, DELTA_OVERLAP)
+
+        return DeltaTracker(str(since), previous)
+
+    def prepare(self):
+        """
+        Prepares the primary connection for export. This must be called before the export transaction
+        is started on the connection; if it isn't, some queries fall back to less efficient forms.
+        """
+        self.staging.prepare(self.db)
 
     def execute(self):
+        self.archive.annotate('exported_at', get_db_timestamp(self.db))
+
+        # A pool provided by the caller is shared with other exports, and remains open afterward
+        if self.pool is not None:
+            return self._export_with_pool(self.pool)
+
+        if self.jobs < 2:
+            return self._export_with_pool(None)
+
+        with ExportWorkerPool(self.db, self.connect, self.jobs, self.staging.prepare) as pool:
+            return self._export_with_pool(pool)
+
+    def _export_with_pool(self, pool):
+        # Impl note:
+        # The model managers submit their queries to the worker pool rather than running them
+        # directly, so we need to wait for the pool to drain before the export is actually complete.
+        # When counting rows for progress reporting, the queries are held back until all of them have
+        # been counted, so progress is measured against the full total from the start.
+        deferred = DeferredExecutor() if self.metrics.counting else None
+        self.executor = deferred if deferred is not None else pool
+
+        try:
+            result = self._export_impl()
+
+            if deferred is not None:
+                self.executor = pool
+                deferred.run(pool, self.db)
+
+            if pool is not None:
+                result = pool.wait() and result
+
+            result = result and self._export_keys()
+
+            if pool is not None:
+                result = pool.wait() and result
+        finally:
+            self.executor = None
+
+        return result
+
+    def _export_keys(self):
+        if self.delta is None:
+            return True
+
+        log.info('Exporting key sets for delta export')
+
+        for table in self.delta.tables:
+            if self.executor is not None:
+                self.executor.submit(self.delta.export_keys, self.archive, table, self.batch_size)
+            elif not self.delta.export_keys(self.db, self.archive, table, self.batch_size):
+                log.debug('Unable to track deletions for table: %s', table)
+
+        return True
+
+    def _export_impl(self):
         # Impl note:
         # Order doesn't matter for export, so we can just run through the list once
         for task in self.workers:
@@ -781,14 +3254,273 @@ class OrgExporter(OrgMigrator):
 
 
 
+class OrgBatchExporter(object):
+    """
+    Exports a batch of orgs over a single connection and worker pool. The orgs are written to one
+    archive together, or to an archive per org if the archive file name contains the org placeholder.
+    """
+
+    ORG_PLACEHOLDER = '{org}'
+
+    def __init__(self, dbconn, archive_file, orgs, ignore_dupes, batch_size=DEFAULT_BATCH_SIZE, jobs=1, connect=None,
+        table_format=JSONTableFormat.name, compression=DEFAULT_COMPRESSION, compression_level=None, since=None, metrics=None):
+
+        self.db = dbconn
+        self.archive_file = archive_file
+        self.orgs = orgs
+        self.ignore_dupes = ignore_dupes
+        self.batch_size = batch_size
+        self.jobs = jobs
+        self.connect = connect
+        self.table_format = table_format
+        self.compression = compression
+        self.compression_level = compression_level
+        self.since = since
+        self.metrics = metrics if metrics is not None else MigrationMetrics('export')
+        self.staging = StagingArea()
+
+        # The worker pool copies the listener from the primary connection when it's opened
+        dbconn.query_listener = self.metrics.record_query
+
+    def prepare(self):
+        self.staging.prepare(self.db)
+
+    @property
+    def per_org(self):
+        return OrgBatchExporter.ORG_PLACEHOLDER in self.archive_file
+
+    def get_archive_file(self, org):
+        return OrgBatchExporter._expand_placeholder(self.archive_file, org)
+
+    @staticmethod
+    def _expand_placeholder(path, org):
+        if path is None:
+            return None
+
+        # Org keys are user-defined, so make sure they can't escape the directory of the archive
+        return path.replace(OrgBatchExporter.ORG_PLACEHOLDER, re.sub(r'[^\w.-]', '_', org))
+
+    def execute(self):
+        if not self.per_org:
+            log.info('Exporting %d orgs to file: %s', len(self.orgs), self.archive_file)
+            return self._export(self.archive_file, list(self.orgs.values()), self.since)
+
+        # Impl note:
+        # The worker pool holds a transaction sharing the snapshot of the primary connection, so every
+        # archive in the batch is consistent with every other
+        pool = ExportWorkerPool(self.db, self.connect, self.jobs, self.staging.prepare) if self.jobs > 1 else None
+        shared_tables = SharedTableCache()
+
+        try:
+            if pool is not None:
+                pool.open()
+
+            for (org, org_id) in self.orgs.items():
+                archive_file = self.get_archive_file(org)
+                log.info('Exporting org "%s" to file: %s', org, archive_file)
+
+                if not self._export(archive_file, org_id, self._expand_placeholder(self.since, org), pool, shared_tables):
+                    log.error('Export of org "%s" failed', org)
+                    return False
+        finally:
+            if pool is not None:
+                pool.close()
+
+        return True
+
+    def _export(self, archive_file, org_id, since, pool=None, shared_tables=None):
+        exporter = OrgExporter(self.db, archive_file, org_id, self.ignore_dupes, self.batch_size, self.jobs, self.connect,
+            self.table_format, self.compression, self.compression_level, since, pool, shared_tables, self.metrics, self.staging)
+
+        try:
+            return exporter.execute()
+        finally:
+            exporter.close()
+
+
+
+class OrgExplainer(OrgMigrator):
+    """
+    Audits the execution plans of the queries an export of the given org(s) would run, without
+    exporting anything
+    """
+
+    def __init__(self, dbconn, org_id, analyze=False):
+        super(OrgExplainer, self).__init__(dbconn, None, org_id, False)
+
+        self.explainer = QueryExplainer(analyze)
+        self.staging = StagingArea()
+        self.results = None
+
+    def prepare(self):
+        """
+        Prepares the connection for explaining, so the queries are explained as an export would run
+        them. This must be called before the explain transaction is started on the connection.
+        """
+        self.staging.prepare(self.db)
+
+    def execute(self):
+        for task in self.workers:
+            if not self._get_model_exporter(task).do_export():
+                log.error('Unable to collect queries from task: %s', task.__name__)
+                return False
+
+        self.results = self.explainer.run(self.db)
+        return True
+
+
+
 class OrgImporter(OrgMigrator):
-    def __init__(self, dbconn, archive_file, org_id, ignore_dupes):
-        archive = zipfile.ZipFile(archive_file, 'r')
+    def __init__(self, dbconn, archive_file, org_id, ignore_dupes, metrics=None, batch_size=DEFAULT_BATCH_SIZE, jobs=1, connect=None,
+        rebuild_indexes=False, checkpoint_rows=None, remap_ids=False):
+        if jobs > 1 and connect is None:
+            raise ValueError("A connection factory is required to import using multiple jobs")
+
+        archive = ArchiveReader(zipfile.ZipFile(archive_file, 'r'))
+        log.debug('Archive format version: %s', archive.format_version)
+
+        # The rows of a delta archive are meant to replace the rows sharing their IDs
+        if remap_ids and archive.is_delta:
+            raise ValueError("IDs cannot be remapped when importing a delta archive")
+
+        super(OrgImporter, self).__init__(dbconn, archive, org_id, ignore_dupes, batch_size)
+
+        self.metrics = metrics if metrics is not None else MigrationMetrics('import')
+        dbconn.query_listener = self.metrics.record_query
+
+        # The manifest records the row count of every entry, so imports never need to count rows
+        if archive.manifest is not None:
+            self.metrics.expect_rows(sum(details['rows'] for details in archive.manifest['entries'].values()
+                if details.get('kind', ENTRY_KIND_DATA) == ENTRY_KIND_DATA))
+
+        # Delta archives only contain the rows which changed, some of which will already exist
+        self.upsert = archive.is_delta
+
+        # Worker connections are shared by the concurrent import and the index rebuild that follows it
+        self.connections = cp.ConnectionPool(connect, max_size=jobs) if jobs > 1 else None
+
+        # Resumable imports commit their progress as they go, rather than in a single transaction
+        if checkpoint_rows is not None:
+            self.checkpoints = ImportCheckpoints(dbconn, archive_file, checkpoint_rows)
+
+        # Upserts depend on the rows already present in each table, so delta archives are always
+        # imported one table at a time on the primary connection
+        if jobs > 1 and not self.upsert:
+            self.scheduler = ImportScheduler(dbconn, archive, self.connections, jobs, ignore_dupes, self.checkpoints)
 
-        super(OrgImporter, self).__init__(dbconn, archive, org_id, ignore_dupes)
+        if remap_ids:
+            self.remapper = IDRemapper(dbconn, archive, archive_file + '.idmap.json', batch_size)
+
+        self.indexes = None
+        if rebuild_indexes:
+            self.indexes = IndexRebuilder(dbconn, self.connections, jobs, archive.get_tables(), archive_file + '.indexes.json')
+
+    def prepare(self):
+        """
+        Prepares the database for import. This must be called before the import transaction is started.
+        """
+        if self.checkpoints is not None:
+            self.checkpoints.prepare()
+
+            # Rows committed by a previous attempt won't be read again
+            if self.archive.manifest is not None:
+                skipped = 0
+
+                for (file, details) in self.archive.manifest['entries'].items():
+                    (rows, complete) = self.checkpoints.get_progress(file)
+                    skipped = skipped + (details['rows'] if complete else rows)
+
+                self.metrics.expect_rows(-skipped)
+
+        # A resumed import must assign the same IDs as the attempt it continues
+        if self.remapper is not None:
+            self.remapper.prepare(self.checkpoints is not None and self.checkpoints.resuming)
+
+        if self.indexes is not None:
+            self.indexes.drop()
+
+    @property
+    def resumable(self):
+        """
+        Whether or not the import commits its progress as it goes, rather than running in a transaction
+        """
+        return self.checkpoints is not None
+
+    def cleanup(self):
+        """
+        Cleans up after the import. Closing the importer does not end the import transaction, so this
+        is separate, and must not be called until the transaction has ended.
+        """
+        if not self.db.is_closed():
+            if self.scheduler is not None:
+                self.scheduler.drop_staging_tables()
+
+            if self.indexes is not None:
+                self.indexes.rebuild()
+
+        if self.connections is not None:
+            self.connections.close()
 
     def execute(self):
-        return self._import_impl(self.workers)
+        if self.scheduler is not None:
+            with self.scheduler:
+                result = self._import_impl(self.workers) and self.scheduler.run()
+        else:
+            result = self._import_impl(self.workers)
+
+        if not result:
+            return False
+
+        if self.remapper is not None:
+            self.remapper.advance_sequences()
+
+        if self.checkpoints is None:
+            return self._apply_deletions() if self.archive.is_delta else True
+
+        # Deleting rows is idempotent, so the deletions of a delta archive are applied along with the
+        # removal of its checkpoints, and simply applied again should either fail
+        with self.db.start_transaction() as transaction:
+            if self.archive.is_delta and not self._apply_deletions():
+                transaction.rollback()
+                return False
+
+            self.checkpoints.clear(self.db)
+            transaction.commit()
+
+        return True
+
+    def _apply_deletions(self):
+        # Rows must be deleted children-first, which is the reverse of the order tables were imported
+        files = self.archive.get_entries(ENTRY_KIND_DELETIONS)
+        order = list(reversed(self.archive.read_order))
+        files.sort(key=lambda file: order.index(self._entry_table(file)) if self._entry_table(file) in order else -1)
+
+        for file in files:
+            with self.archive.read_table(file) as data:
+                validate_column_names(data.table, data.columns)
+
+                if len(data.columns) > 1:
+                    pblock = '(' + ', '.join(['%s'] * len(data.columns)) + ')'
+                    target = '(' + ', '.join(data.columns) + ')'
+                else:
+                    pblock = '%s'
+                    target = data.columns[0]
+
+                # Every batch runs the same statement, so it's only parsed and planned once. The last batch
+                # is padded out by repeating its final key, which doesn't change the rows matched.
+                statement = 'DELETE FROM ' + data.table + ' WHERE ' + target + ' IN (' + ', '.join([pblock] * DELETE_BATCH_SIZE) + ')'
+
+                count = 0
+                for block in iterate_batches(data.rows, DELETE_BATCH_SIZE):
+                    block = block + [block[-1]] * (DELETE_BATCH_SIZE - len(block))
+                    count = count + self.db.execUpdate(statement, [value for row in block for value in row], prepare=True)
+
+                log.debug('Deleted %d rows from table: %s', count, data.table)
+
+        return True
+
+    def _entry_table(self, file):
+        return self.archive.manifest['entries'][file]['table']
 
     def _import_impl(self, task_list, depth=0):
         if depth > 100:
@@ -819,7 +3551,7 @@ class OrgImporter(OrgMigrator):
 
 
 def parse_options():
-    usage = "usage: %prog ORG"
+    usage = "usage: %prog [ORG ...]"
     parser = OptionParser(usage=usage)
 
     parser.add_option("--debug", action="store_true", default=False,
@@ -840,33 +3572,127 @@ def parse_options():
     parser.add_option("--db", action="store", default='candlepin',
         help="The database to use; defaults to 'candlepin'")
     parser.add_option("--file", action="store", default='export.zip',
-        help="The name of the file to export to or import from; defaults to 'export.zip'")
+        help="The name of the file to export to or import from; defaults to 'export.zip'. When exporting multiple orgs, a file name containing %s produces an archive per org, with the placeholder replaced by the org key" % (OrgBatchExporter.ORG_PLACEHOLDER,))
 
     parser.add_option("--import", dest='act_import', action="store_true", default=False,
         help="Sets the operating mode to IMPORT; cannot be used with --export or --list")
     parser.add_option("--export", dest='act_export', action="store_true", default=False,
         help="Sets the operating mode to EXPORT; cannot be used with --import or --list")
+    parser.add_option("--export-all", dest='export_all', action="store_true", default=False,
+        help="Sets the operating mode to EXPORT and exports every org; cannot be used with --import or --list")
     parser.add_option("--list", dest="act_list", action="store_true", default=False,
         help="Sets the operating mode to LIST; cannot be used with --import or --export")
 
     parser.add_option("--ignore_dupes", dest="ignore_dupes", action="store_true", default=False,
         help="Ignores duplicate entities during import")
+    parser.add_option("--format", dest="format", action="store", default=JSONTableFormat.name,
+        choices=sorted(TABLE_FORMATS.keys()),
+        help="The format to use for tables in the export archive; one of: %s. Defaults to '%s'. Imports detect the format automatically" % \
+            (', '.join(sorted(TABLE_FORMATS.keys())), JSONTableFormat.name))
+    parser.add_option("--compression", dest="compression", action="store", default=DEFAULT_COMPRESSION,
+        choices=sorted(COMPRESSION_CODECS.keys()),
+        help="The codec to use to compress tables in the export archive; one of: %s. Defaults to '%s'" % \
+            (', '.join(sorted(COMPRESSION_CODECS.keys())), DEFAULT_COMPRESSION))
+    parser.add_option("--compression-level", dest="compression_level", action="store", type="int", default=None,
+        help="The compression level to use with the selected codec; defaults to the codec's default level")
+    parser.add_option("--since", dest="since", action="store", default=None,
+        help="Exports only rows created or updated since the given timestamp or previous export archive. Given an archive, rows deleted since it was exported are recorded as well. The resulting delta archive is applied as upserts and deletes on import")
+    parser.add_option("--explain", dest="explain", action="store_true", default=False,
+        help="Rather than exporting the given orgs, audits the execution plans of the queries the export would run, flagging sequential scans and sorts")
+    parser.add_option("--explain-analyze", dest="explain_analyze", action="store_true", default=False,
+        help="Executes each query while auditing execution plans to include actual row counts and timings; implies --explain")
+    parser.add_option("--progress", dest="progress", action="store_true", default=False,
+        help="Reports progress and the estimated time remaining while running. Exports count the rows of every query up front to do so")
+    parser.add_option("--timing-report", dest="timing_report", action="store", default=None,
+        help="Writes a JSON report of the time spent on each query and archive entry to the given file once complete")
+    parser.add_option("--jobs", dest="jobs", action="store", type="int", default=1,
+        help="The number of database connections to use to export or import tables concurrently; defaults to 1")
+    parser.add_option("--batch-size", dest="batch_size", action="store", type="int", default=DEFAULT_BATCH_SIZE,
+        help="The number of rows to fetch from the server and write at a time during export, or to insert per statement during import; defaults to %d" % (DEFAULT_BATCH_SIZE,))
+    parser.add_option("--rebuild-indexes", dest="rebuild_indexes", action="store_true", default=False,
+        help="Drops the secondary indexes of the imported tables before importing, and rebuilds them once complete. Speeds up imports of large orgs into populated databases")
+    parser.add_option("--remap-ids", dest="remap_ids", action="store_true", default=False,
+        help="Assigns new IDs to imported rows whose IDs already exist in the database, rewriting the references to them. The IDs changed are written alongside the archive, to <file>.idmap.json")
+    parser.add_option("--resume", dest="resume", action="store_true", default=False,
+        help="Commits the import in chunks, recording its progress in the database so a failed import can be rerun with --resume to pick up where it stopped")
+    parser.add_option("--checkpoint-rows", dest="checkpoint_rows", action="store", type="int", default=DEFAULT_CHECKPOINT_ROWS,
+        help="The number of rows to commit at a time when using --resume; defaults to %d" % (DEFAULT_CHECKPOINT_ROWS,))
+    parser.add_option("--type-cache-dir", dest="type_cache_dir", action="store", default=None,
+        help="Saves the names of the PostgreSQL server's built-in types to the given directory, so later runs needn't look them up")
 
     (options, args) = parser.parse_args()
 
+    if options.explain_analyze:
+        options.explain = True
+
+    if options.explain and not (options.act_export or options.export_all):
+        parser.error("--explain can only be used with --export or --export-all")
+
+    if options.export_all:
+        if len(args) > 0:
+            parser.error("Orgs cannot be specified when using --export-all")
+
+        options.act_export = True
+
     if not options.act_import and not options.act_export and not options.act_list:
         parser.error("One of --import, --export, or --list must be specified")
 
     if not (options.act_import ^ options.act_export ^ options.act_list) or (options.act_import and options.act_export and options.act_list):
         parser.error("Only one of --import, --export, and --list may be specified in a given command")
 
-    if len(args) < 1 and options.act_export:
+    if len(args) < 1 and options.act_export and not options.export_all:
         parser.error("Must provide an organization to export")
 
+    if options.batch_size < 1:
+        parser.error("Batch size must be a positive integer")
+
+    if options.jobs < 1:
+        parser.error("Job count must be a positive integer")
+
+    if options.checkpoint_rows < 1:
+        parser.error("Checkpoint row count must be a positive integer")
+
+    if options.resume and not options.act_import:
+        parser.error("--resume can only be used with --import")
+
+    if options.remap_ids and not options.act_import:
+        parser.error("--remap-ids can only be used with --import")
+
+    if options.compression_level is not None:
+        if options.compression not in COMPRESSION_LEVELS:
+            parser.error("Compression codec '%s' does not support compression levels" % (options.compression,))
+
+        (min_level, max_level) = COMPRESSION_LEVELS[options.compression]
+        if options.compression_level < min_level or options.compression_level > max_level:
+            parser.error("Compression level for codec '%s' must be between %d and %d" % (options.compression, min_level, max_level))
+
     return (options, args)
 
 
 
+def run_with_metrics(task, metrics, options):
+    """
+    Executes the given import or export task, reporting its progress and writing its timing report as
+    requested by the given options
+    """
+    try:
+        if options.progress:
+            with ProgressReporter(metrics):
+                return task.execute()
+        else:
+            return task.execute()
+    finally:
+        # Closing the task completes the archive, which fills in the stored size of each entry
+        if hasattr(task, 'close'):
+            task.close()
+
+        metrics.finish()
+
+        if options.timing_report is not None:
+            metrics.write_report(options.timing_report)
+
+
+
 def main():
     (options, args) = parse_options()
 
@@ -878,6 +3704,9 @@ def main():
         log.setLevel(LOGLVL_TRACE)
         cp.set_log_level(LOGLVL_TRACE)
 
+    if options.type_cache_dir is not None:
+        cp.set_type_cache_dir(options.type_cache_dir)
+
     db = None
 
     try:
@@ -895,35 +3724,82 @@ def main():
                 log.error("File does not exist or cannot be read: %s", options.file)
                 return
 
-            importer = OrgImporter(db, options.file, None, options.ignore_dupes)
+            connect = partial(cp.get_db_connector, options.dbtype, options.host, options.port, options.username, options.password, options.db)
+            metrics = MigrationMetrics('import', counting=options.progress)
+            importer = OrgImporter(db, options.file, None, options.ignore_dupes, metrics, options.batch_size, options.jobs, connect,
+                options.rebuild_indexes, options.checkpoint_rows if options.resume else None, options.remap_ids)
 
             log.info('Importing data from file: %s', options.file)
-            with(db.start_transaction(readonly=False)) as transaction:
-                if importer.execute():
-                    transaction.commit()
-                    log.info('Task complete! Shutting down...')
+
+            try:
+                importer.prepare()
+
+                if importer.resumable:
+                    # Resumable imports commit their own progress as they go
+                    if run_with_metrics(importer, metrics, options):
+                        log.info('Task complete! Shutting down...')
+                    else:
+                        log.error("Import task failed; rerun with --resume to continue from the last checkpoint. Shutting down...")
                 else:
-                    transaction.rollback()
-                    log.error("Import task failed. Shutting down...")
+                    with(db.start_transaction(readonly=False)) as transaction:
+                        if run_with_metrics(importer, metrics, options):
+                            transaction.commit()
+                            log.info('Task complete! Shutting down...')
+                        else:
+                            transaction.rollback()
+                            log.error("Import task failed. Shutting down...")
+            finally:
+                # Any staging tables are read by the import transaction, and indexes can't be rebuilt from
+                # the imported rows, until it ends
+                importer.cleanup()
 
         elif options.act_export:
-            org_id = resolve_org(db, args[0])
+            orgs = resolve_orgs(db, args if not options.export_all else None)
+            missing = [org for org in args if org not in orgs]
+
+            if len(missing) > 0:
+                log.error("No such org: %s", ', '.join(missing))
+            elif len(orgs) < 1:
+                log.error("No orgs to export")
+            else:
+                for (org, org_id) in orgs.items():
+                    log.info('Resolved org "%s" to org ID: %s', org, org_id)
 
-            if org_id is not None:
-                log.info('Resolved org "%s" to org ID: %s', args[0], org_id)
+                # Stream results from the server in blocks of the same size we write them
+                db.itersize = options.batch_size
 
-                exporter = OrgExporter(db, options.file, org_id, False)
+                if options.explain:
+                    explainer = OrgExplainer(db, list(orgs.values()), options.explain_analyze)
+                    explainer.prepare()
+
+                    # Nothing should be written while explaining, but analyzing executes the queries
+                    with(db.start_transaction(readonly=True, consistent=True)) as transaction:
+                        explainer.execute()
+                        transaction.rollback()
+
+                    return
+
+                connect = partial(cp.get_db_connector, options.dbtype, options.host, options.port, options.username, options.password, options.db)
+                metrics = MigrationMetrics('export', counting=options.progress)
+
+                if len(orgs) == 1 and OrgBatchExporter.ORG_PLACEHOLDER not in options.file:
+                    exporter = OrgExporter(db, options.file, list(orgs.values())[0], False, options.batch_size, options.jobs, connect,
+                        options.format, options.compression, options.compression_level, options.since, metrics=metrics)
+                else:
+                    exporter = OrgBatchExporter(db, options.file, orgs, False, options.batch_size, options.jobs, connect,
+                        options.format, options.compression, options.compression_level, options.since, metrics)
+
+                # Staging tables can't be created once the read-only export transaction has started
+                exporter.prepare()
 
                 log.info('Exporting data to file: %s', options.file)
-                with(db.start_transaction(readonly=True)) as transaction:
-                    if exporter.execute():
+                with(db.start_transaction(readonly=True, consistent=True)) as transaction:
+                    if run_with_metrics(exporter, metrics, options):
                         transaction.commit()
                         log.info('Task complete! Shutting down...')
                     else:
                         transaction.rollback()
                         log.error("Import task failed. Shutting down...")
-            else:
-                log.error("No such org: %s", args[0])
 
         elif options.act_list:
             print("Available orgs: %s" % (list_orgs(db)))